@@ -0,0 +1,223 @@
+"""
+Offline benchmarks of the pyesat hot paths, against the local stand-ins in servers.py.
+
+    python bench/bench_pyesat.py --hits 2000 --latency 0.02 --output bench.json
+    python bench/bench_pyesat.py --baseline bench.json
+
+Results are written as json; with --baseline every benchmark is compared with an earlier run, and the run fails
+(exit status 1) if any benchmark got slower by more than --threshold.
+"""
+import sys
+import json
+import time
+import argparse
+import subprocess
+import platform
+import tempfile
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, Path(__file__).parent.parent.as_posix())  # benchmark the working tree
+
+import servers
+import pyesat.credentials
+import pyesat.blockcache
+import pyesat.pipeline
+import pyesat.earthdata
+import pyesat.probe
+
+_bbox = '-75.0,40.5,-73.6,41.6'
+_date_range = '2022-10-01T00:00:00Z,2022-12-31T23:59:59Z'
+_data_sets = ['LST', 'QC', 'cloud']
+_repo_dir = Path(__file__).parent.parent
+
+
+def timed(fn, repeat: int) -> dict:
+    # run fn repeat times, fn returns the number of items it processed (or None)
+    times = []
+    items = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = fn()
+        times.append(time.perf_counter() - start)
+    result = {'min': min(times), 'median': statistics.median(times), 'repeat': repeat}
+    if items:
+        result['items'] = items
+        result['items_per_second'] = items / result['median']
+    return result
+
+
+def setup_credentials(work_dir: Path, credential_server: servers.CredentialServer) -> None:
+    # point pyesat at a scratch config file and the fake credential endpoints
+    pyesat.credentials.config_file = work_dir / 'config.ini'
+    endpoints = credential_server.endpoints()
+    for daac in pyesat.credentials._s3_cred_endpoint:
+        pyesat.credentials._s3_cred_endpoint[daac] = endpoints['s3credentials']
+    for key in pyesat.credentials._edl_token_urls:
+        pyesat.credentials._edl_token_urls[key] = endpoints[key]
+    pyesat.blockcache._block_cache = pyesat.blockcache.BlockCache(work_dir / 'blocks')
+
+
+def bench_import(args, module: str) -> dict:
+    # cold start: import time of a module in a fresh interpreter, as paid by every CLI call and worker process
+    def _import():
+        subprocess.run([sys.executable, '-c', f'import {module}'], cwd=_repo_dir.as_posix(), check=True)
+    return timed(_import, max(args.repeat, 5))
+
+
+def bench_credentials(args) -> dict:
+    def _fetch():
+        for _ in range(args.n_credentials):
+            temp_credentials = pyesat.credentials.get_temp_credentials('lpdaac')
+        pyesat.credentials.set_worker_credentials({
+            'lpdaac': {'access_key': temp_credentials['accessKeyId'],
+                       'secret_key': temp_credentials['secretAccessKey'],
+                       'session_token': temp_credentials['sessionToken'],
+                       'expiration_date': temp_credentials['expiration']},
+            pyesat.credentials._remote_hostname: 'bench-token'})
+        return args.n_credentials
+    return timed(_fetch, args.repeat)
+
+
+def bench_search(args, cmr: servers.MockCMR) -> dict:
+    client = pyesat.earthdata.CMRClient(base_url=cmr.url)
+
+    def _search():
+        return sum(1 for _ in client.iter_granules(_bbox, _date_range, page_size=args.page_size))
+    return timed(_search, args.repeat)
+
+
+def bench_parsing(args, cmr: servers.MockCMR) -> dict:
+    entries = [cmr.entry(i) for i in range(args.hits)]
+
+    def _parse():
+        return len([pyesat.earthdata.Granule(entry, verbose=False) for entry in entries])
+    return timed(_parse, args.repeat)
+
+
+def bench_ingest(args, cmr: servers.MockCMR, work_dir: Path) -> dict:
+    entries = [cmr.entry(i) for i in range(args.hits)]
+    db_paths = iter(work_dir / f'ingest_{i}.db' for i in range(args.repeat))
+
+    def _ingest():
+        db_path = next(db_paths)
+        pyesat.earthdata.create_orm_classes(db_path=db_path)
+        with pyesat.earthdata.SessionContextManager(db_path=db_path) as session:
+            session.add_all([pyesat.earthdata.Granule(entry, verbose=False) for entry in entries])
+            session.commit()
+        return len(entries)
+    return timed(_ingest, args.repeat)
+
+
+def bench_get_xarray(args, cmr: servers.MockCMR, block_cache: bool) -> dict:
+    granules = iter([pyesat.earthdata.Granule(cmr.entry(i), verbose=False)
+                     for i in range(args.n_granules * args.repeat)])
+
+    def _open():
+        for _ in range(args.n_granules):
+            next(granules).get_xarray(data_sets=_data_sets, aws=False, verbose=False, block_cache=block_cache).load()
+        return args.n_granules
+    result = timed(_open, args.repeat)
+    result['seconds_per_granule'] = result['median'] / args.n_granules
+    return result
+
+
+def bench_zarr(args, cmr: servers.MockCMR, work_dir: Path) -> dict:
+    data_set = pyesat.earthdata.Granule(cmr.entry(0), verbose=False).get_xarray(
+        data_sets=_data_sets, aws=False, verbose=False).load()
+    data_set.attrs = pyesat.pipeline.zarr_attrs(data_set.attrs)
+    stores = iter(work_dir / f'bench_{i}.zarr' for i in range(args.repeat))
+
+    def _write():
+        data_set.to_zarr(next(stores).as_posix(), mode='w')
+    result = timed(_write, args.repeat)
+    result['megabytes_per_second'] = data_set.nbytes / 1024 ** 2 / result['median']
+    return result
+
+
+def bench_probe(args, cmr: servers.MockCMR, work_dir: Path, cached: bool) -> dict:
+    # layer headers of n_probe granules, probed over HTTPS into a new catalog or served from the catalog
+    granules = [pyesat.earthdata.Granule(cmr.entry(i), verbose=False) for i in range(args.n_probe)]
+    catalogs = iter(pyesat.probe.HeaderCatalog(work_dir / f'probe_{i}.db') for i in range(args.repeat))
+    warm = pyesat.probe.HeaderCatalog(work_dir / 'probe.db')
+    pyesat.probe.probe_granules(granules, aws=False, catalog=warm)
+
+    def _probe():
+        catalog = warm if cached else next(catalogs)
+        return len(pyesat.probe.probe_granules(granules, aws=False, catalog=catalog))
+    return timed(_probe, args.repeat)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    # print the change of the median time of every benchmark, returns False if any regressed
+    ok = True
+    print(f"\n{'benchmark':<24}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            print(f'{name:<24}{"-":>12}{result["median"]:>12.4f}{"new":>10}')
+            continue
+        before = baseline['benchmarks'][name]['median']
+        change = result['median'] / before - 1.
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            ok = False
+        print(f'{name:<24}{before:>12.4f}{result["median"]:>12.4f}{change:>+10.1%}{flag}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline pyesat benchmarks.')
+    parser.add_argument('--hits', type=int, default=2000, help='number of granules served by the mock CMR')
+    parser.add_argument('--page-size', type=int, default=500, help='CMR page size')
+    parser.add_argument('--latency', type=float, default=0., help='latency of every mock request (s)')
+    parser.add_argument('--tile-size', type=int, default=servers._tile_size, help='synthetic tile size (pixels)')
+    parser.add_argument('--n-granules', type=int, default=3, help='granules opened per get_xarray repeat')
+    parser.add_argument('--n-probe', type=int, default=200, help='granules probed per header probe repeat')
+    parser.add_argument('--n-credentials', type=int, default=20, help='credential requests per repeat')
+    parser.add_argument('--repeat', type=int, default=3, help='repeats of every benchmark')
+    parser.add_argument('--output', type=str, help='write the results to this json file')
+    parser.add_argument('--baseline', type=str, help='compare with the results in this json file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown reported as a regression')
+    args = parser.parse_args()
+
+    results = {'platform': platform.platform(), 'python': platform.python_version(), 'args': vars(args),
+               'benchmarks': {}}
+    benchmarks = results['benchmarks']
+    benchmarks['import_earthdata'] = bench_import(args, 'pyesat.earthdata')
+    benchmarks['import_credentials'] = bench_import(args, 'pyesat.credentials')
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+        tile_dir = servers.make_tiles(work_dir / 'tiles', size=args.tile_size)
+        with servers.CredentialServer(latency=args.latency) as credential_server, \
+                servers.RangeServer(tile_dir, latency=args.latency) as range_server, \
+                servers.MockCMR(hits=args.hits, latency=args.latency, data_url=range_server.url) as cmr:
+            setup_credentials(work_dir, credential_server)
+            benchmarks['credentials'] = bench_credentials(args)
+            benchmarks['search'] = bench_search(args, cmr)
+            benchmarks['granule_parsing'] = bench_parsing(args, cmr)
+            benchmarks['catalog_ingest'] = bench_ingest(args, cmr, work_dir)
+            benchmarks['get_xarray'] = bench_get_xarray(args, cmr, block_cache=False)
+            benchmarks['get_xarray_block_cache'] = bench_get_xarray(args, cmr, block_cache=True)
+            benchmarks['zarr_write'] = bench_zarr(args, cmr, work_dir)
+            benchmarks['header_probe'] = bench_probe(args, cmr, work_dir, cached=False)
+            benchmarks['header_probe_catalog'] = bench_probe(args, cmr, work_dir, cached=True)
+            results['requests'] = {'cmr': cmr.requests, 'data': range_server.requests,
+                                   'credentials': credential_server.requests,
+                                   'data_bytes': range_server.bytes_sent}
+
+    for name, result in benchmarks.items():
+        rate = f"{result['items_per_second']:.1f} items/s" if 'items_per_second' in result else ''
+        print(f"{name:<24}{result['median']:>10.4f} s  {rate}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
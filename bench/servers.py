@@ -0,0 +1,266 @@
+"""
+Local stand-ins for the remote services used by pyesat, for offline benchmarks:
+
+- MockCMR: replays recorded CMR granule feeds (bench/data/*.json) with a configurable number of hits and latency
+- RangeServer: serves synthetic COG tiles over HTTP with byte range support, as LP DAAC does
+- CredentialServer: fake s3credentials and Earthdata token endpoints
+"""
+import re
+import json
+import time
+import copy
+import multiprocessing
+import datetime
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_origin
+
+data_dir = Path(__file__).parent / 'data'
+
+# layers of the synthetic L2T LSTE granules: dtype and value range
+_layers = {
+    'LST': ('float32', (250., 320.)),
+    'LST_err': ('float32', (0.5, 2.)),
+    'QC': ('uint16', (0, 65535)),
+    'cloud': ('uint8', (0, 2)),
+}
+_tile_size = 1568  # 70 m MGRS tiles
+_dt_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def make_tiles(out_dir: Path, size: int = _tile_size, block_size: int = 256, seed: int = 0) -> Path:
+    # write synthetic COGs for every layer, named by layer (e.g. LST.tif)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    transform = from_origin(499980., 4600020., 70., 70.)  # MGRS tile 18TWL
+    for layer, (dtype, (low, high)) in _layers.items():
+        if np.dtype(dtype).kind == 'f':
+            data = rng.uniform(low, high, (size, size)).astype(dtype)
+        else:
+            data = rng.integers(low, high, (size, size)).astype(dtype)
+        with rio.open((out_dir / f'{layer}.tif').as_posix(), 'w', driver='COG', width=size, height=size, count=1,
+                      dtype=dtype, crs='EPSG:32618', transform=transform, blocksize=block_size,
+                      compress='DEFLATE') as dst:
+            dst.write(data, 1)
+    return out_dir
+
+
+def load_feed(feed_dir: Path = data_dir) -> list:
+    # recorded CMR granule entries, one entry or a full feed per file
+    entries = []
+    for feed_file in sorted(Path(feed_dir).glob('*.json')):
+        with open(feed_file, 'r') as f:
+            content = json.load(f)
+        if 'feed' in content:
+            entries.extend(content['feed']['entry'])
+        else:
+            entries.append(content)
+    return entries
+
+
+class _Server:
+    # HTTP server running in a separate process, GDAL holds the GIL while it waits for responses
+    handler = BaseHTTPRequestHandler
+
+    def __init__(self, latency: float = 0.):
+        self.latency = latency
+        self._context = multiprocessing.get_context('fork')
+        self._requests = self._context.Value('l', 0)
+        self._bytes_sent = self._context.Value('l', 0)
+        server = self
+
+        class Handler(self.handler):
+            owner = server
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.process = self._context.Process(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    @property
+    def requests(self) -> int:
+        return self._requests.value
+
+    @property
+    def bytes_sent(self) -> int:
+        return self._bytes_sent.value
+
+    def __enter__(self):
+        self.process.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.process.terminate()
+        self.process.join()
+        self.httpd.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    owner = None
+    protocol_version = 'HTTP/1.1'
+
+    def _wait(self):
+        with self.owner._requests.get_lock():
+            self.owner._requests.value += 1
+        if self.owner.latency:
+            time.sleep(self.owner.latency)
+
+    def _send_json(self, content, headers=None):
+        body = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _CMRHandler(_Handler):
+    def do_GET(self):
+        self._wait()
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+        if parsed.path.endswith('collections') or parsed.path.endswith('collections.json'):
+            self._send_json({'feed': {'entry': []}}, {'CMR-Hits': '0'})
+            return
+        page_size = int(params.get('page_size', ['10'])[0])
+        offset = int(self.headers.get('CMR-Search-After') or 0)
+        entries = [self.owner.entry(i) for i in range(offset, min(offset + page_size, self.owner.hits))]
+        headers = {'CMR-Hits': str(self.owner.hits)}
+        if offset + page_size < self.owner.hits:
+            headers['CMR-Search-After'] = str(offset + page_size)
+        self._send_json({'feed': {'entry': entries}}, headers)
+
+
+class MockCMR(_Server):
+    """
+    CMR search stand-in (granules, collections), replaying recorded granule entries. Entry i of the `hits`
+    granules is a copy of a recorded entry with a unique id, title and start time, and with its https data
+    links pointing to data_url.
+    """
+    handler = _CMRHandler
+
+    def __init__(self, hits: int = 1000, latency: float = 0., data_url: str = None, feed: list = None):
+        super().__init__(latency)
+        self.hits = hits
+        self.data_url = data_url
+        self.feed = load_feed() if feed is None else feed
+
+    def entry(self, i: int) -> dict:
+        entry = copy.deepcopy(self.feed[i % len(self.feed)])
+        title = entry['title']
+        new_title = re.sub(r'_(\d{5})_', f'_{24420 + i:05d}_', title, count=1)
+        time_start = datetime.datetime.strptime(entry['time_start'], _dt_format) + datetime.timedelta(hours=i)
+        entry['id'] = f'G{2530330419 + i}-LPCLOUD'
+        entry['title'] = entry['producer_granule_id'] = new_title
+        entry['time_start'] = time_start.strftime(_dt_format)
+        entry['time_end'] = (time_start + datetime.timedelta(seconds=52)).strftime(_dt_format)
+        for link in entry['links']:
+            link['href'] = link['href'].replace(title, new_title)
+            if self.data_url and link['href'].startswith('https://') and link['href'].endswith('.tif'):
+                link['href'] = f"{self.data_url}/{new_title}/{link['href'].split('/')[-1]}"
+        return entry
+
+
+class _RangeHandler(_Handler):
+    def _file(self):
+        # any granule path maps to the synthetic tile of its layer, e.g. /<granule>/<granule>_LST.tif -> LST.tif
+        name = self.path.split('/')[-1]
+        for layer in sorted(_layers, key=len, reverse=True):
+            if name.endswith(f'_{layer}.tif'):
+                return self.owner.tile_dir / f'{layer}.tif'
+        return None
+
+    def do_HEAD(self):
+        self._wait()
+        file_path = self._file()
+        if file_path is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(file_path.stat().st_size))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        self._wait()
+        file_path = self._file()
+        if file_path is None:
+            self.send_error(404)
+            return
+        size = file_path.stat().st_size
+        range_ = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        start, end = 0, size - 1
+        if range_:
+            start = int(range_.group(1))
+            end = min(int(range_.group(2)), size - 1) if range_.group(2) else size - 1
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        with self.owner._bytes_sent.get_lock():
+            self.owner._bytes_sent.value += len(body)
+        self.send_response(206 if range_ else 200)
+        if range_:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RangeServer(_Server):
+    # HTTP server with byte range support for the synthetic tiles in tile_dir
+    handler = _RangeHandler
+
+    def __init__(self, tile_dir: Path, latency: float = 0.):
+        super().__init__(latency)
+        self.tile_dir = Path(tile_dir)
+
+
+class _CredentialHandler(_Handler):
+    def do_GET(self):
+        self._wait()
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        if self.path.startswith('/s3credentials'):
+            self._send_json({'accessKeyId': 'BENCHACCESSKEY', 'secretAccessKey': 'bench-secret',
+                             'sessionToken': 'bench-session-token',
+                             'expiration': expiration.strftime('%Y-%m-%d %H:%M:%S+00:00')})
+        elif self.path.startswith('/api/users/tokens'):
+            self._send_json([{'access_token': 'bench-token', 'expiration_date': expiration.strftime('%m/%d/%Y')}])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self._wait()
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        expiration = datetime.datetime.now() + datetime.timedelta(days=60)
+        if self.path.startswith('/api/users/token'):
+            self._send_json({'access_token': 'bench-token', 'token_type': 'Bearer',
+                             'expiration_date': expiration.strftime('%m/%d/%Y')})
+        else:
+            self._send_json({})
+
+
+class CredentialServer(_Server):
+    # fake s3credentials and Earthdata token endpoints
+    handler = _CredentialHandler
+
+    def endpoints(self) -> dict:
+        return {
+            's3credentials': f'{self.url}/s3credentials',
+            'generate_token': f'{self.url}/api/users/token',
+            'list_token': f'{self.url}/api/users/tokens',
+            'revoke_token': f'{self.url}/api/users/revoke_token'
+        }
@@ -0,0 +1,42 @@
+#!/bin/python
+
+import sys
+import logging
+import pathlib
+import argparse
+
+import pyesat.logs
+import pyesat.tileserver
+
+
+def main():
+    if args.overviews:
+        for path in args.sources:
+            if pathlib.Path(path).is_dir():
+                factors = pyesat.tileserver.build_overviews(path)
+                print(f"{path}: overviews {factors}")
+    try:
+        server = pyesat.tileserver.TileServer(args.sources, cache_bytes=args.cache_mb * 1024 ** 2,
+                                              workers=args.workers)
+    except Exception as e:
+        print(f"Error opening the sources: {e}")
+        sys.exit(1)
+    print(f"Serving {', '.join(server.sources)} at http://{args.host}:{args.port}/ (ctrl-c to stop)")
+    server.run(host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve zarr cubes and GeoTIFFs as XYZ/WMTS map tiles.")
+    parser.add_argument("sources", nargs='+', help="zarr stores and GeoTIFF (COG) files")
+    parser.add_argument("-H", "--host", type=str, help="address to listen on", default='127.0.0.1')
+    parser.add_argument("-p", "--port", type=int, help="port", default=8080)
+    parser.add_argument("-c", "--cache-mb", type=int, help="size of the rendered tile cache (MB)", default=256)
+    parser.add_argument("-w", "--workers", type=int, help="number of tiles rendered at the same time", default=8)
+    parser.add_argument("-o", "--overviews", action="store_true", help="build the overviews of the zarr stores first")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+
+    args = parser.parse_args()
+    if args.verbose:
+        pyesat.logs.log_to_console(logging.DEBUG)
+
+    main()
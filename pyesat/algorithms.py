@@ -0,0 +1,395 @@
+import os
+import json
+import math
+import shutil
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Union, TYPE_CHECKING
+
+from . import metrics
+from . import tiles
+
+if TYPE_CHECKING:
+    import numpy as np
+    import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+# layers of the L2T LSTE product that carry surface temperature/emissivity values, by their name in
+# Granule.get_xarray (LST_err is err)
+_value_layers = ['LST', 'err', 'EmisWB']
+
+
+def mask_clouds(data_set: 'xr.Dataset', mask_water: bool = False) -> 'xr.Dataset':
+    """
+    Mask cloudy (and optionally water) pixels of the value layers of a granule data set.
+
+    Args:
+        data_set: data set from Granule.get_xarray, with a 'cloud' (and 'water') layer
+        mask_water: also mask pixels flagged in the 'water' layer
+
+    Returns: new xr.Dataset with masked pixels set to NaN, the data set passed is unchanged
+    """
+    if 'cloud' not in data_set:
+        return data_set
+    mask = data_set['cloud'] == 1
+    if mask_water and 'water' in data_set:
+        mask = mask | (data_set['water'] == 1)
+    return data_set.assign({layer: data_set[layer].where(~mask) for layer in _value_layers if layer in data_set})
+
+
+class SeasonalBins:
+    """
+    Seasonal bins of a climatology: day of year and hour of the overpass, in local solar time (the ISS overpass
+    time drifts through the day, LST follows the sun).
+
+    Attributes:
+    - doy_days (int): width of the day of year bins, in days
+    - hour_hours (int): width of the hour bins, in hours
+    """
+
+    def __init__(self, doy_days: int = 16, hour_hours: int = 3):
+        self.doy_days = int(doy_days)
+        self.hour_hours = int(hour_hours)
+        self.n_doy = math.ceil(366 / self.doy_days)
+        self.n_hour = math.ceil(24 / self.hour_hours)
+
+    def __repr__(self):
+        return f'SeasonalBins({self.doy_days} days, {self.hour_hours} hours)'
+
+    def __eq__(self, other):
+        return isinstance(other, SeasonalBins) and self.attrs() == other.attrs()
+
+    @property
+    def size(self) -> int:
+        return self.n_doy * self.n_hour
+
+    def attrs(self) -> Dict:
+        return {'doy_days': self.doy_days, 'hour_hours': self.hour_hours}
+
+    def index(self, time, lon: float = 0.) -> int:
+        # bin of a UTC time at a longitude
+        import pandas as pd
+        local = pd.Timestamp(time) + pd.Timedelta(hours=lon / 15.)
+        return (local.dayofyear - 1) // self.doy_days * self.n_hour + local.hour // self.hour_hours
+
+    def label(self, index: int) -> str:
+        doy, hour = divmod(index, self.n_hour)
+        return f'doy {doy * self.doy_days + 1:03d}-{min((doy + 1) * self.doy_days, 366):03d}, ' \
+               f'{hour * self.hour_hours:02d}-{min((hour + 1) * self.hour_hours, 24):02d}h'
+
+
+def _granule_time(data_set: 'xr.Dataset'):
+    import numpy as np
+    if 'time' not in data_set.coords:
+        raise ValueError(f'{data_set.attrs.get("id")} has no time coordinate')
+    return np.datetime64(data_set['time'].values.ravel()[0], 'ns')
+
+
+def _center_lon(data_set: 'xr.Dataset') -> float:
+    import pyproj
+    left, bottom, right, top = data_set.rio.bounds()
+    transformer = pyproj.Transformer.from_crs(data_set.rio.crs, 'EPSG:4326', always_xy=True)
+    return transformer.transform((left + right) / 2, (bottom + top) / 2)[0]
+
+
+def welford_update(count: 'np.ndarray', mean: 'np.ndarray', m2: 'np.ndarray',
+                   values: 'np.ndarray') -> Tuple['np.ndarray', 'np.ndarray', 'np.ndarray']:
+    """
+    Fold one observation per pixel into running statistics (Welford), pixels where values is NaN are unchanged.
+
+    Returns: count, mean and M2 (sum of squared deviations, the variance is M2 / (count - 1))
+    """
+    import numpy as np
+    valid = np.isfinite(values)
+    mean = np.where(count > 0, mean, 0.).astype('float32')
+    m2 = np.where(count > 0, m2, 0.).astype('float32')
+    new_count = count + valid
+    delta = np.where(valid, values - mean, 0.)
+    new_mean = mean + delta / np.maximum(new_count, 1)
+    new_m2 = m2 + delta * np.where(valid, values - new_mean, 0.)
+    return new_count.astype(count.dtype), new_mean.astype('float32'), new_m2.astype('float32')
+
+
+def anomalies(values: 'np.ndarray', count: 'np.ndarray', mean: 'np.ndarray', m2: 'np.ndarray',
+              min_count: int = 3) -> Tuple['np.ndarray', 'np.ndarray']:
+    # difference to the climatological mean and standardized anomaly, NaN where the climatology has fewer than
+    # min_count observations
+    import numpy as np
+    known = count >= max(min_count, 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        anomaly = np.where(known, values - mean, np.nan).astype('float32')
+        std = np.sqrt(np.where(known, m2, np.nan) / np.maximum(count - 1, 1))
+        zscore = np.where(std > 0, anomaly / std, np.nan).astype('float32')
+    return anomaly, zscore
+
+
+class ClimatologyStore:
+    """
+    Per pixel climatology of granule layers by seasonal bin, kept as running count, mean and M2 (Welford) in a zarr
+    store per grid (MGRS tile), and updated one granule at a time: a granule reads and writes the chunks of its bin
+    that it has data in, so a daily update costs the new granules, not the history.
+
+        store = ClimatologyStore('climatology', variables=['LST'])
+        for data_set in Stream(granules).map(open_granule(['LST', 'cloud'])):
+            anomaly = store.update(data_set)  # LST_anomaly and LST_zscore against the climatology so far
+
+    Granules are masked (mask_clouds) before they are folded in, and each granule is folded in once: the ids of
+    the folded granules are appended to a record next to the store (<store>.granules), of which only the new lines
+    are read by an update. The stores of different tiles can be updated in parallel, the granules of one tile must
+    be folded in by one writer at a time.
+
+    An update first saves the chunks it rewrites to a journal next to the store (<store>.journal), and removes the
+    journal once the granule is recorded. An update that was interrupted is rolled back from its journal by the
+    next update of the store, so the granule can be folded in again without being counted twice.
+
+    Attributes:
+    - path (Path): directory of the stores
+    - variables (List[str]): layers of the climatology
+    - bins (SeasonalBins): seasonal binning
+    - chunk_size (int): chunk size (pixels) of the stores
+    - min_count (int): number of observations below which no anomaly is given
+    """
+
+    def __init__(self, path: Union[str, Path], variables: List[str] = None, bins: SeasonalBins = None,
+                 chunk_size: int = 512, min_count: int = 3, mask: Callable = mask_clouds):
+        self.path = Path(path)
+        self.variables = variables or ['LST']
+        self.bins = bins or SeasonalBins()
+        self.chunk_size = chunk_size
+        self.min_count = min_count
+        self.mask = mask
+        self._recorded = {}
+
+    def __repr__(self):
+        return f'ClimatologyStore({self.path}, {self.variables}, {self.bins})'
+
+    def store_path(self, data_set: 'xr.Dataset') -> Path:
+        # store of the grid of a data set, named after the tile of the granule (the id is the CMR concept id, the tile
+        # is in the granule name)
+        transform = tuple(data_set.rio.transform())[:6]
+        key = f'{data_set.rio.crs.to_string()} {transform} {data_set.rio.width} {data_set.rio.height}'
+        name = data_set.attrs.get('title') or data_set.attrs.get('producer_granule_id') or ''
+        tile = tiles.tile_from_name(name) or 'grid'
+        return self.path / f'{tile}-{hashlib.sha1(key.encode()).hexdigest()[:8]}.zarr'
+
+    def stores(self) -> List[Path]:
+        return sorted(self.path.glob('*.zarr'))
+
+    def _create(self, data_set: 'xr.Dataset', store_path: Path) -> None:
+        # empty store, no chunk is written until it has data
+        import dask.array as da
+        import xarray as xr
+        import rioxarray  # registers the .rio accessor
+        from . import encoding
+        shape = (self.bins.size, data_set.sizes['y'], data_set.sizes['x'])
+        chunks = (1, self.chunk_size, self.chunk_size)
+        layers = {}
+        for variable in self.variables:
+            for name, dtype in [('count', 'uint32'), ('mean', 'float32'), ('m2', 'float32')]:
+                layers[f'{variable}_{name}'] = (('bin', 'y', 'x'), da.zeros(shape, chunks=chunks, dtype=dtype))
+        template = xr.Dataset(layers, coords={'bin': range(self.bins.size), 'y': data_set['y'].values,
+                                              'x': data_set['x'].values},
+                              attrs={**self.bins.attrs(), 'variables': self.variables})
+        template = template.rio.write_crs(data_set.rio.crs)
+        # the record of a store that was removed goes with it
+        self.granules_path(store_path).unlink(missing_ok=True)
+        self._recorded.pop(store_path, None)
+        encoding.to_zarr(template, store_path, compute=False)
+        logger.debug('Created %s', store_path)
+
+    def _open(self, data_set: 'xr.Dataset', create: bool):
+        import zarr
+        store_path = self.store_path(data_set)
+        if not store_path.exists():
+            if not create:
+                return None
+            self._create(data_set, store_path)
+        group = zarr.open_group(store_path.as_posix(), mode='a')
+        bins = SeasonalBins(group.attrs['doy_days'], group.attrs['hour_hours'])
+        if bins != self.bins or not set(self.variables) <= set(group.attrs['variables']):
+            raise ValueError(f'{store_path} holds {group.attrs["variables"]} in {bins}, not {self.variables} in '
+                             f'{self.bins}')
+        if create:
+            self.recover(store_path, group)
+        return group
+
+    @staticmethod
+    def journal_path(store_path: Union[str, Path]) -> Path:
+        return Path(store_path).with_suffix('.journal')
+
+    @staticmethod
+    def granules_path(store_path: Union[str, Path]) -> Path:
+        return Path(store_path).with_suffix('.granules')
+
+    def _folded(self, store_path: Union[str, Path], repair: bool = False) -> set:
+        # ids of the granules folded into a store, reading the lines appended to its record since the last call
+        store_path = Path(store_path)
+        record = self.granules_path(store_path)
+        folded, offset = self._recorded.get(store_path, (set(), 0))
+        if not record.exists() or record.stat().st_size < offset:
+            # a new record
+            folded, offset = set(), 0
+        if record.exists():
+            with open(record, 'rb') as f:
+                f.seek(offset)
+                new = f.read()
+            complete = new[:new.rfind(b'\n') + 1]
+            folded.update(complete.decode().splitlines())
+            offset += len(complete)
+            if repair and len(complete) < len(new):
+                # the last line of an interrupted append, the granule wasn't recorded
+                os.truncate(record, offset)
+        self._recorded[store_path] = folded, offset
+        return folded
+
+    def _record(self, store_path: Path, granule_id: str) -> None:
+        # append a granule to the record of a store, the granule is folded in once its line is on disk
+        with open(self.granules_path(store_path), 'ab') as f:
+            f.write(f'{granule_id}\n'.encode())
+            f.flush()
+            os.fsync(f.fileno())
+        self._folded(store_path)
+
+    @staticmethod
+    def _write_atomic(file_path: Path, write: Callable) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=file_path.parent.as_posix(), prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, file_path)
+
+    def recover(self, store_path: Union[str, Path], group=None) -> bool:
+        """
+        Roll back the update of a store that was interrupted, restoring the chunks saved in its journal.
+
+        Returns: whether there was an update to roll back
+        """
+        import zarr
+        import numpy as np
+        journal = self.journal_path(store_path)
+        marker = journal / 'update.json'
+        if not marker.exists():
+            shutil.rmtree(journal.as_posix(), ignore_errors=True)
+            return False
+        group = group if group is not None else zarr.open_group(Path(store_path).as_posix(), mode='a')
+        update = json.loads(marker.read_text())
+        if update['granule'] is not None and update['granule'] in self._folded(store_path, repair=True):
+            # interrupted after the granule was recorded, the update is complete
+            shutil.rmtree(journal.as_posix(), ignore_errors=True)
+            return False
+        for saved in journal.glob('*.npz'):
+            variable, row, col = saved.stem.rsplit('-', 2)
+            with np.load(saved.as_posix()) as arrays:
+                height, width = arrays['count'].shape
+                window = (update['bin'], slice(int(row), int(row) + height), slice(int(col), int(col) + width))
+                for name in ['count', 'mean', 'm2']:
+                    group[f'{variable}_{name}'][window] = arrays[name]
+        shutil.rmtree(journal.as_posix(), ignore_errors=True)
+        metrics.count('climatology.rollback')
+        logger.warning('Rolled back the interrupted update of %s with %s', store_path, update['granule'])
+        return True
+
+    def _fold(self, data_set: 'xr.Dataset', update: bool) -> 'xr.Dataset':
+        import numpy as np
+        import xarray as xr
+        granule_id = data_set.attrs.get('id')
+        index = self.bins.index(_granule_time(data_set), _center_lon(data_set))
+        if self.mask is not None:
+            data_set = self.mask(data_set)
+        group = self._open(data_set, create=update)
+        if update and granule_id is not None and granule_id in self._folded(self.store_path(data_set)):
+            logger.debug('%s is already in the climatology', granule_id)
+            update = False
+        if update:
+            journal = self.journal_path(self.store_path(data_set))
+            journal.mkdir(parents=True, exist_ok=True)
+            marker = json.dumps({'granule': granule_id, 'bin': index}).encode()
+            self._write_atomic(journal / 'update.json', lambda f: f.write(marker))
+        out = {}
+        for variable in self.variables:
+            # one granule at a time, read it in the calling thread
+            values = np.asarray(data_set[variable].squeeze(drop=True).load(scheduler='synchronous').values,
+                                dtype='float32')
+            anomaly = np.full(values.shape, np.nan, dtype='float32')
+            zscore = np.full(values.shape, np.nan, dtype='float32')
+            rows = range(0, values.shape[0], self.chunk_size) if group is not None else []
+            for row in rows:
+                for col in range(0, values.shape[1], self.chunk_size):
+                    window = (index, slice(row, row + self.chunk_size), slice(col, col + self.chunk_size))
+                    block = values[window[1:]]
+                    if not np.isfinite(block).any():
+                        continue
+                    count, mean, m2 = [group[f'{variable}_{name}'][window] for name in ['count', 'mean', 'm2']]
+                    anomaly[window[1:]], zscore[window[1:]] = anomalies(block, count, mean, m2, self.min_count)
+                    if update:
+                        # the chunk goes to the journal before it is rewritten
+                        self._write_atomic(journal / f'{variable}-{row}-{col}.npz',
+                                           lambda f: np.savez(f, count=count, mean=mean, m2=m2))
+                        for name, array in zip(['count', 'mean', 'm2'], welford_update(count, mean, m2, block)):
+                            group[f'{variable}_{name}'][window] = array
+                        metrics.add_bytes('climatology', 3 * block.nbytes)
+            dims = data_set[variable].squeeze(drop=True).dims
+            out[f'{variable}_anomaly'] = (dims, anomaly)
+            out[f'{variable}_zscore'] = (dims, zscore)
+        if update:
+            if granule_id is not None:
+                self._record(self.store_path(data_set), granule_id)
+            shutil.rmtree(journal.as_posix(), ignore_errors=True)
+            metrics.count('climatology.granules')
+        result = xr.Dataset(out, coords={'y': data_set['y'], 'x': data_set['x']},
+                            attrs={'id': granule_id, 'bin': index, 'bin_label': self.bins.label(index)})
+        return result.expand_dims(time=[_granule_time(data_set)]).rio.write_crs(data_set.rio.crs)
+
+    def update(self, data_set: 'xr.Dataset') -> 'xr.Dataset':
+        """
+        Fold a granule data set (e.g. from Granule.get_xarray, with a time coordinate) into the climatology of its
+        grid and bin.
+
+        Returns: xr.Dataset with <variable>_anomaly (difference to the climatological mean) and <variable>_zscore
+        (anomaly in standard deviations) against the climatology before the granule was folded in, NaN where
+        there were fewer than min_count observations
+        """
+        with metrics.timer('climatology.update'):
+            try:
+                return self._fold(data_set, update=True)
+            except Exception:
+                # leave the store as it was before the granule
+                store_path = self.store_path(data_set)
+                if store_path.exists():
+                    self.recover(store_path)
+                raise
+
+    def anomaly(self, data_set: 'xr.Dataset') -> 'xr.Dataset':
+        # anomalies of a data set without updating the climatology, NaN everywhere if its grid has none
+        with metrics.timer('climatology.anomaly'):
+            return self._fold(data_set, update=False)
+
+    def granules(self, store_path: Union[str, Path]) -> List[str]:
+        # ids of the granules folded into a store, in the order they were folded in
+        record = self.granules_path(store_path)
+        if not record.exists():
+            return []
+        text = record.read_text()
+        return text[:text.rfind('\n') + 1].splitlines()
+
+    def climatology(self, store_path: Union[str, Path], min_count: int = None) -> 'xr.Dataset':
+        """
+        Lazy climatology of a store: <variable>_count, <variable>_mean and <variable>_std by bin, the mean and std
+        are NaN where there are fewer than min_count observations.
+        """
+        import xarray as xr
+        import rioxarray  # registers the .rio accessor
+        min_count = self.min_count if min_count is None else min_count
+        stats = xr.open_zarr(Path(store_path).as_posix(), decode_coords='all', mask_and_scale=False)
+        out = xr.Dataset(attrs=stats.attrs)
+        for variable in stats.attrs['variables']:
+            count = stats[f'{variable}_count']
+            known = count >= max(min_count, 1)
+            out[f'{variable}_count'] = count
+            out[f'{variable}_mean'] = stats[f'{variable}_mean'].where(known)
+            out[f'{variable}_std'] = (stats[f'{variable}_m2'] / (count - 1).clip(min=1)).where(
+                known & (count > 1)) ** .5
+        out = out.assign_coords(bin_label=('bin', [self.bins.label(i) for i in range(self.bins.size)]))
+        return out.rio.write_crs(stats.rio.crs)
@@ -0,0 +1,317 @@
+import io
+import os
+import mmap
+import hashlib
+import time
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, Dict
+from urllib.parse import urlparse
+
+import requests
+
+from . import credentials
+from . import metrics
+
+# on-disk block cache shared by every process on the machine
+cache_dir = Path.home() / '.pyesat' / 'blocks'
+
+_block_size = 512 * 1024  # COG tiles and IFDs of the 70 m products fit in a few blocks
+_default_max_bytes = 20 * 1024 ** 3  # 20 GB
+# the blocks written by other processes are only seen by a sweep of the cache directory
+_sweep_interval = 300.
+
+
+class BlockCache:
+    """
+    Read-through cache of fixed size, aligned byte ranges of remote files.
+
+    Blocks are keyed by url and byte range and stored as individual files, written atomically so that any number
+    of processes (e.g. dask workers) can share the same cache directory. Blocks are read back through mmap.
+
+    The size of the cache is kept as a running total of the blocks written, so evict() only sweeps the directory
+    when the total goes over max_bytes, or every sweep_interval seconds to count the blocks of other processes.
+    """
+
+    def __init__(self, path: Path = cache_dir, block_size: int = _block_size, max_bytes: int = _default_max_bytes,
+                 sweep_interval: float = _sweep_interval):
+        self.path = Path(path)
+        self.block_size = int(block_size)
+        self.max_bytes = int(max_bytes)
+        self.sweep_interval = sweep_interval
+        # bytes in the cache at the last sweep plus the bytes written since, None before the first sweep
+        self._total = None
+        self._swept = 0.
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+
+    def __repr__(self):
+        return f'BlockCache({self.path}, block_size={self.block_size}, max_bytes={self.max_bytes})'
+
+    # block caches are shipped to worker processes with the opener, each process gets its own lock
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _key(self, url: str, start: int, end: int) -> str:
+        return hashlib.sha1(f'{url}:{start}-{end}'.encode()).hexdigest()
+
+    def _block_path(self, url: str, start: int, end: int) -> Path:
+        key = self._key(url, start, end)
+        return self.path / key[:2] / key
+
+    def _size_path(self, url: str) -> Path:
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return self.path / key[:2] / f'{key}.size'
+
+    def _write(self, file_path: Path, data: bytes) -> None:
+        # write to a temporary file and move it in place so readers never see partial blocks
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=file_path.parent.as_posix(), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            # evict doesn't see temporary files, don't leave one behind (e.g. on a full disk)
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        with self._lock:
+            if self._total is not None:
+                self._total += len(data)
+
+    def get_size(self, url: str, fetch_size: Callable[[], int]) -> int:
+        # total file size, cached next to the blocks of the file
+        size_path = self._size_path(url)
+        if size_path.exists():
+            return int(size_path.read_text())
+        size = int(fetch_size())
+        self._write(size_path, str(size).encode())
+        return size
+
+    def get_block(self, url: str, index: int, size: int, fetch: Callable[[int, int], bytes]) -> bytes:
+        """
+        Get one block of a remote file, fetching it on a miss.
+
+        Args:
+            url: url of the remote file
+            index: block number
+            size: total size of the file
+            fetch: function returning the bytes of the inclusive range (start, end) of the file
+
+        Returns: bytes of the block
+        """
+        start = index * self.block_size
+        end = min(start + self.block_size, size) - 1
+        block_path = self._block_path(url, start, end)
+        try:
+            with open(block_path.as_posix(), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    data = mm[:]
+            os.utime(block_path)
+            with self._lock:
+                self.hits += 1
+                self.bytes_saved += len(data)
+            metrics.count('blockcache.hit')
+            metrics.add_bytes('blockcache.saved', len(data))
+            return data
+        except FileNotFoundError:
+            pass
+        with metrics.timer('blockcache.fetch'):
+            data = fetch(start, end)
+        self._write(block_path, data)
+        metrics.count('blockcache.miss')
+        metrics.add_bytes('blockcache.fetched', len(data))
+        with self._lock:
+            self.misses += 1
+            self.bytes_fetched += len(data)
+        return data
+
+    def read(self, url: str, offset: int, length: int, size: int, fetch: Callable[[int, int], bytes]) -> bytes:
+        # read an arbitrary byte range through the aligned blocks that cover it
+        length = max(0, min(length, size - offset))
+        if length == 0:
+            return b''
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+        data = b''.join(self.get_block(url, i, size, fetch) for i in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + length]
+
+    def files(self):
+        return [f for f in self.path.glob('*/*') if not f.name.startswith('.')]
+
+    def evict(self, force: bool = False) -> int:
+        # remove least recently used blocks until the cache fits within max_bytes, returns the bytes removed
+        with self._lock:
+            if not force and self._total is not None and self._total <= self.max_bytes \
+                    and time.monotonic() - self._swept < self.sweep_interval:
+                return 0
+        with metrics.timer('blockcache.sweep'):
+            files = []
+            for file_path in self.files():
+                try:
+                    stat = file_path.stat()
+                except FileNotFoundError:
+                    continue  # removed by another process
+                files.append((stat.st_mtime, stat.st_size, file_path))
+            files.sort(key=lambda f: f[0])
+            total = sum(size for _, size, _ in files)
+            removed = 0
+            for _, size, file_path in files:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    file_path.unlink()
+                except FileNotFoundError:
+                    continue  # removed by another process
+                total -= size
+                removed += size
+        with self._lock:
+            self._total = total
+            self._swept = time.monotonic()
+        return removed
+
+    def stats(self) -> Dict:
+        requests_ = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests_ if requests_ else 0.,
+            'bytes_saved': self.bytes_saved,
+            'bytes_fetched': self.bytes_fetched
+        }
+
+
+class RangeFetcher:
+    # byte range requests against S3 (with DAAC temporary credentials) or HTTPS (with the Earthdata token)
+    def __init__(self, daac: str = 'lpdaac'):
+        self.daac = daac
+        self._s3 = None
+        self._http = None
+
+    # the clients hold connections, a fetcher shipped to another process creates its own
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state['_s3'] = None
+        state['_http'] = None
+        return state
+
+    def _s3_client(self):
+        if self._s3 is None:
+            import boto3
+            temp_creds_req = credentials.get_daac_credentials(self.daac)
+            self._s3 = boto3.client('s3',
+                                    aws_access_key_id=temp_creds_req['access_key'],
+                                    aws_secret_access_key=temp_creds_req['secret_key'],
+                                    aws_session_token=temp_creds_req['session_token'],
+                                    region_name='us-west-2')
+        return self._s3
+
+    def _http_session(self) -> requests.Session:
+        if self._http is None:
+            self._http = requests.Session()
+            self._http.headers['Authorization'] = f'Bearer {credentials.read_earthdata_token()}'
+        return self._http
+
+    def size(self, url: str) -> int:
+        parsed = urlparse(url)
+        if parsed.scheme == 's3':
+            head = self._s3_client().head_object(Bucket=parsed.netloc, Key=parsed.path.lstrip('/'))
+            return int(head['ContentLength'])
+        response = self._http_session().head(url, allow_redirects=True)
+        response.raise_for_status()
+        return int(response.headers['Content-Length'])
+
+    def fetch(self, url: str, start: int, end: int) -> bytes:
+        parsed = urlparse(url)
+        if parsed.scheme == 's3':
+            obj = self._s3_client().get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip('/'),
+                                               Range=f'bytes={start}-{end}')
+            return obj['Body'].read()
+        response = self._http_session().get(url, headers={'Range': f'bytes={start}-{end}'})
+        response.raise_for_status()
+        return response.content
+
+
+class CachedRangeFile(io.RawIOBase):
+    # read-only, seekable file object over a remote file, backed by the block cache
+    def __init__(self, url: str, block_cache: BlockCache, fetcher: RangeFetcher):
+        self.url = url
+        self.block_cache = block_cache
+        self.fetcher = fetcher
+        self._pos = 0
+        self._size = block_cache.get_size(url, lambda: fetcher.size(url))
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._size - self._pos
+        data = self.block_cache.read(self.url, self._pos, size, self._size,
+                                     lambda start, end: self.fetcher.fetch(self.url, start, end))
+        self._pos += len(data)
+        return data
+
+
+class BlockCacheOpener:
+    """
+    rasterio opener (rasterio.open(url, opener=...)) that routes remote reads through a BlockCache.
+
+    Can be passed through rioxarray.open_rasterio as an open keyword argument.
+    """
+
+    def __init__(self, block_cache: BlockCache = None, daac: str = 'lpdaac'):
+        self.block_cache = BlockCache() if block_cache is None else block_cache
+        self.fetcher = RangeFetcher(daac)
+
+    def __call__(self, url: str, mode: str = 'rb') -> CachedRangeFile:
+        # granule layers are self-contained COGs, don't go looking for GDAL sidecar files (.aux.xml, .msk, ...)
+        if not url.endswith('.tif'):
+            raise FileNotFoundError(url)
+        return CachedRangeFile(url, self.block_cache, self.fetcher)
+
+    def stats(self) -> Dict:
+        return self.block_cache.stats()
+
+
+_block_cache = None
+
+
+def get_block_cache() -> BlockCache:
+    # one block cache per process, all sharing the same directory
+    global _block_cache
+    if _block_cache is None:
+        _block_cache = BlockCache()
+    return _block_cache
@@ -0,0 +1,193 @@
+import os
+import json
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from . import credentials
+
+# local download cache, lives next to the catalog database
+cache_dir = Path.home() / '.pyesat' / 'cache'
+
+_default_max_bytes = 50 * 1024 ** 3  # 50 GB
+_pin_file = '.pinned.json'
+_config_section = 'cache'
+
+config_info_str = """Optional cache settings can be added to config.ini in the /pyesat directory:
+
+        [cache]
+          path = <local cache directory>
+          max_bytes = <size limit in bytes>
+          mirror_path = <shared (e.g. NFS) mirror directory>
+        """
+
+
+def file_name_from_url(url: str) -> str:
+    # granule files are identified by their file name across all tiers
+    return url.split('/')[-1]
+
+
+def write_atomic(out_file: Path, write: Callable[[str], object]) -> Path:
+    # write(path) to a temporary file next to out_file and move it in place, so an interrupted download or copy
+    # never leaves a partial file that would be taken for a cached one
+    out_file = Path(out_file)
+    fd, tmp_path = tempfile.mkstemp(dir=out_file.parent.as_posix(), prefix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, out_file)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+    return out_file
+
+
+class LocalCache:
+    """
+    Size bounded LRU cache of downloaded granule files, with an optional shared mirror.
+
+    Reads are resolved in tiers: the granule's recorded local path, this cache, the mirror, then the remote
+    url (S3 or HTTPS). Least recently used files are evicted when the cache grows beyond max_bytes, except for
+    pinned tiles (e.g. '18TWL') or file names.
+    """
+
+    def __init__(self, path: Path = cache_dir, max_bytes: int = _default_max_bytes, mirror_path: Path = None):
+        self.path = Path(path)
+        self.max_bytes = int(max_bytes)
+        self.mirror_path = Path(mirror_path) if mirror_path else None
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self):
+        return f'LocalCache({self.path}, max_bytes={self.max_bytes}, mirror_path={self.mirror_path})'
+
+    def path_for(self, url: str) -> Path:
+        return self.path / file_name_from_url(url)
+
+    def files(self) -> List[Path]:
+        return [f for f in self.path.iterdir() if f.is_file() and not f.name.startswith('.')]
+
+    def size(self) -> int:
+        return sum(f.stat().st_size for f in self.files())
+
+    def get(self, url: str) -> Optional[Path]:
+        # return the cached file and mark it as recently used
+        file_path = self.path_for(url)
+        if not file_path.exists():
+            return None
+        os.utime(file_path)
+        return file_path
+
+    def get_mirror(self, url: str) -> Optional[Path]:
+        if self.mirror_path is None:
+            return None
+        file_path = self.mirror_path / file_name_from_url(url)
+        if file_path.exists():
+            return file_path
+        return None
+
+    def resolve(self, url: str, local_path: str = None) -> str:
+        """
+        Resolve a remote url to the fastest available copy of the file.
+
+        Args:
+            url: remote S3 or HTTPS url of the file
+            local_path: directory the granule was downloaded to (Granule._local_path), if any
+
+        Returns: path of a local or mirrored copy, or the url itself if there is none
+        """
+        if local_path:
+            file_path = Path(local_path) / file_name_from_url(url)
+            if file_path.exists():
+                return file_path.as_posix()
+        file_path = self.get(url)
+        if file_path is not None:
+            return file_path.as_posix()
+        file_path = self.get_mirror(url)
+        if file_path is not None:
+            return file_path.as_posix()
+        return url
+
+    # pinned tiles are never evicted
+    def pinned(self) -> List[str]:
+        pin_path = self.path / _pin_file
+        if not pin_path.exists():
+            return []
+        with open(pin_path.as_posix(), 'r') as f:
+            return json.load(f)
+
+    def _write_pinned(self, pins: List[str]) -> None:
+        pin_path = self.path / _pin_file
+        tmp_path = pin_path.with_suffix('.tmp')
+        with open(tmp_path.as_posix(), 'w') as f:
+            json.dump(sorted(set(pins)), f)
+        os.replace(tmp_path, pin_path)
+
+    def pin(self, key: str) -> None:
+        # key is a tile id (e.g. '18TWL') or a file name
+        self._write_pinned(self.pinned() + [key])
+
+    def unpin(self, key: str) -> None:
+        self._write_pinned([p for p in self.pinned() if p != key])
+
+    def is_pinned(self, file_path: Path, pins: List[str] = None) -> bool:
+        pins = self.pinned() if pins is None else pins
+        name = Path(file_path).name
+        return any(name == p or f'_{p}_' in name for p in pins)
+
+    def evict(self, required_bytes: int = 0) -> List[Path]:
+        """
+        Remove least recently used, unpinned files until required_bytes fit within max_bytes.
+
+        Returns: list of removed files
+        """
+        pins = self.pinned()
+        files = sorted(self.files(), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        removed = []
+        for file_path in files:
+            if total + required_bytes <= self.max_bytes:
+                break
+            if self.is_pinned(file_path, pins):
+                continue
+            total -= file_path.stat().st_size
+            file_path.unlink()
+            removed.append(file_path)
+        return removed
+
+    def fetch_from_mirror(self, url: str, out_dir: Path) -> Optional[Path]:
+        # copy a mirrored file instead of downloading it
+        mirror_file = self.get_mirror(url)
+        if mirror_file is None:
+            return None
+        return write_atomic(Path(out_dir) / mirror_file.name, lambda tmp_path: shutil.copyfile(mirror_file, tmp_path))
+
+
+_local_cache = None
+
+
+def get_cache() -> LocalCache:
+    """
+    Get the local cache configured in the [cache] section of config.ini, or the default cache.
+    config.ini is read once per process, reset_cache() makes the next call read it again.
+    Returns: LocalCache
+
+    """
+    global _local_cache
+    if _local_cache is not None:
+        return _local_cache
+    config_parser = credentials.get_credentials()
+    if not config_parser.has_section(_config_section):
+        _local_cache = LocalCache()
+        return _local_cache
+    section = config_parser[_config_section]
+    _local_cache = LocalCache(path=Path(section.get('path', cache_dir.as_posix())),
+                              max_bytes=int(section.get('max_bytes', _default_max_bytes)),
+                              mirror_path=section.get('mirror_path', None))
+    return _local_cache
+
+
+def reset_cache() -> None:
+    # forget the cache of get_cache, e.g. after changing the [cache] settings
+    global _local_cache
+    _local_cache = None
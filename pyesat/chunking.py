@@ -0,0 +1,212 @@
+import math
+import shutil
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple, Union, TYPE_CHECKING
+
+from . import metrics
+from . import logs
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+_mb = 1024 ** 2
+
+
+class ChunkPolicy:
+    """
+    Chunk sizes aligned to the internal blocks of the COGs, so every dask chunk is read with whole block reads.
+
+    Chunks are the largest square multiple of the block shape that fits target_bytes. They are sized for itemsize
+    bytes per pixel whatever the dtype of a layer, so all the layers of a granule (float32 LST, uint16 QC, uint8
+    cloud) get the same chunks and line up in the data set.
+
+    Attributes:
+    - target_bytes (int): target chunk size
+    - itemsize (int): bytes per pixel used for the chunk size, 4 for the float32 LST layers
+    """
+
+    def __init__(self, target_bytes: int = 16 * _mb, itemsize: int = 4):
+        self.target_bytes = target_bytes
+        self.itemsize = itemsize
+
+    def __repr__(self):
+        return f'ChunkPolicy(target_bytes={self.target_bytes}, itemsize={self.itemsize})'
+
+    def spatial_chunks(self, block_shape: Tuple[int, int], shape: Tuple[int, int]) -> Tuple[int, int]:
+        # (y, x) chunk size of an image of shape with internal blocks of block_shape
+        block_bytes = block_shape[0] * block_shape[1] * self.itemsize
+        blocks = max(1, math.isqrt(max(1, self.target_bytes // block_bytes)))
+        return min(shape[0], block_shape[0] * blocks), min(shape[1], block_shape[1] * blocks)
+
+    def read_chunks(self, block_shape: Tuple[int, int], shape: Tuple[int, int]) -> Dict[str, int]:
+        # chunks argument of rioxarray.open_rasterio
+        y, x = self.spatial_chunks(block_shape, shape)
+        return {'band': 1, 'y': y, 'x': x}
+
+
+default_policy = ChunkPolicy()
+
+
+def open_layer(url: str, policy: ChunkPolicy = None, **open_kwargs) -> 'xr.DataArray':
+    """
+    Open one layer (COG) lazily with block aligned chunks. The file is opened once, the block shape comes from
+    its header (the preferred chunks rioxarray reads with it).
+    """
+    import rioxarray
+    policy = default_policy if policy is None else policy
+    # cache=False keeps the reads lazy, chunk by chunk
+    data_array = rioxarray.open_rasterio(url, cache=False, **open_kwargs)
+    preferred = data_array.encoding['preferred_chunks']
+    return data_array.chunk(policy.read_chunks((preferred['y'], preferred['x']),
+                                               (data_array.sizes['y'], data_array.sizes['x'])))
+
+
+def open_stack(sources: Union[str, Path, List[Union[str, Path]]], variables: List[str] = None) -> 'xr.Dataset':
+    """
+    Lazy time series of a zarr store, or of per-granule zarr stores (a list or a directory of them) on the same
+    grid, e.g. the stores of one tile written by the pipeline, sorted by time.
+    """
+    import xarray as xr
+    if not isinstance(sources, (list, tuple)):
+        path = Path(sources)
+        sources = [path] if (path / 'zarr.json').exists() or (path / '.zgroup').exists() \
+            else sorted(path.glob('*.zarr'))
+    data_sets = []
+    for source in sources:
+        data_set = xr.open_zarr(Path(source).as_posix(), decode_coords='all', mask_and_scale=False)
+        data_sets.append(data_set[variables] if variables else data_set)
+    # join='exact' refuses stores on different grids
+    stack = data_sets[0] if len(data_sets) == 1 else xr.concat(data_sets, dim='time', join='exact',
+                                                               combine_attrs='drop_conflicts')
+    return stack.sortby('time')
+
+
+def _slabs(shape: Tuple[int, int], chunks: Tuple[int, int], n_times: int, itemsize: int,
+           max_bytes: int) -> Iterator[Tuple[slice, slice]]:
+    # (y, x) windows, made of whole chunks, of which n_times time steps fit in max_bytes
+    chunk_bytes = n_times * chunks[0] * chunks[1] * itemsize
+    n_chunks = max(1, max_bytes // chunk_bytes)
+    x_chunks = min(n_chunks, math.ceil(shape[1] / chunks[1]))
+    y_chunks = max(1, n_chunks // x_chunks)
+    rows, cols = y_chunks * chunks[0], x_chunks * chunks[1]
+    for y in range(0, shape[0], rows):
+        for x in range(0, shape[1], cols):
+            yield slice(y, min(y + rows, shape[0])), slice(x, min(x + cols, shape[1]))
+
+
+def _source_chunks(stack: 'xr.Dataset', variables: List[str]) -> Tuple[int, int, int]:
+    # (time, y, x) size of the largest source chunks of the variables
+    return tuple(max(stack[v].chunksizes[dim][0] if stack[v].chunks else stack.sizes[dim] for v in variables)
+                 for dim in ['time', 'y', 'x'])
+
+
+def _staging_regions(shape: Tuple[int, int], n_times: int, source: Tuple[int, int, int], chunks: Tuple[int, int],
+                     itemsize: int, max_bytes: int) -> Iterator[Dict[str, slice]]:
+    # (time, y, x) regions on the source chunk grid, so each source chunk is read once. a region holds as many time
+    # steps of a source window as fit in max_bytes, windows of which one time chunk doesn't fit are split into
+    # whole target chunks
+    source_t, source_y, source_x = min(source[0], n_times), min(source[1], shape[0]), min(source[2], shape[1])
+    step_bytes = source_t * source_y * source_x * itemsize
+    times = source_t * max(1, max_bytes // step_bytes)
+    for t in range(0, n_times, times):
+        for y in range(0, shape[0], source_y):
+            for x in range(0, shape[1], source_x):
+                window = (min(source_y, shape[0] - y), min(source_x, shape[1] - x))
+                split = _slabs(window, chunks, source_t, itemsize, max_bytes) if step_bytes > max_bytes \
+                    else [(slice(0, window[0]), slice(0, window[1]))]
+                for ys, xs in split:
+                    yield {'time': slice(t, min(t + times, n_times)),
+                           'y': slice(y + ys.start, y + ys.stop), 'x': slice(x + xs.start, x + xs.stop)}
+
+
+def _clear_encoding(stack: 'xr.Dataset') -> 'xr.Dataset':
+    # drop the chunks of the source encoding, the stores are read undecoded so the fill value is written back as
+    # encoding
+    for variable in stack.variables.values():
+        variable.encoding.pop('chunks', None)
+        variable.encoding.pop('preferred_chunks', None)
+        if '_FillValue' in variable.attrs:
+            variable.encoding['_FillValue'] = variable.attrs.pop('_FillValue')
+    return stack
+
+
+def _copy_regions(stack: 'xr.Dataset', path: Path, regions: List[Dict[str, slice]], progress: logs.Progress) -> None:
+    # load each region and write it to the store initialized from the template
+    # scalar coordinates (spatial_ref, band) and the time coordinate are written once with the template
+    drop = [c for c in stack.coords if not set(stack[c].dims) & {'y', 'x'}]
+    for region in regions:
+        slab = stack.isel(region).drop_vars(drop)
+        # the regions are within the budget one at a time, load them in the calling thread
+        slab = slab.load(scheduler='synchronous')
+        slab.to_zarr(path.as_posix(), region=region, mode='r+', safe_chunks=False)
+        progress.update(nbytes=slab.nbytes)
+        metrics.add_bytes('rechunk', slab.nbytes)
+
+
+def rechunk(sources: Union[str, Path, List[Union[str, Path]]], target: Union[str, Path], variables: List[str] = None,
+            spatial_chunks: Tuple[int, int] = (64, 64), time_chunks: int = None, max_mem: int = 512 * _mb,
+            verbose: bool = False) -> str:
+    """
+    Rewrite granule-major zarr stores (one chunk per granule and window) as one pixel-major store (the whole time
+    series of small windows in each chunk), so that temporal reductions and point extraction read contiguous data.
+
+    The target is written in slabs of whole target chunks, each slab holding the full time series of a window and
+    sized so that it (and the copy made when it's assembled) stays within max_mem. Slabs are aligned to the source
+    chunks too, so each source chunk is read once. When the full time series of the smallest window aligned to both
+    doesn't fit the budget, the sources are first copied to a staging store (next to the target, removed at the end)
+    in regions of the source chunk grid, with the spatial chunks of the target, and the target is written from it.
+
+    Args:
+        sources: zarr store, per-granule zarr stores on the same grid, or a directory of them
+        target: path of the new store
+        variables: layers to rechunk, all layers with (time, y, x) dimensions if None
+        spatial_chunks: (y, x) chunk size of the target
+        time_chunks: time chunk size of the target, all time steps in one chunk if None
+        max_mem: memory budget in bytes
+
+    Returns: path of the new store
+    """
+    target = Path(target)
+    stack = open_stack(sources, variables)
+    variables = variables or [v for v in stack.data_vars if set(stack[v].dims) == {'time', 'y', 'x'}]
+    stack = stack[variables]
+    n_times = stack.sizes['time']
+    target_chunks = {'time': time_chunks or n_times, 'y': spatial_chunks[0], 'x': spatial_chunks[1]}
+    itemsize = max(stack[v].dtype.itemsize for v in variables) * len(variables)
+    shape = (stack.sizes['y'], stack.sizes['x'])
+    # half the budget for the slab, half for the pieces it is assembled from. the smallest slab is the full time
+    # series of one target chunk
+    chunk_bytes = n_times * min(spatial_chunks[0], shape[0]) * min(spatial_chunks[1], shape[1]) * itemsize
+    if chunk_bytes > max_mem // 2:
+        raise ValueError(f'the time series of a {spatial_chunks} chunk takes {chunk_bytes} bytes, more than half of '
+                         f'max_mem ({max_mem} bytes): use smaller spatial_chunks or a larger max_mem')
+    source = _source_chunks(stack, variables)
+    # the smallest window made of whole source and target chunks
+    aligned = (min(math.lcm(source[1], spatial_chunks[0]), shape[0]),
+               min(math.lcm(source[2], spatial_chunks[1]), shape[1]))
+    stack = _clear_encoding(stack)
+    stack.chunk(target_chunks).to_zarr(target.as_posix(), mode='w', compute=False)
+    level = logging.INFO if verbose else logging.DEBUG
+    if n_times * aligned[0] * aligned[1] * itemsize <= max_mem // 2:
+        slabs = [{'y': y, 'x': x} for y, x in _slabs(shape, aligned, n_times, itemsize, max_mem // 2)]
+        with logs.Progress('slabs', total=len(slabs), logger=logger, level=level) as progress, \
+                metrics.timer('rechunk'):
+            _copy_regions(stack, target, slabs, progress)
+        return target.as_posix()
+    staging = target.with_name(f'{target.stem}.staging.zarr')
+    regions = list(_staging_regions(shape, n_times, source, spatial_chunks, itemsize, max_mem // 2))
+    slabs = [{'y': y, 'x': x} for y, x in _slabs(shape, spatial_chunks, n_times, itemsize, max_mem // 2)]
+    try:
+        # the staging chunks hold the time steps of a region and line up with the target chunks
+        stack.chunk({'time': regions[0]['time'].stop, 'y': spatial_chunks[0], 'x': spatial_chunks[1]}).to_zarr(
+            staging.as_posix(), mode='w', compute=False)
+        with logs.Progress('slabs', total=len(regions) + len(slabs), logger=logger, level=level) as progress, \
+                metrics.timer('rechunk'):
+            _copy_regions(stack, staging, regions, progress)
+            _copy_regions(_clear_encoding(open_stack(staging, variables)), target, slabs, progress)
+    finally:
+        shutil.rmtree(staging.as_posix(), ignore_errors=True)
+    return target.as_posix()
@@ -1,6 +1,10 @@
 import os
 import sys
 import json
+import logging
+import tempfile
+import threading
+import contextlib
 import pytz
 from getpass import getpass
 from typing import Dict, Tuple
@@ -11,6 +15,15 @@ import datetime
 
 import requests
 
+from . import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows, refreshes are only serialized within the process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
 # all credential is stored in this file, keep secure, will be used by other scripts
 config_file = Path(__file__).parent / 'config.ini'  # same directory as the source
 
@@ -34,6 +47,13 @@ _s3_cred_endpoint = {
     'ghrcdaac': 'https://data.ghrc.earthdata.nasa.gov/s3credentials'
 }
 
+# credentials shipped to worker processes, used before the configuration file
+_worker_credentials = {}
+
+# the configuration file is shared by every process of the user, refreshes hold an exclusive lock on a file next to it
+_lock = threading.RLock()
+_lock_depth = 0
+
 config_info_str = """Please write a file config.ini in the /pyesat directory with the format:
 
         [urs.earthdata.nasa.gov]
@@ -92,55 +112,112 @@ def get_temp_credentials(provider) -> Dict:
     """Generate temporary NASA Earthdata credentials for a given provider
        Requires netrc file to be configured with NASA Earthdata username and password
     """
-    return requests.get(_s3_cred_endpoint[provider]).json()
+    with metrics.timer('credentials.s3'):
+        return requests.get(_s3_cred_endpoint[provider]).json()
+
+
+@contextlib.contextmanager
+def config_lock():
+    """
+    Exclusive lock of the configuration file across threads and processes, reentrant within a process.
+
+    Credentials are refreshed under the lock after checking the file again, so when many workers find expired
+    credentials at the same time one of them refreshes and the others read the new credentials from the file.
+    """
+    global _lock_depth
+    with _lock:
+        if _lock_depth or fcntl is None:
+            _lock_depth += 1
+            try:
+                yield
+            finally:
+                _lock_depth -= 1
+            return
+        lock_path = config_file.with_name(f'{config_file.name}.lock')
+        with open(lock_path.as_posix(), 'a') as lock_file:
+            with metrics.timer('credentials.lock'):
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            _lock_depth += 1
+            try:
+                yield
+            finally:
+                _lock_depth -= 1
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
 
 def write_config(config_state) -> bool:
-    # write the config file to disk and set permissions
-    with open(config_file.as_posix(), 'w') as f:
-        config_state.write(f)
-    os.chmod(config_file.as_posix(), 0o640)
+    # write the config file atomically (readers see the old or the new file, never a partial one) with permissions
+    fd, tmp_path = tempfile.mkstemp(dir=config_file.parent.as_posix(), prefix=f'.{config_file.name}.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            config_state.write(f)
+        os.chmod(tmp_path, 0o640)
+        os.replace(tmp_path, config_file.as_posix())
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
     return True
 
 
+def update_config(section: str, values: Dict[str, str], config_state=None) -> bool:
+    # set the values of a section in the file as it is now (not as config_state was read), so concurrent updates of
+    # other sections are kept; config_state is updated as well
+    with config_lock():
+        current = get_credentials()
+        for config_parser in [current] + ([config_state] if config_state is not None else []):
+            if not config_parser.has_section(section):
+                config_parser.add_section(section)
+            for key, value in values.items():
+                config_parser[section][key] = value
+        return write_config(current)
+
+
 def get_earthdata_token() -> Dict:
     # get token for earthdata access
+    with metrics.timer('credentials.token'):
+        return _get_earthdata_token()
+
+
+def _get_earthdata_token() -> Dict:
+    # the valid token that expires last, expired tokens are only revoked when a new token has to be generated
     auth = get_earthdata_login()
     req_ = requests.get(_edl_token_urls['list_token'], auth=auth)
     if req_.status_code == 401:
         error_ = json.loads(req_.text)
         raise Exception(f"{error_['error']}:{error_['error_description']}")
-    tokens_ = req_.json()
-    if tokens_:
-        dates_ = [datetime.datetime.strptime(t['expiration_date'], "%m/%d/%Y") for t in tokens_]
-        for (d_, t_) in sorted(zip(dates_, tokens_)):
-            if d_ > datetime.datetime.now():
-                token = t_
-            else:
-                revoke_token = requests.post(f"{_edl_token_urls['revoke_token']}?", data={'token': t_}, auth=auth)
-                if revoke_token.status_code == 401:
-                    error_ = json.loads(revoke_token.text)
-                    raise Exception(f"{error_['error']}:{error_['error_description']}")
-    else:
-        generate_token_req = requests.post(_edl_token_urls['generate_token'], auth=auth)
-        token = generate_token_req.json()
-    # check expired
-    return dict(token)
+    tokens_ = req_.json() or []
+    dates_ = [datetime.datetime.strptime(t['expiration_date'], "%m/%d/%Y") for t in tokens_]
+    valid_ = [(d_, t_) for d_, t_ in zip(dates_, tokens_) if d_ > datetime.datetime.now()]
+    if valid_:
+        return dict(max(valid_, key=lambda v: v[0])[1])
+    for t_ in tokens_:
+        revoke_token = requests.post(f"{_edl_token_urls['revoke_token']}?", data={'token': t_['access_token']},
+                                     auth=auth)
+        if revoke_token.status_code == 401:
+            error_ = json.loads(revoke_token.text)
+            raise Exception(f"{error_['error']}:{error_['error_description']}")
+    generate_token_req = requests.post(_edl_token_urls['generate_token'], auth=auth)
+    return dict(generate_token_req.json())
 
 
 def update_earthdata_token(config_state):
     # update the token
+    metrics.count('credentials.token.refresh')
     token = get_earthdata_token()
-    config_state['urs.earthdata.nasa.gov']['access_token'] = token['access_token']
-    config_state['urs.earthdata.nasa.gov']['expiration_date'] = token['expiration_date']
-    write_config(config_state)
-    print(f"Config file written to {os.path.abspath(config_file.as_posix())}")
+    update_config(_remote_hostname, {'access_token': token['access_token'],
+                                     'expiration_date': token['expiration_date']}, config_state)
+    logger.info('Config file written to %s', os.path.abspath(config_file.as_posix()))
     return True
 
 
 def write_earthdata_credentials() -> bool:
     # write configuration file from prompt user/password
     # get username and password from netrc file
+    with config_lock():
+        return _write_earthdata_credentials()
+
+
+def _write_earthdata_credentials() -> bool:
     config_parser = get_credentials()
     if not config_parser.has_section(_remote_hostname):
         config_parser.add_section(_remote_hostname)
@@ -149,7 +226,7 @@ def write_earthdata_credentials() -> bool:
         try:
             assert check_earthdata_credentials()
         except:
-            print('Credentials are not valid, will update from prompt ....')
+            logger.warning('Credentials are not valid, will update from prompt ....')
             assert update_earthdata_token(config_parser)
     return True
 
@@ -169,8 +246,7 @@ def get_credentials() -> configparser.ConfigParser:
         try:
             config_parser.read(config_file.as_posix())
         except:
-            print('Configuration file is not in the correct format')
-            print(config_info_str)
+            logger.error('Configuration file is not in the correct format\n%s', config_info_str)
             sys.exit(1)
     return config_parser
 
@@ -185,32 +261,43 @@ def update_daac_credentials(daac, config_parser) -> bool:
     Returns: True if successful
 
     """
+    metrics.count('credentials.refresh')
     temp_credentials = get_temp_credentials(daac)
-    config_parser[daac]['access_key'] = temp_credentials['accessKeyId']
-    config_parser[daac]['secret_key'] = temp_credentials['secretAccessKey']
-    config_parser[daac]['session_token'] = temp_credentials['sessionToken']
-    config_parser[daac]['expiration_date'] = temp_credentials['expiration']
-    write_config(config_parser)
-    print(f"{daac} credentials written to {config_file.as_posix()}")
+    update_config(daac, {'access_key': temp_credentials['accessKeyId'],
+                         'secret_key': temp_credentials['secretAccessKey'],
+                         'session_token': temp_credentials['sessionToken'],
+                         'expiration_date': temp_credentials['expiration']}, config_parser)
+    logger.info('%s credentials written to %s', daac, config_file.as_posix())
     return True
 
 
 def get_daac_credentials(daac) -> Dict:
     # get daac credentials from config file for reading data
+    if daac in _worker_credentials:
+        expiration_date = datetime.datetime.strptime(_worker_credentials[daac]['expiration_date'], "%Y-%m-%d %H:%M:%S%z")
+        if expiration_date > datetime.datetime.now(_tz):
+            metrics.count('credentials.shipped.hit')
+            return dict(_worker_credentials[daac])
+        metrics.count('credentials.shipped.miss')
     config_parser = get_credentials()
-    if not config_parser.has_section(daac):
-        config_parser.add_section(daac)
-        update_daac_credentials(daac, config_parser)
-    else:
-        # check expiration date
-        expiration_date_str = config_parser.get(daac, 'expiration_date')
-        # write datetime parser for '2023-01-11 19:13:22+00:00' format
-        expiration_date = datetime.datetime.strptime(expiration_date_str, "%Y-%m-%d %H:%M:%S%z")
-        if expiration_date < datetime.datetime.now(_tz):
+    if _daac_credentials_valid(config_parser, daac):
+        return dict(config_parser[daac])
+    # check again under the lock, another process may have refreshed them meanwhile
+    with config_lock():
+        config_parser = get_credentials()
+        if not _daac_credentials_valid(config_parser, daac):
             update_daac_credentials(daac, config_parser)
     return dict(config_parser[daac])
 
 
+def _daac_credentials_valid(config_parser, daac) -> bool:
+    if not config_parser.has_option(daac, 'expiration_date'):
+        return False
+    # write datetime parser for '2023-01-11 19:13:22+00:00' format
+    expiration_date = datetime.datetime.strptime(config_parser.get(daac, 'expiration_date'), "%Y-%m-%d %H:%M:%S%z")
+    return expiration_date > datetime.datetime.now(_tz)
+
+
 def check_earthdata_credentials() -> bool:
     # check if the credentials are valid
     check_ = True
@@ -220,7 +307,7 @@ def check_earthdata_credentials() -> bool:
         assert config_parser.has_option(_remote_hostname, 'access_token')
         assert config_parser.has_option(_remote_hostname, 'expiration_date')
     except:
-        check_ = False
+        return False
     # check if the token is still valid
     expiration_date_str = config_parser.get(_remote_hostname, 'expiration_date')
     expiration_date = datetime.datetime.strptime(expiration_date_str, "%m/%d/%Y")
@@ -239,9 +326,34 @@ def read_earthdata_token() -> str:
     Returns:
         str: Access token for the earthdata service
     """
-    try:
-        assert check_earthdata_credentials()
-    except:
-        print('Missing Credentials .. will need to update')
-        write_earthdata_credentials()
-    return str(get_credentials()[_remote_hostname]['access_token'])
\ No newline at end of file
+    if _remote_hostname in _worker_credentials:
+        return _worker_credentials[_remote_hostname]
+    # the token cached in the configuration file is used without any request until it expires
+    if not check_earthdata_credentials():
+        with config_lock():
+            # check again under the lock, another process may have refreshed the token meanwhile
+            if not check_earthdata_credentials():
+                logger.warning('Missing Credentials .. will need to update')
+                write_earthdata_credentials()
+    return str(get_credentials()[_remote_hostname]['access_token'])
+
+
+def get_worker_credentials(daacs=('lpdaac',)) -> Dict:
+    """
+    Collect the Earthdata token and DAAC temporary credentials to ship to worker processes,
+    which may not have access to the configuration file.
+
+    Args:
+        daacs: daac names (e.g. lpdaac)
+
+    Returns: Dict of credentials, see set_worker_credentials
+    """
+    shipped = {daac: get_daac_credentials(daac) for daac in daacs}
+    shipped[_remote_hostname] = read_earthdata_token()
+    return shipped
+
+
+def set_worker_credentials(shipped: Dict) -> bool:
+    # install credentials from get_worker_credentials in this process
+    _worker_credentials.update(shipped)
+    return True
@@ -2,55 +2,78 @@ import os
 import pathlib
 import sys
 import json
-import concurrent.futures
-import dask
+import time
+import logging
+import contextlib
 import sqlalchemy
 import sqlalchemy.orm
 from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, ForeignKey, Table, MetaData, create_engine
 from sqlalchemy.ext.declarative import declarative_base
 
-import dask.array as da
-from dask.diagnostics import ProgressBar
-
-from tqdm import tqdm
-import boto3
-from typing import List, Dict
+from typing import List, Dict, Optional, TYPE_CHECKING
 from pathlib import Path
-import urllib
-import rioxarray
-from rasterio.session import AWSSession
+import urllib.request
 from datetime import datetime
 import requests
-import xarray as xr
-import rasterio as rio
-from requests import Session
+
+# the raster stack (dask, boto3, rasterio, rioxarray, xarray) is imported on first use, so that catalog queries,
+# searches and credential checks don't pay for it
+if TYPE_CHECKING:
+    import rasterio as rio
+    import xarray as xr
 
 from . import credentials
+from . import cache
+from . import blockcache
+from . import metrics
+from . import logs
+from . import chunking
+from . import encoding
 # Generate a NASA Earthdata Login Token
 
+logger = logging.getLogger(__name__)
+
 # write a sqlalchemy engine for ORM access to the database
 _engine_type = 'sqlite'
 db_path = Path.home() / '.pyesat' / 'pyesat.db'
 metadata = MetaData()
 base = declarative_base(metadata=metadata)
+# engines by database and process, and whether their catalog has the granule table
+_engines = {}
+_granule_tables = {}
+# stay below the sqlite limit of bound parameters
+_max_ids = 500
+
 # get the sqlalchemy engine
 def get_engine(db_path: pathlib.Path) -> sqlalchemy.engine:
-    # get the sqlalchemy engine
+    # get the sqlalchemy engine, one per database and process (connections aren't shared with forked processes)
+    key = (Path(db_path).as_posix(), os.getpid())
+    if key in _engines:
+        return _engines[key]
     if not db_path.exists():
         db_path.parent.mkdir(parents=True, exist_ok=True)
         db_path.touch()
         db_path.chmod(0o600)
     # convert PosixPath to string in the form of 'sqlite:///path/to/file.db'
-    db_path = f'{_engine_type}:///' + str(db_path)
-    engine = sqlalchemy.create_engine(db_path, echo=False, future=True)
+    url = f'{_engine_type}:///' + str(db_path)
+    engine = sqlalchemy.create_engine(url, echo=False, future=True)
+    _engines[key] = engine
     return engine
 
+def has_granule_table(engine: sqlalchemy.engine.Engine) -> bool:
+    # whether the catalog was initialized (pyesat_db.py --init), inspected once per database and process
+    key = (str(engine.url), os.getpid())
+    if key not in _granule_tables:
+        _granule_tables[key] = sqlalchemy.inspect(engine).has_table(Granule.__tablename__)
+    return _granule_tables[key]
+
 # create sqlalchemy ORM classes for the database tables
 def create_orm_classes(db_path: pathlib.Path=db_path, metadata: sqlalchemy.MetaData=metadata) -> None:
     # get the sqlalchemy engine
     engine = get_engine(db_path)
     # create the tables
     metadata.create_all(engine)
+    _granule_tables.clear()
     # create the ORM classes
     sqlalchemy.orm.configure_mappers()
 
@@ -125,6 +148,9 @@ class Collection(base):
 
 
 def set_rio_environment(daac: str='lpdaac') -> bool:
+    import boto3
+    import rasterio as rio
+    from rasterio.session import AWSSession
     temp_creds_req = credentials.get_daac_credentials(daac)
     session = boto3.Session(aws_access_key_id=temp_creds_req['access_key'],
                             aws_secret_access_key=temp_creds_req['secret_key'],
@@ -149,11 +175,13 @@ class DaacReadSession:
         self.expiration_date = datetime.strptime(exp_date, "%Y-%m-%d %H:%M:%S%z")
 
     def __enter__(self):
-        if not self.is_expired():
-            self.session = self._get_session()
-        else:
-            self.temp_creds_req = credentials.get_daac_credentials(self.daac)
-            self.session = self._get_session()
+        with metrics.timer('daac.session'):
+            if not self.is_expired():
+                self.session = self._get_session()
+            else:
+                metrics.count('daac.session.refresh')
+                self.temp_creds_req = credentials.get_daac_credentials(self.daac)
+                self.session = self._get_session()
         return self.session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -162,7 +190,10 @@ class DaacReadSession:
     def is_expired(self) -> bool:
         return self.expiration_date < datetime.now(credentials._tz)
 
-    def _get_session(self) -> Session:
+    def _get_session(self) -> 'rio.Env':
+        import boto3
+        import rasterio as rio
+        from rasterio.session import AWSSession
         session = boto3.Session(aws_access_key_id=self.temp_creds_req['access_key'],
                                 aws_secret_access_key=self.temp_creds_req['secret_key'],
                                 aws_session_token=self.temp_creds_req['session_token'],
@@ -185,8 +216,8 @@ class CMRClient:
     - base_url (str): The base URL for the CMR API.
     """
 
-    def __init__(self, provider='LPCLOUD', project='ECOSTRESS'):
-        self.base_url = 'https://cmr.earthdata.nasa.gov'
+    def __init__(self, provider='LPCLOUD', project='ECOSTRESS', base_url='https://cmr.earthdata.nasa.gov'):
+        self.base_url = base_url
         self.search_url = f"{self.base_url}/search"
         self.access_token = credentials.read_earthdata_token()
         self.provider = provider
@@ -196,31 +227,34 @@ class CMRClient:
             'Accept': 'application/json'
         }
 
-    def get_collections(self, verbose=True):
+    def get_collections(self, verbose=False):
         url = f'{self.base_url}/{"collections"}'
-        response = requests.get(url,
-                                params={
-                                    'cloud_hosted': 'True',
-                                    'has_granules': 'True',
-                                    'provider': self.provider,
-                                    'project': self.project,
-                                    'page_size': 100
-                                },
-                                headers=self.headers
-                                )
+        with metrics.timer('cmr.collections'):
+            response = requests.get(url,
+                                    params={
+                                        'cloud_hosted': 'True',
+                                        'has_granules': 'True',
+                                        'provider': self.provider,
+                                        'project': self.project,
+                                        'page_size': 100
+                                    },
+                                    headers=self.headers
+                                    )
+        metrics.add_bytes('cmr', len(response.content))
         try:
             assert response.status_code == 200
         except:
             error_ = json.loads(response.text)
             raise Exception(f"{error_['error']}:{error_['error_description']}")
 
-        print(f"CRM-HITS: {response.headers['cmr-hits']}")
+        level = logging.INFO if verbose else logging.DEBUG
+        logger.log(level, 'CMR-HITS: %s', response.headers['cmr-hits'])
         content = response.json()
         collections = content['feed']['entry']
         for collection in collections:
-            print(f'{collection["archive_center"]} | {collection["dataset_id"]} | {collection["id"]}')
+            logger.log(level, '%s | %s | %s', collection['archive_center'], collection['dataset_id'], collection['id'])
 
-    def search_granules(self, bbox, date_range, collection_id='C2076090826-LPCLOUD', verbose=True):
+    def search_granules(self, bbox, date_range, collection_id='C2076090826-LPCLOUD', verbose=False):
         """
         Search the CMR for granules.
 
@@ -248,15 +282,18 @@ class CMRClient:
             'bounding_box': bbox,
             'page_size': 2000
         }
-        response = requests.get(url, params=params, headers=self.headers)
+        with metrics.timer('cmr.search'):
+            response = requests.get(url, params=params, headers=self.headers)
+        metrics.add_bytes('cmr', len(response.content))
         try:
             assert response.status_code == 200
         except:
             error_ = json.loads(response.text)
             raise Exception(f"{error_['error']}:{error_['error_description']}")
 
-        if verbose:
-            print(f"{self.project}|{self.provider}|{collection_id} granules: {response.headers['CMR-Hits']}")
+        level = logging.INFO if verbose else logging.DEBUG
+        logger.log(level, '%s|%s|%s granules: %s', self.project, self.provider, collection_id,
+                   response.headers['CMR-Hits'])
 
         response.raise_for_status()
 
@@ -264,17 +301,65 @@ class CMRClient:
 
         granules_ = []
         for granule in granules:
-            if verbose:
-                print(f'{granule["data_center"]} | {granule["dataset_id"]} | {granule["id"]}')
             #https_urls = [l['href'] for l in granule['links'] if 'https' in l['href'] and '.tif' in l['href']]
             #s3_urls = [l['href'] for l in granule['links'] if 's3' in l['href'] and '.tif' in l['href']]
             #granule['s3'] = s3_urls
             #granule['https'] = https_urls
 
-            granules_.append(Granule(granule))
+            granules_.append(Granule(granule, verbose=verbose))
 
         return granules_
 
+    def iter_granules(self, bbox, date_range, collection_id='C2076090826-LPCLOUD', page_size=500, verbose=False,
+                      granule_name=None):
+        """
+        Iterate over all granules matching the search, one page at a time.
+
+        Unlike search_granules this follows the CMR-Search-After header to fetch every page, and only requests
+        the next page once the granules of the current one have been consumed.
+
+        Parameters:
+        - bbox (str): 'min_lon,min_lat,max_lon,max_lat'
+        - date_range (str): 'start,end' in ISO format
+        - page_size (int): number of granules per request (max 2000)
+        - granule_name (str): granule name pattern with * and ? wildcards, e.g. '*_18TWL_*' for one MGRS tile
+
+        Yields:
+        - Granule
+        """
+        url = f'{self.search_url}/granules.json'
+        params = {
+            'concept_id': collection_id,
+            'temporal': date_range,
+            'bounding_box': bbox,
+            'page_size': page_size
+        }
+        if granule_name is not None:
+            params['readable_granule_name'] = granule_name
+            params['options[readable_granule_name][pattern]'] = 'true'
+        headers = dict(self.headers)
+        level = logging.INFO if verbose else logging.DEBUG
+        progress = logs.Progress('granules', level=level)
+        while True:
+            with metrics.timer('cmr.page'):
+                response = requests.get(url, params=params, headers=headers)
+            metrics.add_bytes('cmr', len(response.content))
+            if response.status_code != 200:
+                error_ = json.loads(response.text)
+                raise Exception(f"{error_['error']}:{error_['error_description']}")
+            granules = response.json()['feed']['entry']
+            progress.total = int(response.headers['CMR-Hits'])
+            logger.debug('%s|%s|%s page: %d of %s granules', self.project, self.provider, collection_id,
+                         len(granules), response.headers['CMR-Hits'])
+            for granule in granules:
+                progress.update()
+                yield Granule(granule, verbose=verbose)
+            search_after = response.headers.get('CMR-Search-After')
+            if not granules or len(granules) < page_size or search_after is None:
+                break
+            headers['CMR-Search-After'] = search_after
+        progress.close()
+
 
 class Granule(base):
     __tablename__ = 'granules'
@@ -307,7 +392,7 @@ class Granule(base):
     _collection_id = Column(Integer, ForeignKey('collection.id'))
     _dt_parser = '%Y-%m-%dT%H:%M:%S.%fZ'
 
-    def __init__(self, granule, keep_xarray=False, verbose=True):
+    def __init__(self, granule, keep_xarray=False, verbose=False):
         """
         Initialize the Granule object. This is a wrapper around the json object returned by the CMR. It contains the
         functions to download the granule and extract the data to a xarray object and write to zarr.
@@ -343,8 +428,21 @@ class Granule(base):
         self.https = self.links.get_https()
         self.keep_xarray = keep_xarray
         self.xarray = None
+        # catalog columns
+        self._id = self.id
+        self._data_center = self.data_center
+        self._dataset_id = self.dataset_id
+        self._title = self.title
+        self._collection_concept_id = self.collection_concept_id
+        self._start_date = self.time_start
+        self._end_date = self.time_end
+        self._links = json.dumps(granule['links'])
+        self._s3 = json.dumps(self.s3)
+        self._https = json.dumps(self.https)
+        self._bbox = json.dumps(self.bounds)
+        self._granule_size = float(self.granule_size)
         if verbose:
-            print(f'Granule: {self.id}: {self.dataset_id}: {self.time_start} - {self.time_end}')
+            logger.info('Granule: %s: %s: %s - %s', self.id, self.dataset_id, self.time_start, self.time_end)
 
     def __repr__(self):
         return f'{self.data_center} | {self.dataset_id} | {self.id}'
@@ -361,43 +459,128 @@ class Granule(base):
     def get_json(self):
         return self.json
 
-    def download(self, out_dir):
-        # Download the file to the specified directory from self.s3 list using pathlib library
-        for url in self.s3:
-            file_name = url.split('/')[-1]
-            out_file = Path(out_dir) / file_name
-            if not out_file.exists():
-                print(f'Downloading {file_name} to {out_dir}')
-                urllib.request.urlretrieve(url, out_file)
-            else:
-                print(f"{file_name} already exists in {out_dir}")
+    def download(self, out_dir=None):
+        # Download the file to the specified directory (default: the local cache) from self.s3 list
+        # files found in the shared mirror are copied instead of downloaded
+        local_cache = cache.get_cache()
+        if out_dir is None:
+            out_dir = local_cache.path
+            local_cache.evict(required_bytes=int(float(self.granule_size or 0) * 1024 ** 2))
+        with metrics.timer('granule.download'):
+            for url in self.s3:
+                file_name = cache.file_name_from_url(url)
+                out_file = Path(out_dir) / file_name
+                if not out_file.exists():
+                    metrics.count('download_cache.miss')
+                    if local_cache.fetch_from_mirror(url, out_dir) is not None:
+                        metrics.add_bytes('download.mirror', out_file.stat().st_size)
+                        logger.debug('Copied %s from mirror to %s', file_name, out_dir)
+                        continue
+                    logger.debug('Downloading %s to %s', file_name, out_dir)
+                    cache.write_atomic(out_file, lambda tmp_path: urllib.request.urlretrieve(url, tmp_path))
+                    metrics.add_bytes('download', out_file.stat().st_size)
+                else:
+                    metrics.count('download_cache.hit')
+                    logger.debug('%s already exists in %s', file_name, out_dir)
+        # record the download in the catalog so reads resolve locally
+        self._local_path = Path(out_dir).as_posix()
+        self._is_downloaded = True
+        self.update_catalog()
+
+    def update_catalog(self, session: sqlalchemy.orm.session.Session = None) -> bool:
+        """
+        Write the catalog columns of the granule (download status, time to first byte) to the catalog.
+
+        Granules are only recorded in an initialized catalog (pyesat_db.py --init), a failed write is logged and
+        doesn't fail the read or download it follows.
+
+        Args:
+            session: catalog session, a session of the catalog at db_path if None
 
-    def get_xarray(self, data_sets=None, aws=True, verbose=True) -> xr.Dataset:
+        Returns: True if the granule was committed
+        """
+        if session is None:
+            if not db_path.exists():
+                return False
+            with SessionContextManager(db_path=db_path) as session:
+                return self.update_catalog(session)
+        try:
+            if not has_granule_table(session.get_bind()):
+                return False
+            session.merge(self)
+            session.commit()
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            session.rollback()
+            logger.warning('Could not update %s in the catalog: %s', self.id, e)
+            return False
+        return True
+
+    def read_catalog(self, session: sqlalchemy.orm.session.Session = None) -> bool:
+        # download status of the granule from the catalog (see read_catalog), True if the granule is in the catalog
+        return self.id in read_catalog([self], session=session)
+
+    def resolve_links(self, aws=True) -> List[str]:
+        # resolve each file to the first available tier: local file, local cache, mirror, S3 (aws) or HTTPS
+        # the local file of a granule downloaded by an earlier session is recorded in the catalog, read once
+        if self._local_path is None and not getattr(self, '_catalog_read', False):
+            read_catalog([self])
+        local_cache = cache.get_cache()
+        links = self.s3 if aws else self.https
+        return [local_cache.resolve(url, local_path=self._local_path) for url in links]
+
+    def probe(self, data_sets=None, aws=True, refresh=False) -> Dict:
+        # grid, dtype, nodata and layout of the layers from their COG headers (pyesat.probe), without opening them
+        from . import probe
+        return probe.probe_granules([self], data_sets=data_sets, aws=aws, refresh=refresh)[self.id]
+
+    def get_xarray(self, data_sets=None, aws=True, verbose=False, block_cache=True,
+                   chunk_policy=None) -> 'xr.Dataset':
         # Return an xarray dataset from the file in self.https list
         # https://xarray.pydata.org/en/stable/generated/xarray.open_dataset.html
         # https://xarray.pydata.org/en/stable/io.html#reading-from-amazon-s3
-
-        with DaacReadSession() as session:
-            if aws:
-                links = self.s3
-            else:
-                links = self.https
-            if data_sets is None:
-                data_sets = [f.split('_')[-1].replace('.tif', '') for f in links]
-            if verbose:
-                data_sets_ = [f.split('_')[-1].replace('.tif', '') for f in links]
-                data_sets_ = {ds: url for ds, url in zip(data_sets_, links)}
-                data_urls = [data_sets_[ds] for ds in data_sets]
-            loc_ = {True: 'S3', False: 'HTTPS'}[aws]
-            if verbose:
-                print(f'Opening {loc_} {self.id} with data sets: {data_sets}')
-            data_array = {ds:dask.delayed(rioxarray.open_rasterio)(ds_url, chunks='auto') for ds, ds_url in
-                          zip(data_sets, data_urls)}
-            with ProgressBar():
-                data_set = xr.Dataset({ds:d.compute().squeeze() for ds, d in data_array.items()})
+        # remote range reads go through the shared on-disk block cache unless block_cache is False
+        # layers are chunked by chunk_policy (default chunking.default_policy), aligned to the COG blocks
+        import dask
+        import xarray as xr
+        from dask.diagnostics import ProgressBar
+
+        links = self.resolve_links(aws=aws)
+        data_sets_ = [f.split('_')[-1].replace('.tif', '') for f in links]
+        data_sets_ = {ds: url for ds, url in zip(data_sets_, links)}
+        if data_sets is None:
+            data_sets = list(data_sets_)
+        data_urls = [data_sets_[ds] for ds in data_sets]
+        remote = [l for l in data_urls if '://' in l]
+        # only set up a read session if some of the requested files are not available locally
+        with metrics.timer('granule.open'), (DaacReadSession() if remote else contextlib.nullcontext()):
+            loc_ = {True: 'S3', False: 'HTTPS'}[aws] if remote else 'LOCAL'
+            logger.log(logging.INFO if verbose else logging.DEBUG, 'Opening %s %s with data sets: %s', loc_, self.id,
+                       data_sets)
+            open_kwargs = {}
+            if remote and block_cache:
+                blockcache.get_block_cache().evict()
+                open_kwargs['opener'] = blockcache.BlockCacheOpener(blockcache.get_block_cache())
+            opened = {}
+            # the time to first byte is the time it takes to open (read the header of) the first remote layer
+            if remote:
+                ds = data_sets[data_urls.index(remote[0])]
+                start = time.perf_counter()
+                opened[ds] = chunking.open_layer(remote[0], chunk_policy, **open_kwargs)
+                self._time_to_first_byte = time.perf_counter() - start
+                metrics.observe('granule.time_to_first_byte', self._time_to_first_byte)
+            data_array = {ds:dask.delayed(chunking.open_layer)(ds_url, chunk_policy,
+                                                               **(open_kwargs if '://' in ds_url else {}))
+                          for ds, ds_url in zip(data_sets, data_urls) if ds not in opened}
+            # the dask progress bar is only shown on request
+            with ProgressBar() if verbose else contextlib.nullcontext():
+                for ds, d in data_array.items():
+                    opened[ds] = d.compute()
+            data_set = xr.Dataset({ds: opened[ds].squeeze() for ds in data_sets})
         # add time coordinate to data set and set as dimension coordinate
 
-        print(f'Finished opening {self.id}')
+        logger.debug('Finished opening %s', self.id)
+        if remote:
+            self.update_catalog()
         data_set['time'] = self.time_start
         # add the time coordinate as a dimension coordinate
         data_set = data_set.set_coords('time')
@@ -431,14 +614,76 @@ class Granule(base):
             self.xarray = data_set
         return data_set
 
-    def write_to_zarr(self, path):
+    def write_to_zarr(self, path, verbose=False):
         # check if there is an xarray dataset in the object if not
         # load it make sure to append to other data that may be in the zarr store
         if self.xarray is None:
             self.get_xarray()
         # write the xarray dataset to a zarr file in the specified path
-        self.xarray.to_zarr(path, mode='a')
-        print(f'Finished writing {self.id} to {path}')
+        # layers are stored with the encoding profiles of pyesat.encoding (scaled int16 LST, Blosc/Zstd)
+        with metrics.timer('granule.write_zarr'):
+            encoding.to_zarr(self.xarray, path, mode='a')
+        metrics.add_bytes('zarr', self.xarray.nbytes)
+        logger.log(logging.INFO if verbose else logging.DEBUG, 'Finished writing %s to %s', self.id, path)
+
+    def write_to_netcdf(self, path, verbose=False):
+        # write the xarray dataset to a NetCDF4 file with the encoding profiles of pyesat.encoding
+        from .pipeline import zarr_attrs
+        if self.xarray is None:
+            self.get_xarray()
+        data_set = self.xarray.copy()
+        data_set.attrs = {k: ', '.join(v) if isinstance(v, list) else v for k, v in zarr_attrs(data_set.attrs).items()}
+        with metrics.timer('granule.write_netcdf'):
+            encoding.to_netcdf(data_set, path)
+        logger.log(logging.INFO if verbose else logging.DEBUG, 'Finished writing %s to %s', self.id, path)
+
+
+
+def read_catalog(granules: List[Granule], session: sqlalchemy.orm.session.Session = None) -> List[str]:
+    """
+    Read the download status of granules built from a CMR search back from the catalog, in one query per 500
+    granules: the granules downloaded by an earlier session get their local path.
+
+    Args:
+        granules: Granules from CMRClient.search_granules
+        session: catalog session, a session of the catalog at db_path if None
+
+    Returns: ids of the granules in the catalog
+    """
+    if not granules:
+        return []
+    if session is None:
+        if not db_path.exists():
+            for granule in granules:
+                granule._catalog_read = True
+            return []
+        with SessionContextManager(db_path=db_path) as session:
+            return read_catalog(granules, session)
+    by_id = {granule.id: granule for granule in granules}
+    ids = list(by_id)
+    found = []
+    try:
+        if has_granule_table(session.get_bind()):
+            for i in range(0, len(ids), _max_ids):
+                query = sqlalchemy.select(Granule._id, Granule._local_path, Granule._is_downloaded).where(
+                    Granule._id.in_(ids[i:i + _max_ids]))
+                for granule_id, local_path, is_downloaded in session.execute(query):
+                    found.append(granule_id)
+                    if is_downloaded:
+                        by_id[granule_id]._local_path = local_path
+                        by_id[granule_id]._is_downloaded = is_downloaded
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.warning('Could not read %d granules from the catalog: %s', len(ids), e)
+        return []
+    for granule in granules:
+        granule._catalog_read = True
+    return found
+
+
+def resolve_links(granules: List[Granule], aws=True) -> Dict[str, List[str]]:
+    # Granule.resolve_links of many granules, reading their download status from the catalog in one query
+    read_catalog([g for g in granules if g._local_path is None and not getattr(g, '_catalog_read', False)])
+    return {granule.id: granule.resolve_links(aws=aws) for granule in granules}
 
 
 class Links:
@@ -447,10 +692,11 @@ class Links:
         self.links = links
 
     def get_s3(self):
-        return [l['href'] for l in self.links if 's3' in l['href'] and '.tif' in l['href']]
+        return [l['href'] for l in self.links if l['href'].startswith('s3://') and '.tif' in l['href']]
 
     def get_https(self):
-        return [l['href'] for l in self.links if 'https' in l['href'] and '.tif' in l['href']]
+        # plain http links are only served by local mirrors and test servers
+        return [l['href'] for l in self.links if l['href'].startswith(('https://', 'http://')) and '.tif' in l['href']]
 
     def __repr__(self):
         return f'{self.links}'
@@ -489,9 +735,9 @@ class CmrSearch:
         return parsed_results
 
 
-# local data path from config.ini using configparser
-config = configparser.ConfigParser()
-data_path = Path(config.get('data_path', 'path'))
-
-# find all of the local files in the data path
-
+def get_data_path() -> Optional[Path]:
+    # local data path from the [data_path] section of config.ini, None if it isn't configured
+    config_parser = credentials.get_credentials()
+    if not config_parser.has_option('data_path', 'path'):
+        return None
+    return Path(config_parser.get('data_path', 'path')).expanduser()
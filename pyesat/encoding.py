@@ -0,0 +1,166 @@
+from pathlib import Path
+from typing import Dict, Union, TYPE_CHECKING
+
+from . import metrics
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+
+class LayerProfile:
+    """
+    On-disk encoding of a layer: integer dtype, CF scale_factor/add_offset packing and the Blosc shuffle filter.
+
+    Scaled layers are stored as round((value - add_offset) / scale_factor), so the decoded values are within
+    scale_factor / 2 of the original values; NaNs are stored as the fill value.
+    """
+
+    def __init__(self, dtype: str, scale_factor: float = None, add_offset: float = None, fill_value: int = None,
+                 shuffle: str = 'shuffle'):
+        self.dtype = dtype
+        self.scale_factor = scale_factor
+        self.add_offset = add_offset
+        self.fill_value = fill_value
+        self.shuffle = shuffle
+
+    def __repr__(self):
+        return (f'LayerProfile({self.dtype}, scale_factor={self.scale_factor}, add_offset={self.add_offset}, '
+                f'fill_value={self.fill_value})')
+
+    @property
+    def precision(self) -> float:
+        # largest difference between a value and its decoded value, 0 for layers that are stored as is
+        return self.scale_factor / 2 if self.scale_factor else 0.
+
+    def cf_encoding(self) -> Dict:
+        encoding = {'dtype': self.dtype}
+        if self.scale_factor is not None:
+            encoding['scale_factor'] = self.scale_factor
+        if self.add_offset is not None:
+            encoding['add_offset'] = self.add_offset
+        if self.fill_value is not None:
+            encoding['_FillValue'] = self.fill_value
+        return encoding
+
+
+# profiles of the L2T LSTE layers
+profiles = {
+    # 0.01 K steps around 0 C: -54.5 K to 600.8 K
+    'LST': LayerProfile('int16', scale_factor=0.01, add_offset=273.15, fill_value=-32768),
+    # LST_err (named after the end of its file name, as all layers read by Granule.get_xarray): 0.001 K steps up
+    # to 32.7 K
+    'err': LayerProfile('int16', scale_factor=0.001, add_offset=0., fill_value=-32768),
+    # emissivity in 0.0001 steps
+    'EmisWB': LayerProfile('int16', scale_factor=0.0001, add_offset=0., fill_value=-32768),
+    'height': LayerProfile('int16', scale_factor=1., add_offset=0., fill_value=-32768),
+    # bit fields and flags, bitshuffle groups the bits of each flag
+    'QC': LayerProfile('uint16', fill_value=65535, shuffle='bitshuffle'),
+    'cloud': LayerProfile('uint8', fill_value=255, shuffle='bitshuffle'),
+    'water': LayerProfile('uint8', fill_value=255, shuffle='bitshuffle'),
+}
+
+# conventions of the attributes set by rioxarray that would conflict with the encoding
+_cf_attrs = ['_FillValue', 'scale_factor', 'add_offset', 'missing_value']
+
+
+def _zarr_major() -> int:
+    import zarr
+    return int(zarr.__version__.split('.')[0])
+
+
+def blosc(zarr_format: int = None, shuffle: str = 'shuffle', clevel: int = 5) -> Dict:
+    """
+    Blosc/Zstd compression with a shuffle filter, as encoding of zarr-python 2 or 3 and zarr format 2 or 3 stores.
+    """
+    if _zarr_major() < 3 or zarr_format == 2:
+        import numcodecs
+        shuffles = {'noshuffle': numcodecs.Blosc.NOSHUFFLE, 'shuffle': numcodecs.Blosc.SHUFFLE,
+                    'bitshuffle': numcodecs.Blosc.BITSHUFFLE}
+        compressor = numcodecs.Blosc(cname='zstd', clevel=clevel, shuffle=shuffles[shuffle])
+        return {'compressor': compressor} if _zarr_major() < 3 else {'compressors': [compressor]}
+    from zarr.codecs import BloscCodec
+    return {'compressors': [BloscCodec(cname='zstd', clevel=clevel, shuffle=shuffle)]}
+
+
+def clear_cf_attrs(data_set: 'xr.Dataset', profiles: Dict[str, LayerProfile] = profiles) -> 'xr.Dataset':
+    # drop the packing attributes (e.g. rioxarray's scale_factor and _FillValue) of the layers with a profile, the
+    # encoding sets them; the other layers keep theirs, e.g. their nodata value
+    data_set = data_set.copy()
+    for name, variable in data_set.variables.items():
+        if name not in profiles:
+            continue
+        for attr in _cf_attrs:
+            variable.attrs.pop(attr, None)
+    return data_set
+
+
+def _cf_encoding(data_set: 'xr.Dataset', name: str, profiles: Dict[str, LayerProfile]) -> Dict:
+    # an explicit encoding replaces the one of the variable, keep the link to the CRS (spatial_ref) set by rioxarray
+    encoding = {k: v for k, v in data_set[name].encoding.items() if k in ['grid_mapping', 'coordinates']}
+    profile = profiles.get(name)
+    if profile is None:
+        return encoding
+    encoding.update(profile.cf_encoding())
+    # integer layers stored as is keep the nodata value of the source
+    fill_value = data_set[name].attrs.get('_FillValue', data_set[name].encoding.get('_FillValue'))
+    if profile.scale_factor is None and fill_value is not None and data_set[name].dtype.kind in 'iu':
+        encoding['_FillValue'] = fill_value
+    return encoding
+
+
+def zarr_encoding(data_set: 'xr.Dataset', zarr_format: int = None, clevel: int = 5,
+                  profiles: Dict[str, LayerProfile] = profiles) -> Dict:
+    # encoding argument of to_zarr, the data variables without a profile are only compressed
+    encoding = {}
+    for name in data_set.data_vars:
+        encoding[name] = _cf_encoding(data_set, name, profiles)
+        shuffle = profiles[name].shuffle if name in profiles else 'shuffle'
+        encoding[name].update(blosc(zarr_format, shuffle, clevel))
+    return encoding
+
+
+def netcdf_encoding(data_set: 'xr.Dataset', complevel: int = 4,
+                    profiles: Dict[str, LayerProfile] = profiles) -> Dict:
+    # encoding argument of to_netcdf (netCDF4), deflate with the shuffle filter
+    encoding = {}
+    for name in data_set.data_vars:
+        encoding[name] = _cf_encoding(data_set, name, profiles)
+        encoding[name].update({'zlib': True, 'complevel': complevel, 'shuffle': True})
+    return encoding
+
+
+def _store_arrays(path: Path) -> list:
+    # names of the arrays already in a zarr store
+    import zarr
+    if not any((path / f).exists() for f in ['.zgroup', '.zmetadata', 'zarr.json']):
+        return []
+    return list(zarr.open_group(path.as_posix(), mode='r').array_keys())
+
+
+def to_zarr(data_set: 'xr.Dataset', path: Union[str, Path], mode: str = 'w', zarr_format: int = None,
+            clevel: int = 5, **kwargs):
+    """
+    Write a data set to zarr with the layer profiles. When appending to a store, only the new variables are given an
+    encoding, the existing ones keep the encoding they were created with.
+    """
+    path = Path(path)
+    if zarr_format is None and mode != 'w' and (path / '.zgroup').exists():
+        # appending to a format 2 store
+        zarr_format = 2
+    encoding = zarr_encoding(data_set, zarr_format=zarr_format, clevel=clevel)
+    data_set = clear_cf_attrs(data_set)
+    if mode != 'w':
+        for name in _store_arrays(path):
+            encoding.pop(name, None)
+    if zarr_format is not None:
+        kwargs['zarr_format'] = zarr_format
+    with metrics.timer('zarr.write'):
+        return data_set.to_zarr(path.as_posix(), mode=mode, encoding=encoding, **kwargs)
+
+
+def to_netcdf(data_set: 'xr.Dataset', path: Union[str, Path], complevel: int = 4, **kwargs):
+    # write a data set to NetCDF4 with the layer profiles
+    encoding = netcdf_encoding(data_set, complevel=complevel)
+    data_set = clear_cf_attrs(data_set)
+    with metrics.timer('netcdf.write'):
+        return data_set.to_netcdf(Path(path).as_posix(), engine='netcdf4', encoding=encoding, **kwargs)
@@ -0,0 +1,208 @@
+import os
+import logging
+import concurrent.futures
+from pathlib import Path
+from typing import Dict, List, Optional, Union, TYPE_CHECKING
+
+from . import metrics
+from . import logs
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+_composites = ['mean', 'median', 'min', 'max', 'count']
+_time_format = '%Y%m%dT%H%M%S'
+
+
+def open_cube(path: Union[str, Path], group: str = None) -> 'xr.Dataset':
+    # open a zarr store written by write_to_zarr or the pipeline lazily, with its CRS and transform, and with the
+    # integer layers (QC, cloud, ...) in their stored dtype and fill value rather than masked to floats; the scaled
+    # layers of pyesat.encoding (LST, ...) are decoded to their values
+    import xarray as xr
+    import rioxarray  # registers the .rio accessor
+    data_set = xr.open_zarr(Path(path).as_posix(), group=group, decode_coords='all', mask_and_scale=False)
+    scaled = {v: 'scale_factor' in data_set[v].attrs for v in data_set.data_vars}
+    if any(scaled.values()):
+        data_set = xr.open_zarr(Path(path).as_posix(), group=group, decode_coords='all', mask_and_scale=scaled)
+        # the int16 layers decode to float64, float32 holds their precision
+        for variable in [v for v, s in scaled.items() if s]:
+            data_set[variable] = data_set[variable].astype('float32')
+    return data_set
+
+
+def _is_store(path: Path) -> bool:
+    return any((path / f).exists() for f in ['.zgroup', '.zmetadata', 'zarr.json'])
+
+
+def _composite(data_array: 'xr.DataArray', method: str) -> 'xr.DataArray':
+    # lazy reduction over time, block by block
+    if method not in _composites:
+        raise ValueError(f'composite must be one of {_composites}, got {method}')
+    if data_array.rio.nodata is not None and data_array.dtype.kind != 'f':
+        data_array = data_array.where(data_array != data_array.rio.nodata)
+    if method == 'count':
+        return data_array.notnull().sum('time').astype('uint16')
+    if method == 'median':
+        # the median needs the whole time series of a pixel in one chunk
+        data_array = data_array.chunk({'time': -1})
+    return getattr(data_array, method)('time', skipna=True)
+
+
+def write_cog(data_array: 'xr.DataArray', out_path: Union[str, Path], compress: str = 'DEFLATE',
+              blocksize: int = 512, resampling: str = 'average', overview_count: int = None,
+              nodata: Optional[float] = None, scheduler: str = None) -> str:
+    """
+    Write a 2D (y, x) data array as a Cloud-Optimized GeoTIFF with internal tiling, compression and overviews.
+
+    The array is computed one dask chunk at a time into a temporary tiled GeoTIFF, which GDAL then copies to the
+    COG layout and builds the overviews of, so no more than a chunk (and the GDAL block cache) is held in memory.
+
+    Args:
+        data_array: georeferenced (rioxarray) 2D array, numpy or dask backed
+        out_path: path of the COG
+        compress: GDAL compression (DEFLATE, ZSTD, LZW, ...)
+        blocksize: internal tile size
+        resampling: overview resampling (average, nearest, mode, ...)
+        overview_count: number of overview levels, by default until the overview fits in one tile
+        nodata: nodata value, by default NaN for floats and the _FillValue of integers
+        scheduler: dask scheduler computing the chunks, the configured one if None
+
+    Returns: path of the COG
+    """
+    import numpy as np
+    import dask.array as da
+    import rasterio as rio
+    import rasterio.shutil
+    from rasterio.windows import Window
+
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    data_array = data_array.squeeze(drop=True)
+    if data_array.ndim != 2:
+        raise ValueError(f'expected a 2D (y, x) array, got dimensions {data_array.dims}')
+    data = data_array.data
+    if not isinstance(data, da.Array):
+        data = da.from_array(data, chunks=(blocksize * 4, blocksize * 4))
+    if nodata is None:
+        nodata = np.nan if np.issubdtype(data.dtype, np.floating) else data_array.rio.nodata
+    profile = {
+        'driver': 'GTiff', 'width': data.shape[1], 'height': data.shape[0], 'count': 1, 'dtype': data.dtype.name,
+        'crs': data_array.rio.crs, 'transform': data_array.rio.transform(), 'nodata': nodata,
+        'tiled': True, 'blockxsize': blocksize, 'blockysize': blocksize, 'BIGTIFF': 'IF_SAFER'
+    }
+    tmp_path = out_path.with_name(f'.{out_path.name}.{os.getpid()}.tmp.tif')
+    try:
+        with metrics.timer('export.write_blocks'):
+            with rio.open(tmp_path.as_posix(), 'w', **profile) as dst:
+                offsets = [np.cumsum((0,) + c[:-1]) for c in data.chunks]
+                for i, j in np.ndindex(*data.numblocks):
+                    block = np.asarray(data.blocks[i, j].compute(scheduler=scheduler))
+                    window = Window(offsets[1][j], offsets[0][i], block.shape[1], block.shape[0])
+                    dst.write(block, 1, window=window)
+        options = {'COMPRESS': compress, 'BLOCKSIZE': blocksize, 'OVERVIEW_RESAMPLING': resampling.upper(),
+                   'BIGTIFF': 'IF_SAFER'}
+        if compress.upper() in ['DEFLATE', 'ZSTD', 'LZW']:
+            options['PREDICTOR'] = 'YES'
+        if overview_count is not None:
+            options['OVERVIEW_COUNT'] = overview_count
+        with metrics.timer('export.cog'):
+            rasterio.shutil.copy(tmp_path.as_posix(), out_path.as_posix(), driver='COG', **options)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    metrics.add_bytes('export.cog', out_path.stat().st_size)
+    return out_path.as_posix()
+
+
+class CogExporter:
+    """
+    Export the layers of a time series cube (Zarr) as COGs, per time step and/or as composites over time, writing
+    the outputs in parallel.
+
+        exporter = CogExporter('cogs', variables=['LST'], composites=['mean', 'count'])
+        paths = exporter.export(open_cube('stack.zarr'))
+
+    Attributes:
+    - out_dir (Path): directory of the COGs
+    - variables (List[str]): layers to export, all 2D/3D layers if None
+    - per_time (bool): write one COG per time step and layer
+    - composites (List[str]): composites over time to write, of 'mean', 'median', 'min', 'max', 'count'
+    - max_workers (int): number of COGs written at the same time
+    - verbose (bool): log the progress of an export at INFO level, DEBUG otherwise
+    - cog_options: keyword arguments of write_cog: compress, blocksize, resampling, overview_count and nodata (the
+      scheduler is set by the exporter, the chunks of an output are computed in the thread writing it)
+    """
+
+    def __init__(self, out_dir: Union[str, Path], variables: List[str] = None, per_time: bool = True,
+                 composites: List[str] = None, max_workers: int = 4, verbose: bool = False, **cog_options):
+        self.out_dir = Path(out_dir)
+        self.variables = variables
+        self.per_time = per_time
+        self.composites = composites or []
+        for method in self.composites:
+            if method not in _composites:
+                raise ValueError(f'composite must be one of {_composites}, got {method}')
+        self.max_workers = max_workers
+        self.verbose = verbose
+        self.cog_options = cog_options
+
+    def outputs(self, data_set: 'xr.Dataset', name: str = None) -> Dict[str, 'xr.DataArray']:
+        # lazy 2D arrays to write, by output file name
+        import pandas as pd
+        name = name or data_set.attrs.get('id', 'cube')
+        variables = self.variables or [v for v in data_set.data_vars
+                                       if {'y', 'x'} <= set(data_set[v].dims) and data_set[v].ndim <= 3]
+        outputs = {}
+        for variable in variables:
+            data_array = data_set[variable]
+            if 'time' not in data_array.dims:
+                outputs[f'{name}_{variable}.tif'] = data_array
+                continue
+            times = pd.to_datetime(data_array['time'].values)
+            if self.per_time:
+                for i, time in enumerate(times):
+                    outputs[f'{name}_{variable}_{time.strftime(_time_format)}.tif'] = data_array.isel(time=i)
+            for method in self.composites:
+                period = f'{times.min().strftime(_time_format)}_{times.max().strftime(_time_format)}'
+                composite = _composite(data_array, method)
+                composite.rio.write_crs(data_array.rio.crs, inplace=True)
+                outputs[f'{name}_{variable}_{method}_{period}.tif'] = composite
+        return outputs
+
+    def _write(self, data_array: 'xr.DataArray', out_path: Path) -> str:
+        # the exporter parallelizes over outputs, compute the chunks of one output in its own thread
+        return write_cog(data_array, out_path, scheduler='synchronous', **self.cog_options)
+
+    def export(self, data_set: 'xr.Dataset', name: str = None) -> List[str]:
+        """
+        Write all the outputs of a cube.
+
+        Returns: paths of the COGs
+        """
+        outputs = self.outputs(data_set, name=name)
+        level = logging.INFO if self.verbose else logging.DEBUG
+        paths = []
+        with logs.Progress('COGs', total=len(outputs), logger=logger, level=level) as progress, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._write, data_array, self.out_dir / file_name)
+                       for file_name, data_array in outputs.items()]
+            for future in futures:
+                paths.append(future.result())
+                progress.update(nbytes=Path(paths[-1]).stat().st_size)
+        return paths
+
+
+def export_zarr(path: Union[str, Path], out_dir: Union[str, Path], **exporter_options) -> List[str]:
+    """
+    Export a zarr store, or every store in a directory (e.g. the per-granule stores of the pipeline), as COGs.
+
+    Returns: paths of the COGs
+    """
+    path = Path(path)
+    stores = [path] if _is_store(path) else sorted(p for p in path.glob('*.zarr') if _is_store(p))
+    exporter = CogExporter(out_dir, **exporter_options)
+    paths = []
+    for store in stores:
+        paths.extend(exporter.export(open_cube(store), name=store.stem))
+    return paths
@@ -0,0 +1,189 @@
+import os
+import socket
+import uuid
+import pathlib
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import Column, Integer, String, DateTime, Float, UniqueConstraint
+from sqlalchemy.dialects.sqlite import insert
+
+from . import earthdata
+
+_statuses = ['pending', 'running', 'done', 'failed']
+
+
+class JobTask(earthdata.base):
+    # state of one stage (e.g. download, zarr, browse) of one granule in a bulk job
+    __tablename__ = 'job_tasks'
+    __table_args__ = (UniqueConstraint('job', 'granule_id', 'stage'),)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job = Column(String, nullable=False, index=True)
+    granule_id = Column(String, nullable=False)
+    stage = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='pending', index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    worker = Column(String)
+    claim = Column(String)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+    duration = Column(Float)
+    error = Column(String)
+    updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'{self.job} | {self.stage} | {self.granule_id} | {self.status} ({self.attempts} attempts)'
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _is_dead(worker: str) -> bool:
+    # whether worker (worker_name) is a process of this host that no longer exists
+    host, _, pid = (worker or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class JobState:
+    """
+    Persistent, per granule and per stage progress of a bulk job in the pyesat database.
+
+    Work is claimed with a single UPDATE statement, so several processes can share a job without processing the
+    same granule twice, and completed work is skipped when a job is restarted. Work claimed by a worker that died
+    (a process of this host that no longer exists, or running for longer than stale_timeout) is handed out again.
+    """
+
+    def __init__(self, job: str, db_path: pathlib.Path = earthdata.db_path, max_attempts: int = 3,
+                 stale_timeout: timedelta = timedelta(hours=1)):
+        self.job = job
+        self.max_attempts = max_attempts
+        self.stale_timeout = stale_timeout
+        self.engine = earthdata.get_engine(db_path)
+        JobTask.__table__.create(self.engine, checkfirst=True)
+        self.worker = worker_name()
+
+    def __repr__(self):
+        return f'JobState({self.job}, {self.summary()})'
+
+    def add(self, granule_ids: List[str], stages: List[str]) -> None:
+        # register the work of the job, granules that are already registered keep their state
+        rows = [{'job': self.job, 'granule_id': g, 'stage': s, 'status': 'pending', 'attempts': 0}
+                for g in granule_ids for s in stages]
+        if not rows:
+            return
+        with self.engine.begin() as connection:
+            connection.execute(insert(JobTask).on_conflict_do_nothing(), rows)
+
+    def claim(self, stage: str, n: int = 1, granule_ids: List[str] = None) -> List[str]:
+        """
+        Claim up to n pending granules of a stage for this worker.
+
+        Args:
+            stage: stage of the work
+            n: maximum number of granules claimed
+            granule_ids: only claim among these granules (the ones this worker can process), any if None
+
+        Returns: list of claimed granule ids
+        """
+        claim = uuid.uuid4().hex
+        pending = sqlalchemy.select(JobTask.id).where(JobTask.job == self.job, JobTask.stage == stage,
+                                                      JobTask.status == 'pending')
+        if granule_ids is not None:
+            pending = pending.where(JobTask.granule_id.in_(list(granule_ids)))
+        pending = pending.limit(n).scalar_subquery()
+        with self.engine.begin() as connection:
+            connection.execute(sqlalchemy.update(JobTask)
+                               .where(JobTask.id.in_(pending))
+                               .values(status='running', worker=self.worker, claim=claim,
+                                       started=datetime.utcnow(), attempts=JobTask.attempts + 1)
+                               .execution_options(synchronize_session=False))
+            rows = connection.execute(sqlalchemy.select(JobTask.granule_id).where(JobTask.claim == claim))
+            return [r[0] for r in rows]
+
+    def release(self, granule_ids: List[str], stage: str) -> None:
+        # hand work claimed by this worker and left unprocessed back without counting the attempt
+        if not granule_ids:
+            return
+        with self.engine.begin() as connection:
+            connection.execute(sqlalchemy.update(JobTask)
+                               .where(JobTask.job == self.job, JobTask.stage == stage, JobTask.status == 'running',
+                                      JobTask.worker == self.worker, JobTask.granule_id.in_(list(granule_ids)))
+                               .values(status='pending', claim=None, attempts=JobTask.attempts - 1))
+
+    def _finish(self, granule_id: str, stage: str, values: Dict) -> None:
+        now = datetime.utcnow()
+        with self.engine.begin() as connection:
+            started = connection.execute(sqlalchemy.select(JobTask.started).where(
+                JobTask.job == self.job, JobTask.granule_id == granule_id, JobTask.stage == stage)).scalar()
+            duration = (now - started).total_seconds() if started else None
+            connection.execute(sqlalchemy.update(JobTask)
+                               .where(JobTask.job == self.job, JobTask.granule_id == granule_id,
+                                      JobTask.stage == stage)
+                               .values(finished=now, duration=duration, claim=None, **values))
+
+    def complete(self, granule_id: str, stage: str) -> None:
+        self._finish(granule_id, stage, {'status': 'done', 'error': None})
+
+    def fail(self, granule_id: str, stage: str, error: str) -> str:
+        # failed work goes back to pending until it has been attempted max_attempts times, returns the new status
+        with self.engine.connect() as connection:
+            attempts = connection.execute(sqlalchemy.select(JobTask.attempts).where(
+                JobTask.job == self.job, JobTask.granule_id == granule_id, JobTask.stage == stage)).scalar()
+        status = 'failed' if (attempts or 0) >= self.max_attempts else 'pending'
+        self._finish(granule_id, stage, {'status': status, 'error': str(error)})
+        return status
+
+    def requeue_stale(self, stage: str = None, timeout: timedelta = None) -> int:
+        """
+        Put work claimed by workers that died back to pending: work of processes of this host that no longer
+        exist, and work running for longer than timeout (default stale_timeout).
+
+        Returns: number of requeued tasks
+        """
+        timeout = self.stale_timeout if timeout is None else timeout
+        running = sqlalchemy.and_(JobTask.job == self.job, JobTask.status == 'running')
+        if stage is not None:
+            running = sqlalchemy.and_(running, JobTask.stage == stage)
+        with self.engine.begin() as connection:
+            workers = connection.execute(sqlalchemy.select(JobTask.worker).where(running).distinct()).scalars()
+            dead = [w for w in workers if _is_dead(w)]
+            result = connection.execute(sqlalchemy.update(JobTask)
+                                        .where(running, sqlalchemy.or_(JobTask.worker.in_(dead),
+                                                                       JobTask.started < datetime.utcnow() - timeout))
+                                        .values(status='pending', claim=None))
+            return result.rowcount
+
+    def status(self, granule_id: str, stage: str) -> str:
+        with self.engine.connect() as connection:
+            return connection.execute(sqlalchemy.select(JobTask.status).where(
+                JobTask.job == self.job, JobTask.granule_id == granule_id, JobTask.stage == stage)).scalar()
+
+    def summary(self) -> Dict:
+        # number of tasks per stage and status
+        with self.engine.connect() as connection:
+            rows = connection.execute(sqlalchemy.select(JobTask.stage, JobTask.status, sqlalchemy.func.count())
+                                      .where(JobTask.job == self.job)
+                                      .group_by(JobTask.stage, JobTask.status))
+            summary = {}
+            for stage, status, count in rows:
+                summary.setdefault(stage, {s: 0 for s in _statuses})[status] = count
+            return summary
+
+    def errors(self, stage: str = None) -> Dict:
+        query = sqlalchemy.select(JobTask.granule_id, JobTask.error).where(
+            JobTask.job == self.job, JobTask.error.is_not(None))
+        if stage is not None:
+            query = query.where(JobTask.stage == stage)
+        with self.engine.connect() as connection:
+            return dict(connection.execute(query).all())
@@ -0,0 +1,74 @@
+import sys
+import time
+import logging
+import threading
+
+# parent of the loggers of all pyesat modules (pyesat.earthdata, pyesat.pipeline, ...)
+logger = logging.getLogger('pyesat')
+
+_format = '%(asctime)s %(name)s %(levelname)s %(message)s'
+
+
+def log_to_console(level: int = logging.INFO, fmt: str = _format) -> logging.Handler:
+    """
+    Show pyesat log records on stderr, nothing but warnings is shown unless a handler is configured.
+    Returns: the handler, remove it with logger.removeHandler
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(fmt))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return handler
+
+
+class Progress:
+    """
+    Progress of a long running loop, logged as a rate-limited summary (count, items/s, MB/s) at most once every
+    `interval` seconds instead of one line per item.
+
+        with Progress('granules', total=len(granules)) as progress:
+            for granule in granules:
+                ...
+                progress.update(nbytes=size)
+    """
+
+    def __init__(self, name: str = 'granules', total: int = None, interval: float = 10.,
+                 logger: logging.Logger = logger, level: int = logging.INFO):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.logger = logger
+        self.level = level
+        self.count = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last = self._start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, n: int = 1, nbytes: int = 0) -> None:
+        # count n more items and nbytes more bytes
+        with self._lock:
+            self.count += n
+            self.bytes += nbytes
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+        self._log()
+
+    def _log(self, done: bool = False) -> None:
+        if not self.logger.isEnabledFor(self.level):
+            return
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        count = f'{self.count}/{self.total}' if self.total is not None else f'{self.count}'
+        self.logger.log(self.level, '%s%s %s in %.1f s | %.1f %s/s | %.1f MB/s', 'finished: ' if done else '',
+                        count, self.name, elapsed, self.count / elapsed, self.name, self.bytes / 1024 ** 2 / elapsed)
+
+    def close(self) -> None:
+        self._log(done=True)
@@ -0,0 +1,184 @@
+import json
+import time
+import logging
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict
+
+# prefix of the exported metric names
+_namespace = 'pyesat'
+
+
+class _Stat:
+    # running count/sum/min/max of a duration
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def as_dict(self) -> Dict:
+        return {'count': self.count, 'total': self.total, 'mean': self.total / self.count if self.count else 0.,
+                'min': self.min if self.count else 0., 'max': self.max}
+
+
+class Metrics:
+    """
+    In-process registry of operation durations, bytes transferred and event counts (retries, cache hits, ...).
+
+    Every recorded value is also passed to the registered sinks, callables taking (kind, name, value), e.g. a
+    LogSink writing structured log records.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.bytes = {}
+        self.counts = {}
+        self.sinks = []
+
+    def _emit(self, kind: str, name: str, value) -> None:
+        for sink in self.sinks:
+            sink(kind, name, value)
+
+    def add_sink(self, sink: Callable) -> None:
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink: Callable) -> None:
+        self.sinks.remove(sink)
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.durations.setdefault(name, _Stat()).add(seconds)
+        self._emit('duration', name, seconds)
+
+    def add_bytes(self, name: str, n: int) -> None:
+        with self._lock:
+            self.bytes[name] = self.bytes.get(name, 0) + int(n)
+        self._emit('bytes', name, int(n))
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+        self._emit('count', name, n)
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        # time the block, failures are counted as <name>.error
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count(f'{name}.error')
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.durations = {}
+            self.bytes = {}
+            self.counts = {}
+
+    def summary(self) -> Dict:
+        """
+        Summary of everything recorded so far, with the hit ratio of every '<name>.hit'/'<name>.miss' pair.
+        Returns: Dict with 'durations', 'bytes', 'counts' and 'hit_ratios'
+        """
+        with self._lock:
+            counts = dict(self.counts)
+            summary = {'durations': {k: v.as_dict() for k, v in self.durations.items()},
+                       'bytes': dict(self.bytes),
+                       'counts': counts}
+        hit_ratios = {}
+        for name in counts:
+            if name.endswith('.hit'):
+                base_name = name[:-len('.hit')]
+                total = counts[name] + counts.get(f'{base_name}.miss', 0)
+                hit_ratios[base_name] = counts[name] / total if total else 0.
+        summary['hit_ratios'] = hit_ratios
+        return summary
+
+    def to_prometheus(self) -> str:
+        # Prometheus text exposition format
+        summary = self.summary()
+        lines = [f'# TYPE {_namespace}_duration_seconds summary']
+        for name, stat in sorted(summary['durations'].items()):
+            lines.append(f'{_namespace}_duration_seconds_count{{op="{name}"}} {stat["count"]}')
+            lines.append(f'{_namespace}_duration_seconds_sum{{op="{name}"}} {stat["total"]}')
+        lines.append(f'# TYPE {_namespace}_bytes_total counter')
+        for name, value in sorted(summary['bytes'].items()):
+            lines.append(f'{_namespace}_bytes_total{{op="{name}"}} {value}')
+        lines.append(f'# TYPE {_namespace}_events_total counter')
+        for name, value in sorted(summary['counts'].items()):
+            lines.append(f'{_namespace}_events_total{{event="{name}"}} {value}')
+        lines.append(f'# TYPE {_namespace}_hit_ratio gauge')
+        for name, value in sorted(summary['hit_ratios'].items()):
+            lines.append(f'{_namespace}_hit_ratio{{cache="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def report(self) -> str:
+        # human readable table of the summary
+        summary = self.summary()
+        lines = [f"{'operation':<32}{'count':>8}{'total s':>10}{'mean s':>10}{'max s':>10}"]
+        for name, stat in sorted(summary['durations'].items()):
+            lines.append(f"{name:<32}{stat['count']:>8}{stat['total']:>10.3f}{stat['mean']:>10.4f}{stat['max']:>10.4f}")
+        for name, value in sorted(summary['bytes'].items()):
+            lines.append(f'{name:<32}{value / 1024 ** 2:>8.1f} MB')
+        for name, value in sorted(summary['counts'].items()):
+            lines.append(f'{name:<32}{value:>8}')
+        for name, value in sorted(summary['hit_ratios'].items()):
+            lines.append(f'{name + " hit ratio":<32}{value:>8.1%}')
+        return '\n'.join(lines)
+
+
+class LogSink:
+    # sink writing every recorded value as a json log record
+    def __init__(self, logger: logging.Logger = None, level: int = logging.DEBUG):
+        self.logger = logging.getLogger(f'{_namespace}.metrics') if logger is None else logger
+        self.level = level
+
+    def __call__(self, kind: str, name: str, value) -> None:
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, json.dumps({'kind': kind, 'name': name, 'value': value}))
+
+
+def serve_prometheus(port: int = 9464, registry: Metrics = None, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Serve the metrics in Prometheus text format at http://<host>:<port>/metrics from a background thread, on
+    localhost only by default (host='' serves on all interfaces).
+    Returns: the server, call shutdown() to stop it
+    """
+    registry = metrics if registry is None else registry
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# the default registry used by pyesat
+metrics = Metrics()
+timer = metrics.timer
+observe = metrics.observe
+add_bytes = metrics.add_bytes
+count = metrics.count
+summary = metrics.summary
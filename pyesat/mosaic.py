@@ -0,0 +1,336 @@
+import math
+import logging
+import threading
+import collections
+from typing import Callable, Dict, List, Tuple, TYPE_CHECKING
+
+from . import metrics
+from . import tiles
+
+if TYPE_CHECKING:
+    import numpy as np
+    import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+_mb = 1024 ** 2
+# QC bits 0-1 (mandatory QA flags) of the L2 LSTE products: 0 best quality, 1 nominal, 2 cloud, 3 not produced
+_qa_mask = 0b11
+_value_layers = ['LST', 'err', 'EmisWB', 'height']
+_no_source = 65535
+
+
+class Grid:
+    """
+    North-up target grid of a mosaic.
+
+    Attributes:
+    - crs (str): e.g. EPSG:32618
+    - transform (Affine): affine transform of the grid
+    - width, height (int): size in pixels
+    """
+
+    def __init__(self, crs: str, transform, width: int, height: int):
+        self.crs = crs
+        self.transform = transform
+        self.width = int(width)
+        self.height = int(height)
+
+    def __repr__(self):
+        return f'Grid({self.crs}, {self.width}x{self.height}, {tuple(self.transform)[:6]})'
+
+    @property
+    def key(self) -> Tuple:
+        return self.crs, tuple(self.transform)[:6], self.width, self.height
+
+    @property
+    def resolution(self) -> float:
+        return self.transform.a
+
+    @classmethod
+    def from_bounds(cls, bbox: List[float], crs: str = None, resolution: float = 70.,
+                    origin: Tuple[float, float] = None) -> 'Grid':
+        """
+        Grid covering a [min_lon, min_lat, max_lon, max_lat] box.
+
+        Args:
+            bbox: area of the grid, in degrees
+            crs: CRS of the grid, the UTM zone of the center of bbox if None
+            resolution: pixel size in the units of crs
+            origin: (x, y) the pixel edges are aligned to, e.g. the corner of a tile so that the tiles of the grid's
+                UTM zone need no resampling; multiples of resolution if None
+        """
+        import pyproj
+        from affine import Affine
+        crs = crs or tiles.utm_crs((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+        transformer = pyproj.Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+        left, bottom, right, top = transformer.transform_bounds(*bbox, densify_pts=21)
+        x0, y0 = origin or (0., 0.)
+        left = x0 + math.floor((left - x0) / resolution) * resolution
+        top = y0 + math.ceil((top - y0) / resolution) * resolution
+        width = math.ceil((right - left) / resolution)
+        height = math.ceil((top - bottom) / resolution)
+        return cls(crs, Affine(resolution, 0., left, 0., -resolution, top), width, height)
+
+    def coords(self) -> Tuple['np.ndarray', 'np.ndarray']:
+        # x and y of the pixel centers
+        import numpy as np
+        x = self.transform.c + self.transform.a * (np.arange(self.width) + 0.5)
+        y = self.transform.f + self.transform.e * (np.arange(self.height) + 0.5)
+        return x, y
+
+    def windows(self, chunk_size: int) -> List[Tuple[int, int, int, int]]:
+        # (row_start, row_stop, col_start, col_stop) of the chunks of the grid
+        return [(r, min(r + chunk_size, self.height), c, min(c + chunk_size, self.width))
+                for r in range(0, self.height, chunk_size) for c in range(0, self.width, chunk_size)]
+
+
+class IndexMap:
+    # nearest source pixel of every pixel of a target window: rows and cols within the source window
+    # (row_start, row_stop, col_start, col_stop), and whether the pixel is covered by the source
+    def __init__(self, window: Tuple[int, int, int, int], rows: 'np.ndarray', cols: 'np.ndarray',
+                 valid: 'np.ndarray'):
+        self.window = window
+        self.rows = rows
+        self.cols = cols
+        self.valid = valid
+
+    @property
+    def empty(self) -> bool:
+        return self.window is None
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self.empty else self.rows.nbytes + self.cols.nbytes + self.valid.nbytes
+
+
+_transformers = threading.local()
+
+
+def _transformer(src_crs: str, dst_crs: str):
+    # pyproj transformers are not shared between threads
+    import pyproj
+    cache = _transformers.__dict__.setdefault('cache', {})
+    if (src_crs, dst_crs) not in cache:
+        cache[(src_crs, dst_crs)] = pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+    return cache[(src_crs, dst_crs)]
+
+
+def index_map(source: Grid, target: Grid, window: Tuple[int, int, int, int]) -> IndexMap:
+    # warp geometry of a target window from a source grid, nearest neighbour
+    import numpy as np
+    x, y = target.coords()
+    xs, ys = np.meshgrid(x[window[2]:window[3]], y[window[0]:window[1]])
+    if source.crs != target.crs:
+        xs, ys = _transformer(target.crs, source.crs).transform(xs, ys)
+    cols, rows = ~source.transform * (xs, ys)
+    rows, cols = np.floor(rows), np.floor(cols)
+    valid = (rows >= 0) & (rows < source.height) & (cols >= 0) & (cols < source.width)
+    if not valid.any():
+        return IndexMap(None, None, None, None)
+    rows, cols = np.where(valid, rows, 0).astype('int32'), np.where(valid, cols, 0).astype('int32')
+    row_start, row_stop = int(rows[valid].min()), int(rows[valid].max()) + 1
+    col_start, col_stop = int(cols[valid].min()), int(cols[valid].max()) + 1
+    return IndexMap((row_start, row_stop, col_start, col_stop), np.where(valid, rows - row_start, 0),
+                    np.where(valid, cols - col_start, 0), valid)
+
+
+class GeometryCache:
+    """
+    Least recently used cache of the index maps of (source grid, target grid, window), shared by the chunks and by
+    all the granules on the same tile grid, e.g. the overpasses of a time window.
+    """
+
+    def __init__(self, max_bytes: int = 256 * _mb):
+        self.max_bytes = max_bytes
+        self._maps = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __dask_tokenize__(self):
+        return id(self)
+
+    def __repr__(self):
+        return f'GeometryCache({len(self._maps)} maps, {self._bytes / _mb:.1f}/{self.max_bytes / _mb:.0f} MB)'
+
+    def get(self, source: Grid, target: Grid, window: Tuple[int, int, int, int]) -> IndexMap:
+        key = (source.key, target.key, window)
+        with self._lock:
+            if key in self._maps:
+                self._maps.move_to_end(key)
+                metrics.count('mosaic.geometry.hit')
+                return self._maps[key]
+        metrics.count('mosaic.geometry.miss')
+        with metrics.timer('mosaic.geometry'):
+            mapping = index_map(source, target, window)
+        with self._lock:
+            if key not in self._maps:
+                self._maps[key] = mapping
+                self._bytes += mapping.nbytes
+            while self._bytes > self.max_bytes and len(self._maps) > 1:
+                _, evicted = self._maps.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return mapping
+
+
+default_cache = GeometryCache()
+
+
+def qc_score(values: Dict[str, 'np.ndarray']) -> 'np.ndarray':
+    """
+    Priority of the pixels of a source, lower is better: any pixel that isn't cloudy comes before a cloudy one, then
+    best quality comes before nominal quality (QC bits 0-1); ties go to the latest overpass (see mosaic). Pixels
+    without a value (NaN, or QC 'not produced') score 255 and are never used.
+
+    Args:
+        values: source values of the layers in a target window, by layer
+    """
+    import numpy as np
+    shape = next(iter(values.values())).shape
+    score = np.zeros(shape, dtype='uint8')
+    if 'QC' in values:
+        score += (values['QC'].astype('uint16') & _qa_mask).astype('uint8')
+    if 'cloud' in values:
+        score += 4 * (values['cloud'] == 1).astype('uint8')
+    for layer in _value_layers:
+        if layer in values and values[layer].dtype.kind == 'f':
+            score[np.isnan(values[layer])] = 255
+    if 'QC' in values:
+        score[(values['QC'].astype('uint16') & _qa_mask) == 3] = 255
+    return score
+
+
+class _Source:
+    # one granule data set with its grid, passed to the chunk tasks as is (dask doesn't traverse it)
+    def __init__(self, data_set: 'xr.Dataset', layers: List[str]):
+        transform = data_set.rio.transform()
+        self.id = data_set.attrs.get('id')
+        self.layers = {layer: data_set[layer].squeeze(drop=True) for layer in layers if layer in data_set}
+        self.grid = Grid(data_set.rio.crs.to_string(), transform, data_set.rio.width, data_set.rio.height)
+
+    def __dask_tokenize__(self):
+        return self.id, self.grid.key, id(self)
+
+    def read(self, layer: str, window: Tuple[int, int, int, int]) -> 'np.ndarray':
+        import numpy as np
+        block = self.layers[layer].isel(y=slice(window[0], window[1]), x=slice(window[2], window[3]))
+        # chunks are already tasks of the mosaic, read the window in the calling thread
+        return np.asarray(block.load(scheduler='synchronous').values)
+
+
+def _mosaic_chunk(sources: List[_Source], target: Grid, window: Tuple[int, int, int, int], layers: List[str],
+                  dtypes: Dict[str, str], fills: Dict[str, float], score: Callable,
+                  cache: GeometryCache) -> Dict[str, 'np.ndarray']:
+    # composite of the sources in one target window, the sources are in time order and ties go to the latest
+    import numpy as np
+    shape = (window[1] - window[0], window[3] - window[2])
+    out = {layer: np.full(shape, fills[layer], dtype=dtypes[layer]) for layer in layers}
+    out['source'] = np.full(shape, _no_source, dtype='uint16')
+    best = np.full(shape, 255, dtype='uint8')
+    with metrics.timer('mosaic.chunk'):
+        for i, source in enumerate(sources):
+            mapping = cache.get(source.grid, target, window)
+            if mapping.empty:
+                continue
+            values = {}
+            for layer in source.layers:
+                block = source.read(layer, mapping.window)
+                values[layer] = block[mapping.rows, mapping.cols]
+                metrics.add_bytes('mosaic.read', block.nbytes)
+            source_score = np.where(mapping.valid, score(values), 255).astype('uint8')
+            better = (source_score <= best) & (source_score < 255)
+            for layer, value in values.items():
+                if layer in out:
+                    out[layer][better] = value[better]
+            out['source'][better] = i
+            best = np.where(better, source_score, best)
+    return out
+
+
+def mosaic(data_sets: List['xr.Dataset'], grid: Grid, layers: List[str] = None, chunk_size: int = 512,
+           score: Callable = qc_score, cache: GeometryCache = None) -> 'xr.Dataset':
+    """
+    Lazy mosaic of granule data sets (e.g. from Granule.get_xarray) on a common grid.
+
+    Every chunk of the grid is an independent task that reads only the source windows it needs, reprojects them
+    (nearest neighbour, with the warp geometry from the cache) and composites them pixel by pixel: the source with
+    the best score wins (see qc_score), the latest one on ties, and all layers come from the same source. Memory
+    use depends on chunk_size and the number of sources, not on the size of the grid.
+
+    Args:
+        data_sets: georeferenced granule data sets
+        grid: target grid
+        layers: layers to mosaic, all the layers of the first data set if None
+        chunk_size: chunk size (pixels) of the mosaic
+        score: function of the source values of a window (by layer) returning the priority of each pixel
+        cache: cache of the warp geometry, the module cache if None
+
+    Returns: xr.Dataset with the layers and a 'source' layer, the index of the data set (in attrs['sources'])
+    used for each pixel
+    """
+    import numpy as np
+    import dask
+    import dask.array as da
+    import xarray as xr
+    import rioxarray  # registers the .rio accessor
+    cache = default_cache if cache is None else cache
+    data_sets = sorted(data_sets, key=lambda d: np.datetime64(d['time'].values.ravel()[0]) if 'time' in d.coords
+                       else np.datetime64('NaT'))
+    layers = layers or [v for v in data_sets[0].data_vars if {'y', 'x'} <= set(data_sets[0][v].dims)]
+    sources = [_Source(data_set, layers) for data_set in data_sets]
+    dtypes, fills = {}, {}
+    for layer in layers:
+        data_array = next(d[layer] for d in data_sets if layer in d)
+        dtypes[layer] = data_array.dtype.name
+        nodata = data_array.rio.nodata
+        fills[layer] = nodata if nodata is not None else (np.nan if data_array.dtype.kind == 'f' else 0)
+    dtypes['source'] = 'uint16'
+    windows = grid.windows(chunk_size)
+    n_rows = len(range(0, grid.height, chunk_size))
+    n_cols = len(range(0, grid.width, chunk_size))
+    blocks = {layer: [[None] * n_cols for _ in range(n_rows)] for layer in layers + ['source']}
+    for window in windows:
+        chunk = dask.delayed(_mosaic_chunk, pure=True)(sources, grid, window, layers, dtypes, fills, score, cache)
+        shape = (window[1] - window[0], window[3] - window[2])
+        for layer in blocks:
+            block = da.from_delayed(chunk[layer], shape=shape, dtype=dtypes[layer])
+            blocks[layer][window[0] // chunk_size][window[2] // chunk_size] = block
+    x, y = grid.coords()
+    data_set = xr.Dataset({layer: (('y', 'x'), da.block(rows)) for layer, rows in blocks.items()},
+                          coords={'y': y, 'x': x})
+    for layer in layers:
+        if not np.isnan(fills[layer]):
+            data_set[layer].attrs['_FillValue'] = fills[layer]
+    data_set['source'].attrs['_FillValue'] = _no_source
+    data_set.attrs['sources'] = [source.id for source in sources]
+    data_set = data_set.rio.write_crs(grid.crs).rio.write_transform(grid.transform)
+    if 'time' in data_sets[0].coords:
+        times = [d['time'].values.ravel()[0] for d in data_sets]
+        data_set.attrs['time_start'], data_set.attrs['time_end'] = str(min(times)), str(max(times))
+    return data_set
+
+
+def mosaic_granules(granules: List, bbox: List[float] = None, crs: str = None, resolution: float = 70.,
+                    data_sets: List[str] = None, aws: bool = True, chunk_size: int = 512, **mosaic_options):
+    """
+    Lazy mosaic of granules (one overpass or a time window) over a [min_lon, min_lat, max_lon, max_lat] box, the
+    union of the granule footprints if None. The grid is in the UTM zone of the center of bbox unless crs is
+    given, and aligned to the tiles of that zone.
+
+    Returns: xr.Dataset, see mosaic
+    """
+    if bbox is None:
+        bounds = [g.bounds for g in granules]
+        bbox = [min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds),
+                max(b[3] for b in bounds)]
+    opened = [granule.get_xarray(data_sets=data_sets, aws=aws) for granule in granules]
+    crs = crs or tiles.utm_crs((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+    origin = None
+    for data_set in opened:
+        if data_set.rio.crs.to_string() == crs and data_set.rio.resolution()[0] == resolution:
+            transform = data_set.rio.transform()
+            origin = (transform.c, transform.f)
+            break
+    grid = Grid.from_bounds(bbox, crs=crs, resolution=resolution, origin=origin)
+    logger.debug('Mosaic of %d granules on %s', len(granules), grid)
+    return mosaic(opened, grid, layers=data_sets, chunk_size=chunk_size, **mosaic_options)
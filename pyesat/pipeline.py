@@ -0,0 +1,250 @@
+import time
+import inspect
+import logging
+import datetime
+import concurrent.futures
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from . import credentials
+from . import algorithms
+from . import metrics
+from . import logs
+from . import encoding
+
+logger = logging.getLogger(__name__)
+
+_executors = ['threads', 'processes', 'distributed']
+# number of granule ids a job claim is limited to at a time
+_claim_batch = 500
+
+
+def _accepts(task: Callable, parameter: str) -> bool:
+    # whether task takes a keyword argument named parameter
+    try:
+        parameters = inspect.signature(task).parameters
+    except (TypeError, ValueError):
+        return False
+    return parameter in parameters
+
+
+def zarr_attrs(attrs: Dict) -> Dict:
+    # granule attributes as json serializable values for zarr
+    attrs_ = {}
+    for key, value in attrs.items():
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        elif isinstance(value, (list, tuple)):
+            value = [str(v) for v in value]
+        elif not isinstance(value, (str, int, float, bool)):
+            value = str(value)
+        attrs_[key] = value
+    return attrs_
+
+
+def process_granule(granule, zarr_path: str, data_sets: List[str] = None, aws: bool = True,
+                    mask: Callable = algorithms.mask_clouds, bbox: List[float] = None,
+                    shipped_credentials: Dict = None) -> str:
+    """
+    Read, mask, clip and write one granule to its own zarr store under zarr_path.
+    Each granule is written to a separate store, so tasks never write to the same files.
+
+    Args:
+        granule: Granule from CMRClient.search_granules
+        zarr_path: directory of the granule zarr stores
+        data_sets: layers to read (e.g. ['LST', 'QC', 'cloud']), all if None
+        aws: read from S3 (True) or HTTPS (False)
+        mask: function applied to the data set, or None
+        bbox: [min_lon, min_lat, max_lon, max_lat] to clip to, or None
+        shipped_credentials: credentials from credentials.get_worker_credentials
+
+    Returns: path of the written zarr store
+    """
+    if shipped_credentials:
+        credentials.set_worker_credentials(shipped_credentials)
+    data_set = granule.get_xarray(data_sets=data_sets, aws=aws, verbose=False)
+    if mask is not None:
+        data_set = mask(data_set)
+    if bbox is not None:
+        data_set = data_set.rio.clip_box(*bbox, crs='EPSG:4326')
+    data_set.attrs = zarr_attrs(data_set.attrs)
+    out_path = Path(zarr_path) / f'{granule.id}.zarr'
+    # the runner already parallelizes over granules, keep the writes within a task single threaded
+    encoding.to_zarr(data_set, out_path, mode='w', compute=False).compute(scheduler='synchronous')
+    return out_path.as_posix()
+
+
+class PipelineResult:
+    # accounting of a pipeline run
+    def __init__(self):
+        self.succeeded = {}
+        self.failed = {}
+        self.attempts = {}
+        self.elapsed = 0.
+
+    def __repr__(self):
+        return f'PipelineResult(succeeded={len(self.succeeded)}, failed={len(self.failed)}, elapsed={self.elapsed:.1f}s)'
+
+    def throughput(self) -> float:
+        # granules per second
+        return len(self.succeeded) / self.elapsed if self.elapsed else 0.
+
+
+class PipelineRunner:
+    """
+    Run a per-granule task (by default process_granule: read, mask, clip, write to zarr) over many granules.
+
+    Attributes:
+    - executor (str): 'threads', 'processes' or 'distributed' (a dask.distributed LocalCluster, or the
+      scheduler at `address`)
+    - max_workers (int): number of workers
+    - max_in_flight (int): maximum number of submitted, unfinished tasks (backpressure), default 2 x max_workers
+    - retries (int): number of times a failed task is resubmitted, without a job_state. With a job_state the
+      attempts of the job (JobState.max_attempts, counted across runs) are the only limit: a failed granule is
+      claimed again, after the retry delay, while it has attempts left, so a granule runs at most max_attempts times
+    """
+
+    def __init__(self, executor: str = 'threads', max_workers: int = 4, max_in_flight: int = None,
+                 retries: int = 2, retry_delay: float = 5., daacs=('lpdaac',), address: str = None,
+                 verbose: bool = False):
+        if executor not in _executors:
+            raise ValueError(f'executor must be one of {_executors}, got {executor}')
+        self.executor = executor
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight or 2 * max_workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.daacs = daacs
+        self.address = address
+        self.verbose = verbose
+        self._client = None
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self.executor == 'threads':
+            return concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        if self.executor == 'processes':
+            return concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        # dask.distributed is an optional dependency
+        import distributed
+        if self.address is not None:
+            self._client = distributed.Client(self.address)
+        else:
+            cluster = distributed.LocalCluster(n_workers=self.max_workers, threads_per_worker=1,
+                                               processes=True)
+            self._client = distributed.Client(cluster)
+        return self._client.get_executor(pure=False)
+
+    def _close(self, executor: concurrent.futures.Executor) -> None:
+        executor.shutdown(wait=True)
+        if self._client is not None:
+            cluster = self._client.cluster
+            self._client.close()
+            if cluster is not None and self.address is None:
+                cluster.close()
+            self._client = None
+
+    def run(self, granules: List, task: Callable = process_granule, job_state=None, stage: str = 'process',
+            **task_kwargs) -> PipelineResult:
+        """
+        Submit task(granule, **task_kwargs) for every granule.
+
+        Credentials are collected once here and shipped with every task (as shipped_credentials) when the
+        task accepts them, so that workers never refresh credentials themselves.
+
+        With a job_state (jobs.JobState) the progress of `stage` is recorded in the database: granules completed in
+        an earlier run are skipped, and several processes running the same job claim disjoint sets of granules.
+        Work left by workers that died is requeued when the run starts, and work claimed but not finished when the
+        run is interrupted (an error or Ctrl-C) is released back to the job.
+
+        Returns: PipelineResult with the task results per granule id and the errors of granules that failed
+        after all retries
+        """
+        from . import earthdata
+        result = PipelineResult()
+        # the download status of the granules is read from the catalog in one query here, not by every task
+        earthdata.read_catalog([g for g in granules if isinstance(g, earthdata.Granule) and g._local_path is None])
+        if _accepts(task, 'shipped_credentials') and 'shipped_credentials' not in task_kwargs:
+            task_kwargs['shipped_credentials'] = credentials.get_worker_credentials(self.daacs)
+        by_id = {granule.id: granule for granule in granules}
+        # claims are limited to the granules of this run, a batch of them at a time: granules registered by another
+        # process running the same job are left to that process
+        ids = list(by_id)
+        batches = [ids[i:i + _claim_batch] for i in range(0, len(ids), _claim_batch)]
+        batch = 0
+        if job_state is None:
+            pending = list(granules)[::-1]
+        else:
+            job_state.add(ids, [stage])
+            requeued = job_state.requeue_stale(stage)
+            if requeued:
+                logger.info('Requeued %s granules of stale workers of %s', requeued, job_state.job)
+            pending = []
+        claimable = job_state is not None and bool(batches)
+        retry_at = {}
+        in_flight = {}
+        start = time.time()
+        progress = logs.Progress('granules', total=len(by_id), logger=logger,
+                                 level=logging.INFO if self.verbose else logging.DEBUG)
+        executor = self._get_executor()
+        try:
+            while True:
+                while claimable and len(pending) < self.max_in_flight:
+                    n = self.max_in_flight - len(pending)
+                    claimed = job_state.claim(stage, n=n, granule_ids=batches[batch])
+                    pending.extend(by_id[g] for g in claimed[::-1])
+                    if len(claimed) < n:
+                        # nothing left to claim in this batch
+                        batch = (batch + 1) % len(batches)
+                        claimable = batch != 0
+                if not pending and not in_flight:
+                    break
+                # backpressure: only keep max_in_flight tasks submitted
+                while pending and len(in_flight) < self.max_in_flight:
+                    granule = pending[-1]
+                    delay = retry_at.get(granule.id, 0) - time.time()
+                    if delay > 0:
+                        # retries wait for their delay, unless there is nothing else to wait on
+                        if in_flight:
+                            break
+                        time.sleep(delay)
+                    pending.pop()
+                    retry_at.pop(granule.id, None)
+                    result.attempts[granule.id] = result.attempts.get(granule.id, 0) + 1
+                    in_flight[executor.submit(task, granule, **task_kwargs)] = granule
+                done, _ = concurrent.futures.wait(list(in_flight), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    # an interrupted task stays in flight, so its granule is released
+                    granule = in_flight[future]
+                    try:
+                        result.succeeded[granule.id] = future.result()
+                        result.failed.pop(granule.id, None)
+                        if job_state is not None:
+                            job_state.complete(granule.id, stage)
+                    except Exception as error:
+                        result.failed[granule.id] = repr(error)
+                        metrics.count('pipeline.error')
+                        if job_state is not None:
+                            # the job hands the granule out again if it has attempts left, no retries on top
+                            if job_state.fail(granule.id, stage, repr(error)) == 'pending':
+                                metrics.count('pipeline.retry')
+                                retry_at[granule.id] = time.time() + self.retry_delay * result.attempts[granule.id]
+                            claimable, batch = True, 0
+                        elif result.attempts[granule.id] <= self.retries:
+                            metrics.count('pipeline.retry')
+                            retry_at[granule.id] = time.time() + self.retry_delay * result.attempts[granule.id]
+                            pending.insert(0, granule)
+                    del in_flight[future]
+                    if granule.id not in retry_at:
+                        # finished, without retries left. granule_size of CMR granules is in MB
+                        progress.update(nbytes=int(float(getattr(granule, 'granule_size', 0) or 0) * 1024 ** 2))
+        finally:
+            try:
+                self._close(executor)
+            finally:
+                if job_state is not None:
+                    # granules claimed by this run and not finished go back to the job
+                    job_state.release([g.id for g in pending] + [g.id for g in in_flight.values()], stage)
+        result.elapsed = time.time() - start
+        progress.close()
+        logger.log(progress.level, '%s', result)
+        return result
@@ -0,0 +1,162 @@
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+from typing import Iterable, Iterator, List, TYPE_CHECKING
+
+from . import metrics
+from . import logs
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+_mb = 1024 ** 2
+
+
+class ReadAheadClosed(Exception):
+    pass
+
+
+class ByteBudget:
+    """
+    Bytes held by prefetched data sets, reserved in sequence order: a reservation waits for the ones of the earlier
+    items, so a later item never takes the room an earlier one needs. An item larger than the whole budget is let
+    through when nothing else is held.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = int(max_bytes)
+        self.used = 0
+        self.peak = 0
+        self._next = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def __repr__(self):
+        return f'ByteBudget({self.used / _mb:.1f}/{self.max_bytes / _mb:.1f} MB)'
+
+    def acquire(self, ticket: int, nbytes: int) -> None:
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or (
+                ticket == self._next and (self.used + nbytes <= self.max_bytes or self.used == 0)))
+            if self._closed:
+                raise ReadAheadClosed()
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            self._next += 1
+            self._condition.notify_all()
+
+    def release(self, nbytes: int) -> None:
+        with self._condition:
+            self.used -= nbytes
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class ReadAhead:
+    """
+    Iterate over the data sets of a sequence of granules, loading the next ones in the background while the current
+    one is processed, so that reads (and their time to first byte) overlap with compute.
+
+        for data_set in ReadAhead(granules, data_sets=['LST', 'cloud'], lookahead=4, max_bytes=2 * 1024 ** 3):
+            ...  # data_set is in memory
+
+    Up to lookahead granules are loaded ahead of the one being processed, as long as the data sets loaded and not
+    yet processed fit in max_bytes. A data set counts against the budget until the next one is requested.
+
+    Attributes:
+    - granules (Iterable): granules in processing order, e.g. from search_granules or iter_granules (consumed
+      lazily)
+    - data_sets (List[str]): layers to load, all if None
+    - aws (bool): read from S3 (True) or HTTPS (False)
+    - bbox (List[float]): [min_lon, min_lat, max_lon, max_lat], only load the window of the granules within it
+    - lookahead (int): number of granules loaded ahead
+    - max_bytes (int): budget of the loaded data sets
+    - workers (int): number of granules loaded at the same time
+    """
+
+    def __init__(self, granules: Iterable, data_sets: List[str] = None, aws: bool = True, bbox: List[float] = None,
+                 lookahead: int = 4, max_bytes: int = 2048 * _mb, workers: int = 2, verbose: bool = False):
+        self.granules = granules
+        self.data_sets = data_sets
+        self.aws = aws
+        self.bbox = bbox
+        self.lookahead = max(1, lookahead)
+        self.max_bytes = max_bytes
+        self.workers = max(1, workers)
+        self.verbose = verbose
+        self.budget = None
+        self.wait_time = 0.
+
+    def __repr__(self):
+        return f'ReadAhead(lookahead={self.lookahead}, max_bytes={self.max_bytes}, workers={self.workers})'
+
+    def _open(self, granule) -> 'xr.Dataset':
+        data_set = granule.get_xarray(data_sets=self.data_sets, aws=self.aws, verbose=False)
+        if self.bbox is not None:
+            data_set = data_set.rio.clip_box(*self.bbox, crs='EPSG:4326')
+        return data_set
+
+    def _load(self, granule, ticket: int):
+        try:
+            # opening only reads the headers, the size of the data set is known before it is loaded
+            data_set = self._open(granule)
+            nbytes = data_set.nbytes
+        except BaseException:
+            self.budget.acquire(ticket, 0)  # pass the turn
+            raise
+        self.budget.acquire(ticket, nbytes)
+        try:
+            # the read-ahead parallelizes over granules, load the layers of one granule in its own thread
+            with metrics.timer('prefetch.load'):
+                data_set = data_set.load(scheduler='synchronous')
+        except BaseException:
+            self.budget.release(nbytes)
+            raise
+        metrics.add_bytes('prefetch', nbytes)
+        return data_set, nbytes
+
+    def __iter__(self) -> Iterator['xr.Dataset']:
+        self.budget = ByteBudget(self.max_bytes)
+        self.wait_time = 0.
+        granules = iter(self.granules)
+        in_flight = collections.deque()
+        ticket = 0
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        level = logging.INFO if self.verbose else logging.DEBUG
+
+        def _fill():
+            nonlocal ticket
+            while len(in_flight) < self.lookahead:
+                granule = next(granules, None)
+                if granule is None:
+                    return
+                in_flight.append(executor.submit(self._load, granule, ticket))
+                ticket += 1
+        try:
+            with logs.Progress('granules', logger=logger, level=level) as progress:
+                _fill()
+                while in_flight:
+                    start = time.perf_counter()
+                    with metrics.timer('prefetch.wait'):
+                        data_set, nbytes = in_flight.popleft().result()
+                    self.wait_time += time.perf_counter() - start
+                    # start the next read before handing out the data set
+                    _fill()
+                    try:
+                        yield data_set
+                    finally:
+                        self.budget.release(nbytes)
+                    progress.update(nbytes=nbytes)
+        finally:
+            self.budget.close()
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
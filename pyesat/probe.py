@@ -0,0 +1,388 @@
+import json
+import math
+import struct
+import logging
+import pathlib
+import concurrent.futures
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.dialects.sqlite import insert
+
+from . import earthdata
+from . import blockcache
+from . import cache
+from . import metrics
+from . import logs
+
+logger = logging.getLogger(__name__)
+
+# the IFDs of all the levels of a GDAL COG come first in the file, the 70 m layers need a few KB
+_header_bytes = 16 * 1024
+
+# TIFF field types: (struct format, size)
+_types = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 7: ('B', 1), 8: ('h', 2),
+          9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+_compressions = {1: 'NONE', 5: 'LZW', 7: 'JPEG', 8: 'DEFLATE', 32773: 'PACKBITS', 32946: 'DEFLATE', 34887: 'LERC',
+                 50000: 'ZSTD', 50001: 'WEBP'}
+_sample_formats = {1: 'uint', 2: 'int', 3: 'float'}
+# tags of the header
+_new_subfile_type = 254
+_image_width = 256
+_image_length = 257
+_bits_per_sample = 258
+_compression = 259
+_samples_per_pixel = 277
+_rows_per_strip = 278
+_tile_width = 322
+_tile_length = 323
+_sample_format = 339
+_model_pixel_scale = 33550
+_model_tiepoint = 33922
+_model_transformation = 34264
+_geo_key_directory = 34735
+_gdal_nodata = 42113
+# GeoKeys
+_model_type_key = 1024
+_raster_type_key = 1025
+_geographic_type_key = 2048
+_projected_type_key = 3072
+_pixel_is_point = 2
+_user_defined = 32767
+
+
+class NeedMoreBytes(Exception):
+    # the header extends past the bytes read so far
+    def __init__(self, size: int):
+        super().__init__(f'header needs {size} bytes')
+        self.size = size
+
+
+class LayerHeader(earthdata.base):
+    """
+    Grid and storage layout of one layer (COG) of a granule, read from its TIFF header.
+
+    Attributes:
+    - file_name (str): file name of the layer, the same for its S3 and HTTPS urls
+    - granule_id (str): id of the granule
+    - layer (str): layer name (LST, QC, cloud, ...)
+    - width, height, count (int): raster size and number of bands
+    - dtype (str): numpy dtype of the pixels
+    - block_width, block_height (int): internal tile (or strip) size
+    - crs (str): e.g. EPSG:32618, None for CRSs without an EPSG code
+    - transform (str): json list of the affine transform (a, b, c, d, e, f), as rasterio's Affine
+    - nodata (str): nodata value, None if not set
+    - compression (str): e.g. DEFLATE
+    - overviews (int): number of overview levels
+    - header_bytes (int): bytes read to parse the header
+    """
+    __tablename__ = 'layer_headers'
+    file_name = Column(String, primary_key=True)
+    granule_id = Column(String, index=True)
+    layer = Column(String)
+    url = Column(String)
+    width = Column(Integer)
+    height = Column(Integer)
+    count = Column(Integer)
+    dtype = Column(String)
+    block_width = Column(Integer)
+    block_height = Column(Integer)
+    crs = Column(String)
+    transform = Column(String)
+    nodata = Column(String)
+    compression = Column(String)
+    overviews = Column(Integer)
+    header_bytes = Column(Integer)
+    probed = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'{self.file_name} | {self.width}x{self.height} {self.dtype} | {self.crs} | {self.affine}'
+
+    @property
+    def affine(self) -> Tuple[float, ...]:
+        return tuple(json.loads(self.transform))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.height, self.width
+
+    @property
+    def block_shape(self) -> Tuple[int, int]:
+        return self.block_height, self.block_width
+
+    @property
+    def nodata_value(self) -> float:
+        return None if self.nodata is None else float(self.nodata)
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        # (left, bottom, right, top) in the CRS of the layer, for north-up grids
+        a, _, c, _, e, f = self.affine
+        return c, f + e * self.height, c + a * self.width, f
+
+    @property
+    def grid(self) -> Tuple:
+        # layers with the same grid line up pixel for pixel
+        return self.crs, self.affine, self.width, self.height
+
+    def values(self) -> Dict:
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+def _read_values(data: bytes, order: str, field_type: int, count: int, offset: int):
+    fmt, size = _types[field_type]
+    end = offset + size * count
+    if end > len(data):
+        raise NeedMoreBytes(end)
+    if field_type == 2:
+        return data[offset:end].split(b'\0')[0].decode('ascii', 'replace')
+    if field_type in (5, 10):
+        values = struct.unpack(f'{order}{2 * count}{fmt[0]}', data[offset:end])
+        return [n / d if d else math.nan for n, d in zip(values[::2], values[1::2])]
+    return list(struct.unpack(f'{order}{count}{fmt}', data[offset:end]))
+
+
+def _read_ifd(data: bytes, order: str, big: bool, offset: int, tags: List[int]) -> Tuple[Dict[int, object], int]:
+    # values of the requested tags of the IFD at offset, and the offset of the next IFD
+    count_fmt, entry_size, value_size = ('Q', 20, 8) if big else ('H', 12, 4)
+    count_size = 8 if big else 2
+    if offset + count_size > len(data):
+        raise NeedMoreBytes(offset + count_size)
+    n_entries = struct.unpack(f'{order}{count_fmt}', data[offset:offset + count_size])[0]
+    end = offset + count_size + n_entries * entry_size + value_size
+    if end > len(data):
+        raise NeedMoreBytes(end)
+    values = {}
+    entry_fmt = f'{order}HHQ' if big else f'{order}HHI'
+    for i in range(n_entries):
+        entry = offset + count_size + i * entry_size
+        tag, field_type, count = struct.unpack(entry_fmt, data[entry:entry + entry_size - value_size])
+        if tag not in tags or field_type not in _types:
+            continue
+        value_offset = entry + entry_size - value_size
+        if _types[field_type][1] * count > value_size:
+            value_offset = struct.unpack(f'{order}{"Q" if big else "I"}', data[value_offset:value_offset + value_size])[0]
+        values[tag] = _read_values(data, order, field_type, count, value_offset)
+    next_ifd = struct.unpack(f'{order}{"Q" if big else "I"}', data[end - value_size:end])[0]
+    return values, next_ifd
+
+
+def _geo_keys(directory: List[int]) -> Dict[int, int]:
+    # GeoKeys stored in the directory itself (the EPSG codes and model and raster types are)
+    keys = {}
+    for i in range(4, 4 + 4 * directory[3], 4):
+        key, location, _, value = directory[i:i + 4]
+        if location == 0:
+            keys[key] = value
+    return keys
+
+
+def _transform(tags: Dict[int, object], pixel_is_point: bool) -> List[float]:
+    if _model_transformation in tags:
+        m = tags[_model_transformation]
+        a, b, c, d, e, f = m[0], m[1], m[3], m[4], m[5], m[7]
+    elif _model_pixel_scale in tags and _model_tiepoint in tags:
+        sx, sy = tags[_model_pixel_scale][:2]
+        i, j, _, x, y, _ = tags[_model_tiepoint][:6]
+        a, b, c, d, e, f = sx, 0., x - i * sx, 0., -sy, y + j * sy
+    else:
+        return None
+    if pixel_is_point:
+        # as GDAL, the transform refers to the corner of the pixels
+        c, f = c - a / 2 - b / 2, f - d / 2 - e / 2
+    return [a, b, c, d, e, f]
+
+
+def parse_header(data: bytes) -> Dict:
+    """
+    Parse the header of a (Big)TIFF/COG: size, dtype, blocks, compression, georeferencing and number of overviews.
+
+    Raises NeedMoreBytes with the size to read when data doesn't hold the whole header.
+
+    Returns: Dict of LayerHeader columns
+    """
+    if data[:2] not in (b'II', b'MM') or len(data) < 16:
+        raise ValueError('not a TIFF file')
+    order = '<' if data[:2] == b'II' else '>'
+    version = struct.unpack(f'{order}H', data[2:4])[0]
+    if version == 42:
+        big, offset = False, struct.unpack(f'{order}I', data[4:8])[0]
+    elif version == 43:
+        big, offset = True, struct.unpack(f'{order}Q', data[8:16])[0]
+    else:
+        raise ValueError(f'not a TIFF file (version {version})')
+    tags = [_new_subfile_type, _image_width, _image_length, _bits_per_sample, _compression, _samples_per_pixel,
+            _rows_per_strip, _tile_width, _tile_length, _sample_format, _model_pixel_scale, _model_tiepoint,
+            _model_transformation, _geo_key_directory, _gdal_nodata]
+    first, next_ifd = _read_ifd(data, order, big, offset, tags)
+    # the following IFDs are the overviews and masks
+    overviews = 0
+    while next_ifd:
+        ifd, next_ifd = _read_ifd(data, order, big, next_ifd, [_new_subfile_type])
+        overviews += ifd.get(_new_subfile_type, [0])[0] == 1
+    geo_keys = _geo_keys(first[_geo_key_directory]) if _geo_key_directory in first else {}
+    epsg = geo_keys.get(_projected_type_key) if geo_keys.get(_model_type_key) == 1 \
+        else geo_keys.get(_geographic_type_key)
+    transform = _transform(first, geo_keys.get(_raster_type_key) == _pixel_is_point)
+    width, height = first[_image_width][0], first[_image_length][0]
+    bits = first.get(_bits_per_sample, [1])[0]
+    nodata = first.get(_gdal_nodata)
+    return {
+        'width': width,
+        'height': height,
+        'count': first.get(_samples_per_pixel, [1])[0],
+        'dtype': f'{_sample_formats.get(first.get(_sample_format, [1])[0], "uint")}{bits}',
+        'block_width': first[_tile_width][0] if _tile_width in first else width,
+        'block_height': first[_tile_length][0] if _tile_length in first
+        else min(first.get(_rows_per_strip, [height])[0], height),
+        'crs': f'EPSG:{epsg}' if epsg and epsg != _user_defined else None,
+        'transform': json.dumps(transform) if transform else None,
+        'nodata': nodata.strip() if nodata else None,
+        'compression': _compressions.get(first.get(_compression, [1])[0], str(first.get(_compression, [1])[0])),
+        'overviews': overviews,
+    }
+
+
+def _layer_name(url: str) -> str:
+    # as Granule.get_xarray
+    return url.split('_')[-1].replace('.tif', '')
+
+
+def read_header(url: str, fetcher: blockcache.RangeFetcher = None, header_bytes: int = _header_bytes) -> Dict:
+    """
+    Read the header of a local or remote (S3 or HTTPS) COG with one range request of header_bytes, and another one
+    for the rest of the header in the rare case it's larger.
+
+    Returns: Dict of LayerHeader columns
+    """
+    def _fetch(start, end):
+        if '://' not in url:
+            with open(url, 'rb') as f:
+                f.seek(start)
+                return f.read(end - start + 1)
+        return (fetcher or blockcache.RangeFetcher()).fetch(url, start, end)
+
+    with metrics.timer('probe.header'):
+        data = _fetch(0, header_bytes - 1)
+        while True:
+            try:
+                values = parse_header(data)
+                break
+            except NeedMoreBytes as e:
+                if len(data) < header_bytes and e.size > len(data):
+                    raise ValueError(f'truncated TIFF header in {url}')
+                # read ahead, the tag data of the overviews follows
+                more = _fetch(len(data), max(e.size, 2 * len(data)) - 1)
+                if not more:
+                    raise ValueError(f'truncated TIFF header in {url}')
+                data += more
+                header_bytes = len(data)
+                metrics.count('probe.refetch')
+    metrics.add_bytes('probe', len(data))
+    values.update({'url': url, 'file_name': cache.file_name_from_url(url), 'layer': _layer_name(url),
+                   'header_bytes': len(data)})
+    return values
+
+
+class HeaderCatalog:
+    # layer headers in the pyesat database, by file name
+    def __init__(self, db_path: pathlib.Path = earthdata.db_path):
+        self.engine = earthdata.get_engine(db_path)
+        LayerHeader.__table__.create(self.engine, checkfirst=True)
+
+    def get(self, file_names: List[str]) -> Dict[str, LayerHeader]:
+        headers = {}
+        with sqlalchemy.orm.Session(self.engine, expire_on_commit=False) as session:
+            # stay below the sqlite limit of bound parameters
+            for i in range(0, len(file_names), 500):
+                query = sqlalchemy.select(LayerHeader).where(LayerHeader.file_name.in_(file_names[i:i + 500]))
+                headers.update({h.file_name: h for h in session.scalars(query)})
+        return headers
+
+    def put(self, headers: List[LayerHeader]) -> None:
+        rows = [h.values() for h in headers]
+        if not rows:
+            return
+        statement = insert(LayerHeader)
+        statement = statement.on_conflict_do_update(
+            index_elements=['file_name'], set_={c: statement.excluded[c] for c in rows[0] if c != 'file_name'})
+        with self.engine.begin() as connection:
+            connection.execute(statement, rows)
+
+    def granule_headers(self, granule_id: str) -> Dict[str, LayerHeader]:
+        with sqlalchemy.orm.Session(self.engine, expire_on_commit=False) as session:
+            query = sqlalchemy.select(LayerHeader).where(LayerHeader.granule_id == granule_id)
+            return {h.layer: h for h in session.scalars(query)}
+
+
+def probe_granules(granules: List, data_sets: List[str] = None, aws: bool = True, catalog: HeaderCatalog = None,
+                   refresh: bool = False, max_workers: int = 16, header_bytes: int = _header_bytes,
+                   verbose: bool = False) -> Dict[str, Dict[str, LayerHeader]]:
+    """
+    Headers of the layers of many granules, without opening the rasters: served from the catalog, or read with one
+    small range request per layer and added to the catalog.
+
+    Args:
+        granules: Granules from CMRClient.search_granules
+        data_sets: layers to probe (e.g. ['LST', 'QC']), all if None
+        aws: read from S3 (True) or HTTPS (False)
+        catalog: catalog of the headers, the pyesat database if None
+        refresh: probe the layers again even if they are in the catalog
+        max_workers: number of concurrent requests
+
+    Returns: Dict of granule id -> layer -> LayerHeader, without the layers that could not be probed
+    """
+    catalog = HeaderCatalog() if catalog is None else catalog
+    layers = []
+    links = earthdata.resolve_links(granules, aws=aws)
+    for granule in granules:
+        for url in links[granule.id]:
+            if data_sets is None or _layer_name(url) in data_sets:
+                layers.append((granule.id, url))
+    cached = {} if refresh else catalog.get([cache.file_name_from_url(url) for _, url in layers])
+    results = {granule.id: {} for granule in granules}
+    to_probe = []
+    for granule_id, url in layers:
+        header = cached.get(cache.file_name_from_url(url))
+        if header is None:
+            to_probe.append((granule_id, url))
+        else:
+            results[granule_id][header.layer] = header
+    metrics.count('probe_cache.hit', len(layers) - len(to_probe))
+    metrics.count('probe_cache.miss', len(to_probe))
+    fetcher = blockcache.RangeFetcher()
+    level = logging.INFO if verbose else logging.DEBUG
+    probed = []
+    with logs.Progress('headers', total=len(to_probe), logger=logger, level=level) as progress, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(read_header, url, fetcher, header_bytes): (granule_id, url)
+                   for granule_id, url in to_probe}
+        for future in concurrent.futures.as_completed(futures):
+            granule_id, url = futures[future]
+            try:
+                header = LayerHeader(granule_id=granule_id, **future.result())
+            except Exception as e:
+                # a bad or forbidden layer is left out, the headers of the others are still stored
+                logger.warning('Could not probe %s: %r', url, e)
+                metrics.count('probe.error')
+                progress.update()
+                continue
+            results[header.granule_id][header.layer] = header
+            probed.append(header)
+            progress.update(nbytes=header.header_bytes)
+    catalog.put(probed)
+    return results
+
+
+def group_by_grid(headers: Dict[str, Dict[str, LayerHeader]]) -> Dict[Tuple, List[str]]:
+    # granule ids by grid (crs, transform, width, height) of their layers, one group per grid for aligned granules
+    grids = {}
+    for granule_id, layers in headers.items():
+        for header in layers.values():
+            granule_ids = grids.setdefault(header.grid, [])
+            if granule_id not in granule_ids:
+                granule_ids.append(granule_id)
+    return grids
@@ -0,0 +1,213 @@
+import os
+import uuid
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Tuple, TYPE_CHECKING
+
+from . import credentials
+from . import metrics
+
+if TYPE_CHECKING:
+    import numpy as np
+    import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+# tmpfs: files there are shared memory, with no disk behind them
+_shm_dir = Path('/dev/shm')
+
+
+def default_root() -> Path:
+    root = _shm_dir if _shm_dir.is_dir() else Path(tempfile.gettempdir())
+    return root / f'pyesat-{os.getuid() if hasattr(os, "getuid") else "shm"}'
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def cleanup_stale(root: Path = None) -> int:
+    # remove the arenas left by processes that died without closing them, returns the number removed
+    root = Path(root) if root is not None else default_root()
+    removed = 0
+    for path in root.glob('*-*'):
+        pid = path.name.split('-')[0]
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            shutil.rmtree(path.as_posix(), ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class SharedArray:
+    """
+    Handle of a numpy array in shared memory (a memory-mapped file in an arena). The handle pickles as its path,
+    shape and dtype, so passing it to or from another process copies no data; open() maps the same memory.
+
+    Views stay valid after release(): the memory is freed once the file is removed and the last view is gone.
+    """
+
+    def __init__(self, path: Path, shape: Tuple[int, ...], dtype: str):
+        self.path = Path(path)
+        self.shape = tuple(shape)
+        self.dtype = dtype
+
+    def __repr__(self):
+        return f'SharedArray({self.path.name}, {self.shape}, {self.dtype})'
+
+    @property
+    def nbytes(self) -> int:
+        import numpy as np
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def open(self, writable: bool = False) -> 'np.ndarray':
+        import numpy as np
+        if self.nbytes == 0:
+            return np.empty(self.shape, dtype=self.dtype)
+        return np.memmap(self.path.as_posix(), dtype=self.dtype, mode='r+' if writable else 'r', shape=self.shape)
+
+    def release(self) -> None:
+        self.path.unlink(missing_ok=True)
+        metrics.count('shm.release')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class SharedDataset:
+    """
+    Handle of a data set whose data variables are in shared memory, the coordinates and attributes travel with the
+    handle. open() returns the data set backed by the shared memory, without copies.
+    """
+
+    def __init__(self, template: 'xr.Dataset', variables: Dict[str, Tuple[Tuple[str, ...], Dict, SharedArray]]):
+        self.template = template
+        self.variables = variables
+
+    def __repr__(self):
+        return f'SharedDataset({list(self.variables)}, {self.nbytes / 1024 ** 2:.1f} MB)'
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for _, _, array in self.variables.values())
+
+    def open(self, writable: bool = False) -> 'xr.Dataset':
+        data_set = self.template.copy()
+        for name, (dims, attrs, array) in self.variables.items():
+            data_set[name] = (dims, array.open(writable=writable), attrs)
+        return data_set
+
+    def release(self) -> None:
+        for _, _, array in self.variables.values():
+            array.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class SharedArena:
+    """
+    Directory of shared memory buffers owned by one process, e.g. the parent of a process pool. Workers get the
+    arena (it pickles as its path) and create their buffers in it, the consumer releases each buffer when done,
+    and closing the arena frees whatever is left. Arenas of processes that died are removed by cleanup_stale.
+
+        with SharedArena() as arena:
+            handles = pool.map(functools.partial(read_shared, arena=arena, data_sets=['LST']), granules)
+            for handle in handles:
+                with handle:
+                    process(handle.open())
+    """
+
+    def __init__(self, root: Path = None):
+        root = Path(root) if root is not None else default_root()
+        self.path = root / f'{os.getpid()}-{uuid.uuid4().hex[:12]}'
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.path.chmod(0o700)
+
+    def __repr__(self):
+        return f'SharedArena({self.path})'
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+
+    def empty(self, shape: Tuple[int, ...], dtype: str) -> SharedArray:
+        # allocate a buffer, written in place through open(writable=True)
+        import numpy as np
+        array = SharedArray(self.path / f'{os.getpid()}-{uuid.uuid4().hex}.buf', shape, np.dtype(dtype).name)
+        with open(array.path.as_posix(), 'wb') as f:
+            f.truncate(array.nbytes)
+        metrics.add_bytes('shm', array.nbytes)
+        return array
+
+    def share(self, array: 'np.ndarray') -> SharedArray:
+        shared = self.empty(array.shape, array.dtype)
+        if shared.nbytes:
+            shared.open(writable=True)[...] = array
+        return shared
+
+    def share_dataset(self, data_set: 'xr.Dataset', scheduler: str = None) -> SharedDataset:
+        """
+        Move the data variables of a data set to shared memory. Lazy (dask) variables are computed straight into
+        the shared buffers (with the given dask scheduler, the configured one if None), so a granule read by a worker
+        is decoded once, into memory the consumer maps.
+        """
+        import dask.array as da
+        template = data_set.drop_vars(list(data_set.data_vars))
+        variables = {}
+        for name, data_array in data_set.data_vars.items():
+            shared = self.empty(data_array.shape, data_array.dtype)
+            if shared.nbytes:
+                target = shared.open(writable=True)
+                if isinstance(data_array.data, da.Array):
+                    da.store(data_array.data, target, lock=False, scheduler=scheduler)
+                else:
+                    target[...] = data_array.values
+                target.flush()
+            variables[name] = (data_array.dims, dict(data_array.attrs), shared)
+        return SharedDataset(template, variables)
+
+    def files(self) -> List[Path]:
+        return sorted(self.path.glob('*.buf'))
+
+    def close(self) -> None:
+        shutil.rmtree(self.path.as_posix(), ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_shared(granule, arena: SharedArena, data_sets: List[str] = None, aws: bool = True,
+                bbox: List[float] = None, shipped_credentials: Dict = None) -> SharedDataset:
+    """
+    Pipeline task reading a granule (clipped to bbox) into shared memory, e.g.
+    PipelineRunner('processes').run(granules, task=read_shared, arena=arena, data_sets=['LST', 'QC']).
+
+    Returns: SharedDataset, to be released by the consumer
+    """
+    if shipped_credentials:
+        credentials.set_worker_credentials(shipped_credentials)
+    with metrics.timer('shm.read'):
+        data_set = granule.get_xarray(data_sets=data_sets, aws=aws, verbose=False)
+        if bbox is not None:
+            data_set = data_set.rio.clip_box(*bbox, crs='EPSG:4326')
+        # the runner already parallelizes over granules, decode the layers of one granule in its own thread
+        return arena.share_dataset(data_set, scheduler='synchronous')
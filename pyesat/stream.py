@@ -0,0 +1,156 @@
+import queue
+import logging
+import threading
+import collections
+import concurrent.futures
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List
+
+from . import pipeline
+from . import logs
+from . import encoding
+
+logger = logging.getLogger(__name__)
+
+# marks the end of a buffered stream
+_done = object()
+
+
+class _Error:
+    # exception raised in a buffering thread, re-raised in the consumer
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _buffered(source: Iterable, size: int) -> Iterator:
+    # run the source in a background thread, holding at most size items that haven't been consumed yet
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        # wait for room in the queue, give up if the consumer has stopped
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill():
+        try:
+            for item in source:
+                if not _put(item):
+                    return
+            _put(_done)
+        except BaseException as error:
+            _put(_Error(error))
+
+    thread = threading.Thread(target=_fill, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _done:
+                return
+            if isinstance(item, _Error):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+
+def _mapped(source: Iterable, fn: Callable, workers: int, size: int) -> Iterator:
+    # apply fn to the items of source in a thread pool, in order, with at most size items in flight
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = collections.deque()
+        for item in source:
+            in_flight.append(executor.submit(fn, item))
+            if len(in_flight) >= size:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+class Stream:
+    """
+    Composable, lazy pipeline of stages, e.g. search pages -> granules -> lazy data sets -> transforms -> sink.
+
+    Each stage holds a bounded number of items, so a long job only keeps a fixed number of granules in flight and
+    a slow sink throttles the stages upstream of it (nothing is pulled from a stage until there is room for it).
+
+        stream = (Stream(client.iter_granules(bbox, date_range))
+                  .prefetch(8)
+                  .map(open_granule(['LST', 'cloud']), workers=4)
+                  .map(algorithms.mask_clouds)
+                  .sink(ZarrSink('out')))
+    """
+
+    def __init__(self, source: Iterable):
+        self.source = source
+
+    def __iter__(self) -> Iterator:
+        return iter(self.source)
+
+    def prefetch(self, size: int = 8) -> 'Stream':
+        # read ahead up to size items from the previous stage in a background thread
+        return Stream(_buffered(self.source, size))
+
+    def map(self, fn: Callable, workers: int = 1, buffer: int = None) -> 'Stream':
+        # apply fn to every item, with `workers` threads and at most workers + buffer items in flight
+        if workers <= 1 and not buffer:
+            return Stream(fn(item) for item in self.source)
+        return Stream(_mapped(self.source, fn, workers, workers + (buffer or workers)))
+
+    def read_ahead(self, **options) -> 'Stream':
+        # load the data sets of a stream of granules ahead of the next stage within a byte budget, options of
+        # prefetch.ReadAhead (data_sets, aws, bbox, lookahead, max_bytes, workers)
+        from . import prefetch
+        return Stream(prefetch.ReadAhead(self.source, **options))
+
+    def filter(self, fn: Callable) -> 'Stream':
+        return Stream(item for item in self.source if fn(item))
+
+    def batch(self, size: int) -> 'Stream':
+        # group items into lists of up to size items
+        def _batches():
+            batch_ = []
+            for item in self.source:
+                batch_.append(item)
+                if len(batch_) == size:
+                    yield batch_
+                    batch_ = []
+            if batch_:
+                yield batch_
+        return Stream(_batches())
+
+    def sink(self, fn: Callable, verbose: bool = False) -> int:
+        # consume the stream with fn, returns the number of items consumed
+        with logs.Progress('items', logger=logger, level=logging.INFO if verbose else logging.DEBUG) as progress:
+            for item in self.source:
+                fn(item)
+                progress.update()
+        return progress.count
+
+    def collect(self) -> List:
+        return list(self.source)
+
+
+def open_granule(data_sets: List[str] = None, aws: bool = True) -> Callable:
+    # stage opening a granule as a lazy data set
+    def _open(granule):
+        return granule.get_xarray(data_sets=data_sets, aws=aws, verbose=False)
+    return _open
+
+
+class ZarrSink:
+    # sink writing each granule data set to its own zarr store under path
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def __call__(self, data_set) -> str:
+        data_set.attrs = pipeline.zarr_attrs(data_set.attrs)
+        out_path = self.path / f"{data_set.attrs['id']}.zarr"
+        encoding.to_zarr(data_set, out_path, mode='w')
+        return out_path.as_posix()
@@ -0,0 +1,250 @@
+import re
+import math
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# MGRS latitude bands (8 degrees from 80S, X is 12 degrees) and 100 km square letters
+_bands = 'CDEFGHJKLMNPQRSTUVWX'
+_column_letters = ['STUVWXYZ', 'ABCDEFGH', 'JKLMNPQR']  # by zone % 3
+_row_letters = 'ABCDEFGHJKLMNPQRSTUV'
+# tile id in the name of the tiled (L2T) granules, e.g. ECOv002_L2T_LSTE_24420_013_18TWL_20221026T142447_0710_01
+_tile_pattern = re.compile(r'_(\d{2}[C-X][A-Z]{2})_')
+_dt_format = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def utm_zone(lon: float, lat: float) -> int:
+    # UTM zone of a point, with the Norway and Svalbard exceptions
+    if 56 <= lat < 64 and 3 <= lon < 12:
+        return 32
+    if 72 <= lat < 84 and 0 <= lon < 42:
+        return 31 + 2 * int((lon + 3) // 12) if lon >= 9 else 31
+    return int((lon + 180) // 6) % 60 + 1
+
+
+def utm_crs(lon: float, lat: float) -> str:
+    return f"EPSG:{(32600 if lat >= 0 else 32700) + utm_zone(lon, lat)}"
+
+
+def _transformer(crs: str):
+    import pyproj
+    return pyproj.Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+
+
+def mgrs_tiles(points: List[Tuple[float, float]]) -> List[str]:
+    """
+    MGRS 100 km tile ids (e.g. 18TWL) of (lon, lat) points, the tiling of the ECOSTRESS Collection 2 tiled products.
+    """
+    tiles = [None] * len(points)
+    by_crs = {}
+    for i, (lon, lat) in enumerate(points):
+        if not -80 <= lat < 84:
+            raise ValueError(f'MGRS tiles cover latitudes 80S to 84N, got {lat}')
+        by_crs.setdefault(utm_crs(lon, lat), []).append(i)
+    for crs, indices in by_crs.items():
+        zone = int(crs[-2:])
+        xs, ys = _transformer(crs).transform([points[i][0] for i in indices], [points[i][1] for i in indices])
+        for i, x, y in zip(indices, xs, ys):
+            lat = points[i][1]
+            band = _bands[min(int((lat + 80) // 8), len(_bands) - 1)]
+            column = _column_letters[zone % 3][int(x // 100000) - 1]
+            row = _row_letters[(int(y // 100000) + (5 if zone % 2 == 0 else 0)) % 20]
+            tiles[i] = f'{zone:02d}{band}{column}{row}'
+    return tiles
+
+
+def mgrs_tile(lon: float, lat: float) -> str:
+    return mgrs_tiles([(lon, lat)])[0]
+
+
+def tile_from_name(name: str) -> Optional[str]:
+    # tile id from a granule or file name, None for non-tiled products
+    match = _tile_pattern.search(name)
+    return match.group(1) if match else None
+
+
+def split_date_range(date_range: str, days: int = None) -> List[str]:
+    # split a CMR 'start,end' temporal range into windows of at most days days
+    if not days:
+        return [date_range]
+    start, end = [datetime.fromisoformat(d.strip().replace('Z', '+00:00')) for d in date_range.split(',')]
+    if start.tzinfo is None:
+        start, end = start.replace(tzinfo=timezone.utc), end.replace(tzinfo=timezone.utc)
+    windows = []
+    while start < end:
+        stop = min(start + timedelta(days=days), end)
+        windows.append(f'{start.strftime(_dt_format)},{stop.strftime(_dt_format)}')
+        start = stop
+    return windows
+
+
+class Site:
+    """
+    A point (lon, lat) or area (bbox: [min_lon, min_lat, max_lon, max_lat]) of interest.
+    """
+
+    def __init__(self, name: str, lon: float = None, lat: float = None, bbox: List[float] = None):
+        if bbox is None and (lon is None or lat is None):
+            raise ValueError('a site needs a point (lon, lat) or a bbox')
+        self.name = name
+        self.lon = lon
+        self.lat = lat
+        self.bbox = list(bbox) if bbox is not None else None
+
+    def __repr__(self):
+        return f'Site({self.name}, {self.bounds})'
+
+    @property
+    def is_point(self) -> bool:
+        return self.bbox is None
+
+    @property
+    def bounds(self) -> List[float]:
+        return [self.lon, self.lat, self.lon, self.lat] if self.is_point else self.bbox
+
+    def sample_points(self, step: float = 0.1) -> List[Tuple[float, float]]:
+        # the point, or a grid over the area (step in degrees, well below the 100 km tile size) including its corners
+        if self.is_point:
+            return [(self.lon, self.lat)]
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        n_lon = max(1, math.ceil((max_lon - min_lon) / step))
+        n_lat = max(1, math.ceil((max_lat - min_lat) / step))
+        return [(min_lon + (max_lon - min_lon) * i / n_lon, min_lat + (max_lat - min_lat) * j / n_lat)
+                for i in range(n_lon + 1) for j in range(n_lat + 1)]
+
+    def intersects(self, bounds: List[float]) -> bool:
+        min_lon, min_lat, max_lon, max_lat = self.bounds
+        return not (bounds[0] > max_lon or bounds[2] < min_lon or bounds[1] > max_lat or bounds[3] < min_lat)
+
+
+class TileQuery:
+    # one CMR query: the granules in one time window intersecting the bounds of the sites in one tile
+    def __init__(self, tile: str, date_range: str, sites: List[Site]):
+        self.tile = tile
+        self.date_range = date_range
+        self.sites = sites
+        bounds = [s.bounds for s in sites]
+        self.bbox = [min(b[0] for b in bounds), min(b[1] for b in bounds),
+                     max(b[2] for b in bounds), max(b[3] for b in bounds)]
+
+    def __repr__(self):
+        return f'TileQuery({self.tile}, {self.date_range}, {len(self.sites)} sites)'
+
+    @property
+    def bbox_str(self) -> str:
+        return ','.join(str(b) for b in self.bbox)
+
+
+class SearchPlanner:
+    """
+    Plans the searches of many sites as one query per MGRS tile and time window, instead of one query per site,
+    and fans the results back out to the sites. Granules shared by several sites are searched, parsed and read once.
+
+    A query is a bbox search of the sites of a tile, not a search of the granules of the tile by name: the tiles
+    overlap by about 10 km, so a site in an overlap strip is also covered by the granules of the neighbouring
+    tile, which may hold overpasses the granules of its own tile don't (e.g. a swath edge clipping the neighbour).
+    Granules found by several queries are kept once, by id.
+
+        planner = SearchPlanner([Site('a', -74.0, 40.7), Site('b', -74.1, 40.8)], client=CMRClient())
+        granules = planner.search('2022-10-01T00:00:00Z,2022-12-31T23:59:59Z')  # {'a': [...], 'b': [...]}
+        for site, granule, data_set in planner.read(granules, data_sets=['LST', 'cloud']):
+            ...
+
+    Attributes:
+    - sites (List[Site]): points and areas of interest
+    - client (CMRClient): client used for the searches
+    - window_days (int): split the date range into windows of at most window_days days, one query each
+    - step (float): sampling step (degrees) of the areas when finding the tiles that cover them
+    """
+
+    def __init__(self, sites: List[Site], client=None, collection_id: str = 'C2076090826-LPCLOUD',
+                 window_days: int = None, step: float = 0.1):
+        self.sites = list(sites)
+        self.client = client
+        self.collection_id = collection_id
+        self.window_days = window_days
+        self.step = step
+
+    def tiles(self) -> Dict[str, List[Site]]:
+        # the tiles covering the sites, with the sites in each tile
+        samples = [(site, point) for site in self.sites for point in site.sample_points(self.step)]
+        tiles = {}
+        for (site, _), tile in zip(samples, mgrs_tiles([point for _, point in samples])):
+            sites = tiles.setdefault(tile, [])
+            if site not in sites:
+                sites.append(site)
+        return dict(sorted(tiles.items()))
+
+    def plan(self, date_range: str) -> List[TileQuery]:
+        windows = split_date_range(date_range, self.window_days)
+        return [TileQuery(tile, window, sites) for tile, sites in self.tiles().items() for window in windows]
+
+    def iter_query(self, query: TileQuery, page_size: int = 500) -> Iterator:
+        # granules intersecting the sites of the tile, including the granules of neighbouring tiles overlapping them
+        with metrics.timer('planner.query'):
+            yield from self.client.iter_granules(query.bbox_str, query.date_range, self.collection_id,
+                                                 page_size=page_size)
+
+    def search(self, date_range: str, page_size: int = 500) -> Dict[str, List]:
+        """
+        Run the planned queries.
+
+        Returns: Dict of site name -> granules intersecting the site, the same Granule object is shared by all the
+        sites it covers
+        """
+        if self.client is None:
+            from . import earthdata
+            self.client = earthdata.CMRClient()
+        plan = self.plan(date_range)
+        results = {site.name: [] for site in self.sites}
+        granules = {}
+        for query in plan:
+            for granule in self.iter_query(query, page_size=page_size):
+                granule = granules.setdefault(granule.id, granule)
+                for site in query.sites:
+                    if site.intersects(granule.bounds) and granule not in results[site.name]:
+                        results[site.name].append(granule)
+        n_site_granules = sum(len(g) for g in results.values())
+        metrics.count('planner.queries', len(plan))
+        metrics.count('planner.shared_granules', n_site_granules - len(granules))
+        logger.debug('%d sites in %d queries: %d granules, %d site granules', len(self.sites), len(plan),
+                     len(granules), n_site_granules)
+        return results
+
+    def read(self, results: Dict[str, List], data_sets: List[str] = None, aws: bool = True) -> Iterator:
+        """
+        Open every granule once and subset it to each of its sites: the nearest pixel of points, clipped to the
+        bbox of areas (lazy, nothing is read until the data is used).
+
+        Yields: (site name, granule, data set)
+        """
+        sites = {site.name: site for site in self.sites}
+        by_granule = {}
+        for name, granules in results.items():
+            for granule in granules:
+                by_granule.setdefault(granule.id, (granule, []))[1].append(sites[name])
+        for granule, granule_sites in by_granule.values():
+            data_set = granule.get_xarray(data_sets=data_sets, aws=aws)
+            for site in granule_sites:
+                subset = subset_site(data_set, site)
+                if subset is not None:
+                    yield site.name, granule, subset
+
+
+def subset_site(data_set, site: Site):
+    # data of a site in a granule data set, None if the site isn't covered by the data set
+    from rioxarray.exceptions import NoDataInBounds
+    if site.is_point:
+        x, y = _transformer(data_set.rio.crs.to_string()).transform(site.lon, site.lat)
+        left, bottom, right, top = data_set.rio.bounds()
+        if not (left <= x <= right and bottom <= y <= top):
+            return None
+        return data_set.sel(x=x, y=y, method='nearest')
+    try:
+        return data_set.rio.clip_box(*site.bbox, crs='EPSG:4326')
+    except NoDataInBounds:
+        return None
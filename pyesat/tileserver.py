@@ -0,0 +1,681 @@
+import abc
+import json
+import math
+import zlib
+import struct
+import asyncio
+import logging
+import threading
+import functools
+import collections
+import urllib.parse
+import concurrent.futures
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+
+from . import metrics
+from . import mosaic
+
+if TYPE_CHECKING:
+    import numpy as np
+    import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+_mb = 1024 ** 2
+_tile_size = 256
+# half the extent of the web mercator (EPSG:3857) tile matrix, in meters
+_half_extent = 20037508.342789244
+_max_zoom = 24
+
+# colormaps as (position, (r, g, b)) stops, interpolated to 256 colors
+_colormaps = {
+    'inferno': [(0., (0, 0, 4)), (.25, (87, 16, 110)), (.5, (188, 55, 84)), (.75, (249, 142, 9)),
+                (1., (252, 255, 164))],
+    'viridis': [(0., (68, 1, 84)), (.25, (59, 82, 139)), (.5, (33, 145, 140)), (.75, (94, 201, 98)),
+                (1., (253, 231, 37))],
+    'coolwarm': [(0., (59, 76, 192)), (.5, (221, 221, 221)), (1., (180, 4, 38))],
+    'gray': [(0., (0, 0, 0)), (1., (255, 255, 255))],
+}
+# default colormap and range of the layers
+_styles = {
+    'LST': ('inferno', 250., 330.),
+    'LST_err': ('viridis', 0., 2.),
+    'err': ('viridis', 0., 2.),
+    'EmisWB': ('viridis', .9, 1.),
+    'height': ('viridis', 0., 3000.),
+    'cloud': ('gray', 0., 1.),
+    'water': ('gray', 0., 1.),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def colormap(name: str) -> 'np.ndarray':
+    # 256 x RGBA lookup table of a colormap, the matplotlib colormaps are used for the other names if installed
+    import numpy as np
+    if name in _colormaps:
+        positions, colors = zip(*_colormaps[name])
+        steps = np.linspace(0., 1., 256)
+        table = np.stack([np.interp(steps, positions, [c[i] for c in colors]) for i in range(3)], axis=-1)
+        return np.concatenate([np.round(table), np.full((256, 1), 255)], axis=-1).astype('uint8')
+    try:
+        import matplotlib
+    except ImportError:
+        raise ValueError(f'unknown colormap {name}, use one of {sorted(_colormaps)}') from None
+    if name not in matplotlib.colormaps:
+        raise ValueError(f'unknown colormap {name}')
+    return (matplotlib.colormaps[name](np.linspace(0., 1., 256)) * 255).round().astype('uint8')
+
+
+class Style:
+    """
+    Colormap and value range of a rendered layer, values outside the range are clipped and missing values are
+    transparent.
+    """
+
+    def __init__(self, cmap: str = 'viridis', vmin: float = 0., vmax: float = 1.):
+        if not vmax > vmin:
+            raise ValueError(f'vmax must be greater than vmin, got {vmin}, {vmax}')
+        colormap(cmap)  # fail early on unknown names
+        self.cmap = cmap
+        self.vmin = float(vmin)
+        self.vmax = float(vmax)
+
+    def __repr__(self):
+        return f'Style({self.cmap}, {self.vmin}, {self.vmax})'
+
+    @classmethod
+    def for_layer(cls, layer: str, cmap: str = None, vmin: float = None, vmax: float = None) -> 'Style':
+        default = _styles.get(layer, ('viridis', 0., 1.))
+        return cls(cmap or default[0], default[1] if vmin is None else vmin, default[2] if vmax is None else vmax)
+
+    @property
+    def key(self) -> Tuple:
+        return self.cmap, self.vmin, self.vmax
+
+    def apply(self, values: 'np.ndarray') -> 'np.ndarray':
+        import numpy as np
+        missing = ~np.isfinite(values)
+        scaled = (np.where(missing, self.vmin, values) - self.vmin) * (255. / (self.vmax - self.vmin))
+        rgba = colormap(self.cmap)[np.clip(scaled, 0, 255).astype('uint8')]
+        rgba[missing] = 0
+        return rgba
+
+
+def encode_png(rgba: 'np.ndarray', level: int = 4) -> bytes:
+    # PNG of a (height, width, 4) uint8 array, with no filtering (one 0 byte before each row)
+    import numpy as np
+    height, width = rgba.shape[:2]
+    raw = np.concatenate([np.zeros((height, 1), dtype='uint8'), rgba.reshape(height, width * 4)], axis=1)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw.tobytes(), level))
+            + chunk(b'IEND', b''))
+
+
+@functools.lru_cache(maxsize=None)
+def empty_tile(size: int = _tile_size) -> bytes:
+    import numpy as np
+    return encode_png(np.zeros((size, size, 4), dtype='uint8'))
+
+
+def tile_grid(z: int, x: int, y: int, size: int = _tile_size) -> mosaic.Grid:
+    # grid of an XYZ (and WMTS GoogleMapsCompatible) tile in EPSG:3857
+    from affine import Affine
+    if not (0 <= z <= _max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise ValueError(f'no tile {z}/{x}/{y}')
+    resolution = 2 * _half_extent / (size * 2 ** z)
+    return mosaic.Grid('EPSG:3857', Affine(resolution, 0., -_half_extent + x * size * resolution, 0., -resolution,
+                                           _half_extent - y * size * resolution), size, size)
+
+
+def tile_latitude(z: int, y: int) -> float:
+    # latitude of the center of a row of tiles
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + .5) / 2 ** z))))
+
+
+def _decode(values: 'np.ndarray', scale_factor: float = None, add_offset: float = None,
+            nodata: float = None) -> 'np.ndarray':
+    # stored values to float32, with NaN for nodata
+    import numpy as np
+    decoded = values.astype('float32')
+    if nodata is not None and not (isinstance(nodata, float) and math.isnan(nodata)):
+        decoded[values == nodata] = np.nan
+    if scale_factor is not None:
+        decoded *= scale_factor
+    if add_offset is not None:
+        decoded += add_offset
+    return decoded
+
+
+class Level:
+    # one resolution of a source: the decimation factor of the full resolution grid and the grid
+    def __init__(self, factor: int, grid: mosaic.Grid, data=None):
+        self.factor = factor
+        self.grid = grid
+        self.data = data
+
+    def __repr__(self):
+        return f'Level({self.factor}, {self.grid})'
+
+
+class TileSource(abc.ABC):
+    """
+    Raster served as tiles, read at the coarsest level (overview) that is at least as fine as the tile.
+
+    Attributes:
+    - name (str): name of the source in the tile urls
+    - variables (List[str]): layers of the source
+    - times (List): time steps, empty for 2D sources
+    - levels (List[Level]): full resolution and overviews, finest first
+    """
+    name = None
+    variables = []
+    times = []
+    levels = []
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.name}, {self.variables}, {len(self.times)} times, ' \
+               f'{[level.factor for level in self.levels]})'
+
+    @abc.abstractmethod
+    def read(self, variable: str, time_index: Optional[int], level: Level,
+             window: Tuple[int, int, int, int]) -> 'np.ndarray':
+        # float32 values of a window (row_start, row_stop, col_start, col_stop) of a level, NaN where missing
+        pass
+
+    @functools.cached_property
+    def bounds_3857(self) -> Tuple[float, float, float, float]:
+        import pyproj
+        grid = self.levels[0].grid
+        left, top = grid.transform * (0, 0)
+        right, bottom = grid.transform * (grid.width, grid.height)
+        transformer = pyproj.Transformer.from_crs(grid.crs, 'EPSG:3857', always_xy=True)
+        return transformer.transform_bounds(left, bottom, right, top, densify_pts=21)
+
+    @functools.cached_property
+    def bounds(self) -> List[float]:
+        # [min_lon, min_lat, max_lon, max_lat]
+        import pyproj
+        transformer = pyproj.Transformer.from_crs('EPSG:3857', 'EPSG:4326', always_xy=True)
+        return list(transformer.transform_bounds(*self.bounds_3857))
+
+    def intersects(self, grid: mosaic.Grid) -> bool:
+        left, top = grid.transform * (0, 0)
+        right, bottom = grid.transform * (grid.width, grid.height)
+        min_x, min_y, max_x, max_y = self.bounds_3857
+        return not (left > max_x or right < min_x or bottom > max_y or top < min_y)
+
+    def level_for(self, z: int, y: int) -> Level:
+        # pixels of the level no larger than the ground size of the tile pixels (web mercator stretches with
+        # latitude), assumes the source is in meters
+        resolution = 2 * _half_extent / (_tile_size * 2 ** z) * math.cos(math.radians(tile_latitude(z, y)))
+        level = self.levels[0]
+        for candidate in self.levels[1:]:
+            if abs(candidate.grid.transform.a) <= resolution:
+                level = candidate
+        return level
+
+    def time_index(self, time: str = None) -> Optional[int]:
+        # index of the time step nearest to an ISO date or time, the latest if None
+        import numpy as np
+        if not len(self.times):
+            return None
+        if time is None:
+            return len(self.times) - 1
+        try:
+            target = np.datetime64(time.replace('Z', ''), 'ns')
+        except ValueError:
+            raise ValueError(f'time must be an ISO date or time, got {time}') from None
+        times = np.asarray(self.times, dtype='datetime64[ns]')
+        return int(np.abs(times - target).argmin())
+
+    def info(self) -> Dict:
+        import numpy as np
+        times = np.datetime_as_string(np.asarray(self.times, dtype='datetime64[ns]'), unit='s')
+        return {'variables': list(self.variables), 'bounds': self.bounds, 'times': [str(t) for t in times],
+                'levels': [level.factor for level in self.levels],
+                'tiles': f'/tiles/{self.name}/{{z}}/{{x}}/{{y}}.png'}
+
+
+def _overview_factors(path: Path) -> List[int]:
+    return sorted(int(p.name) for p in (path / 'overviews').glob('*') if p.is_dir() and p.name.isdigit())
+
+
+def _grid(data_set: 'xr.Dataset') -> mosaic.Grid:
+    return mosaic.Grid(data_set.rio.crs.to_string(), data_set.rio.transform(), data_set.rio.width,
+                       data_set.rio.height)
+
+
+class ZarrSource(TileSource):
+    """
+    Zarr store written by pyesat (write_to_zarr, the pipeline, open_stack/rechunk ...), with the overviews of
+    build_overviews if any. Reads only the chunks of the time step and window of a tile, without dask.
+    """
+
+    def __init__(self, path: Union[str, Path], name: str = None):
+        self.path = Path(path)
+        self.name = name or self.path.stem
+        root = self._open()
+        self.variables = [v for v in root.data_vars if {'y', 'x'} <= set(root[v].dims)]
+        self.times = root['time'].values if 'time' in root.dims else []
+        self.levels = [Level(1, _grid(root), root)]
+        for factor in _overview_factors(self.path):
+            level = self._open(f'overviews/{factor}')
+            self.levels.append(Level(factor, _grid(level), level))
+
+    def _open(self, group: str = None) -> 'xr.Dataset':
+        # lazily indexed raw values, decoded by read
+        import xarray as xr
+        import rioxarray  # registers the .rio accessor
+        return xr.open_zarr(self.path.as_posix(), group=group, chunks=None, mask_and_scale=False,
+                            decode_coords='all')
+
+    def read(self, variable: str, time_index: Optional[int], level: Level,
+             window: Tuple[int, int, int, int]) -> 'np.ndarray':
+        import numpy as np
+        data_array = level.data[variable]
+        if 'time' in data_array.dims:
+            data_array = data_array.isel(time=time_index)
+        values = np.asarray(data_array.isel(y=slice(window[0], window[1]), x=slice(window[2], window[3])).values)
+        attrs = data_array.attrs
+        return _decode(values, attrs.get('scale_factor'), attrs.get('add_offset'),
+                       attrs.get('_FillValue', data_array.encoding.get('_FillValue')))
+
+
+class CogSource(TileSource):
+    """
+    Single band GeoTIFF, e.g. a downloaded granule layer or an export of CogExporter. Low zooms read the internal
+    overviews (GDAL picks them from the size of the read).
+    """
+
+    def __init__(self, path: Union[str, Path], name: str = None):
+        import rasterio
+        self.path = Path(path)
+        self.name = name or self.path.stem
+        # layer name from the file name, as the granule urls: ..._LST.tif
+        self.variables = [self.path.stem.split('_')[-1]]
+        self.times = []
+        self._local = threading.local()
+        with rasterio.open(self.path.as_posix()) as src:
+            self.crs = src.crs.to_string()
+            self.nodata = src.nodata
+            self.scale, self.offset = src.scales[0], src.offsets[0]
+            self.levels = [Level(1, mosaic.Grid(self.crs, src.transform, src.width, src.height))]
+            for factor in src.overviews(1):
+                self.levels.append(Level(factor, mosaic.Grid(self.crs, src.transform * src.transform.scale(factor),
+                                                             src.width // factor, src.height // factor)))
+
+    def _dataset(self):
+        # GDAL datasets are not shared between threads
+        import rasterio
+        if getattr(self._local, 'dataset', None) is None:
+            self._local.dataset = rasterio.open(self.path.as_posix())
+        return self._local.dataset
+
+    def read(self, variable: str, time_index: Optional[int], level: Level,
+             window: Tuple[int, int, int, int]) -> 'np.ndarray':
+        from rasterio.windows import Window
+        from rasterio.enums import Resampling
+        f = level.factor
+        shape = (window[1] - window[0], window[3] - window[2])
+        values = self._dataset().read(1, window=Window(window[2] * f, window[0] * f, shape[1] * f, shape[0] * f),
+                                      out_shape=shape, resampling=Resampling.nearest)
+        return _decode(values, self.scale if self.scale != 1 else None, self.offset or None, self.nodata)
+
+
+def open_source(path: Union[str, Path], name: str = None) -> TileSource:
+    path = Path(path)
+    if path.is_dir():
+        return ZarrSource(path, name=name)
+    return CogSource(path, name=name)
+
+
+def render_tile(source: TileSource, z: int, x: int, y: int, variable: str = None, time_index: int = None,
+                style: Style = None, geometry: mosaic.GeometryCache = None) -> Optional[bytes]:
+    """
+    Render a tile of a source as a PNG, nearest neighbour.
+
+    Returns: the PNG, None if the source doesn't cover the tile
+    """
+    import numpy as np
+    variable = variable or source.variables[0]
+    if variable not in source.variables:
+        raise ValueError(f'{source.name} has no layer {variable}, use one of {source.variables}')
+    style = style or Style.for_layer(variable)
+    geometry = mosaic.default_cache if geometry is None else geometry
+    target = tile_grid(z, x, y)
+    if not source.intersects(target):
+        return None
+    level = source.level_for(z, y)
+    mapping = geometry.get(level.grid, target, (0, target.height, 0, target.width))
+    if mapping.empty:
+        return None
+    with metrics.timer('tileserver.read'):
+        block = source.read(variable, time_index, level, mapping.window)
+    values = np.where(mapping.valid, block[mapping.rows, mapping.cols], np.nan)
+    with metrics.timer('tileserver.encode'):
+        return encode_png(style.apply(values))
+
+
+class TileCache:
+    # least recently used cache of rendered tiles, by size
+    def __init__(self, max_bytes: int = 256 * _mb):
+        self.max_bytes = max_bytes
+        self._tiles = collections.OrderedDict()
+        self._bytes = 0
+
+    def __repr__(self):
+        return f'TileCache({len(self._tiles)} tiles, {self._bytes / _mb:.1f}/{self.max_bytes / _mb:.0f} MB)'
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key: Tuple) -> Optional[bytes]:
+        tile = self._tiles.get(key)
+        if tile is None:
+            metrics.count('tileserver.cache.miss')
+            return None
+        self._tiles.move_to_end(key)
+        metrics.count('tileserver.cache.hit')
+        return tile
+
+    def put(self, key: Tuple, tile: bytes) -> None:
+        if key in self._tiles:
+            self._bytes -= len(self._tiles.pop(key))
+        self._tiles[key] = tile
+        self._bytes += len(tile)
+        while self._bytes > self.max_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._bytes -= len(evicted)
+
+
+_index_html = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>pyesat tiles</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css"/>
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>
+html, body, #map {height: 100%; margin: 0}
+#time {position: absolute; z-index: 1000; top: 10px; left: 60px}
+</style>
+</head><body><div id="map"></div><select id="time"></select><script>
+const map = L.map('map');
+L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {attribution: '&copy; OpenStreetMap'}).addTo(map);
+fetch('sources').then(r => r.json()).then(sources => {
+  const layers = {}, select = document.getElementById('time');
+  let bounds = null;
+  for (const [name, source] of Object.entries(sources)) {
+    for (const variable of source.variables) {
+      layers[name + ' ' + variable] = L.tileLayer(source.tiles + '?variable=' + variable, {maxZoom: 18});
+    }
+    source.times.forEach(t => { if (![...select.options].some(o => o.value === t)) select.add(new Option(t, t)); });
+    const b = L.latLngBounds([source.bounds[1], source.bounds[0]], [source.bounds[3], source.bounds[2]]);
+    bounds = bounds ? bounds.extend(b) : b;
+  }
+  select.selectedIndex = select.options.length - 1;
+  select.onchange = () => Object.values(layers).forEach(
+    l => l.setUrl(l._url.split('&time=')[0] + '&time=' + select.value));
+  Object.values(layers)[0].addTo(map);
+  L.control.layers({}, layers).addTo(map);
+  map.fitBounds(bounds || [[-60, -180], [75, 180]]);
+});
+</script></body></html>
+"""
+
+
+class TileServer:
+    """
+    Local XYZ tile server over Zarr stores and GeoTIFFs (COGs), for web maps (Leaflet, OpenLayers, QGIS XYZ tiles):
+
+        server = TileServer(['stack.zarr', 'ECOv002_L2T_LSTE_..._LST.tif'])
+        server.run(port=8080)  # or port = server.start() to serve from a background thread
+
+    Urls:
+    - /: map of the sources
+    - /sources: sources, with their layers, time steps and bounds (json)
+    - /tiles/<source>/<z>/<x>/<y>.png and /wmts/<source>/<TileMatrix>/<TileRow>/<TileCol>.png (GoogleMapsCompatible),
+      with the optional parameters variable, time (ISO, nearest time step, latest if missing), cmap, vmin and vmax
+
+    Requests are served by an asyncio loop, tiles are rendered in a thread pool and kept in an LRU cache of PNGs;
+    concurrent requests for a tile being rendered wait for the same render.
+
+    Attributes:
+    - sources (Dict[str, TileSource]): sources by name
+    - cache (TileCache): rendered tiles
+    - geometry (GeometryCache): warp geometry of the tiles, shared by the time steps of a source
+    - workers (int): number of tiles rendered at the same time
+    """
+
+    def __init__(self, sources: Union[List, Dict], cache_bytes: int = 256 * _mb, workers: int = 8,
+                 geometry: mosaic.GeometryCache = None, keep_alive: float = 15.):
+        sources = sources.items() if isinstance(sources, dict) else [(None, source) for source in sources]
+        self.sources = {}
+        for name, source in sources:
+            source = source if isinstance(source, TileSource) else open_source(source, name=name)
+            self.sources[source.name] = source
+        self.cache = TileCache(cache_bytes)
+        self.geometry = mosaic.GeometryCache(64 * _mb) if geometry is None else geometry
+        self.workers = workers
+        self.keep_alive = keep_alive
+        self._executor = None
+        self._pending = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def __repr__(self):
+        return f'TileServer({list(self.sources)}, {self.cache})'
+
+    def _render(self, source: TileSource, z: int, x: int, y: int, variable: str, time_index: Optional[int],
+                style: Style) -> bytes:
+        with metrics.timer('tileserver.render'):
+            tile = render_tile(source, z, x, y, variable=variable, time_index=time_index, style=style,
+                               geometry=self.geometry)
+        return empty_tile() if tile is None else tile
+
+    async def tile(self, name: str, z: int, x: int, y: int, params: Dict[str, str] = None) -> bytes:
+        """
+        PNG of a tile, from the cache or rendered.
+
+        Raises: KeyError for unknown sources, ValueError for invalid tiles or parameters
+        """
+        params = params or {}
+        source = self.sources[name]
+        variable = params.get('variable') or source.variables[0]
+        if variable not in source.variables:
+            raise ValueError(f'{name} has no layer {variable}, use one of {source.variables}')
+        style = Style.for_layer(variable, params.get('cmap'),
+                                *[float(params[p]) if params.get(p) else None for p in ['vmin', 'vmax']])
+        time_index = source.time_index(params.get('time'))
+        tile_grid(z, x, y)  # validates the tile
+        key = (name, variable, time_index, z, x, y, style.key)
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+        if key not in self._pending:
+            loop = asyncio.get_running_loop()
+            self._pending[key] = loop.run_in_executor(self._executor, self._render, source, z, x, y, variable,
+                                                      time_index, style)
+        future = self._pending[key]
+        try:
+            tile = await asyncio.shield(future)
+        finally:
+            if self._pending.get(key) is future and future.done():
+                del self._pending[key]
+        self.cache.put(key, tile)
+        return tile
+
+    async def _route(self, method: str, target: str) -> Tuple[int, str, bytes]:
+        if method not in ['GET', 'HEAD']:
+            return 405, 'text/plain', b'method not allowed'
+        url = urllib.parse.urlsplit(target)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        parts = [urllib.parse.unquote(p) for p in url.path.strip('/').split('/')]
+        try:
+            if parts == ['']:
+                return 200, 'text/html; charset=utf-8', _index_html.encode()
+            if parts == ['sources']:
+                info = {name: source.info() for name, source in self.sources.items()}
+                return 200, 'application/json', json.dumps(info).encode()
+            if len(parts) == 5 and parts[0] in ['tiles', 'wmts'] and parts[4].endswith('.png'):
+                z, a, b = int(parts[2]), int(parts[3]), int(parts[4][:-4])
+                x, y = (a, b) if parts[0] == 'tiles' else (b, a)
+                return 200, 'image/png', await self.tile(parts[1], z, x, y, params)
+        except KeyError as e:
+            return 404, 'text/plain', f'unknown source {e}'.encode()
+        except ValueError as e:
+            return 400, 'text/plain', str(e).encode()
+        except Exception:
+            logger.exception('Error serving %s', target)
+            return 500, 'text/plain', b'internal error'
+        return 404, 'text/plain', b'not found'
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # HTTP/1.1 with keep-alive, one request at a time per connection (browsers open several)
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.keep_alive)
+                if not line.strip():
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    method, target, version = None, None, 'HTTP/1.0'
+                headers = {}
+                while True:
+                    header = await asyncio.wait_for(reader.readline(), self.keep_alive)
+                    if header in [b'\r\n', b'\n', b'']:
+                        break
+                    key, _, value = header.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                if method is None:
+                    status, content_type, body = 400, 'text/plain', b'bad request'
+                else:
+                    status, content_type, body = await self._route(method, target)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                head = [f'HTTP/1.1 {status} {_reasons.get(status, "")}', f'Content-Type: {content_type}',
+                        f'Content-Length: {len(body)}', 'Access-Control-Allow-Origin: *',
+                        f'Connection: {"keep-alive" if keep_alive else "close"}']
+                if status == 200 and content_type == 'image/png':
+                    head.append('Cache-Control: max-age=300')
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + (body if method != 'HEAD' else b''))
+                await writer.drain()
+                metrics.count(f'tileserver.status.{status}')
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8080) -> asyncio.AbstractServer:
+        # start serving on the running loop, returns the asyncio server
+        self._executor = self._executor or concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info('Serving %s at http://%s:%d', list(self.sources), host, self.port)
+        return self._server
+
+    @property
+    def port(self) -> Optional[int]:
+        return self._server.sockets[0].getsockname()[1] if self._server is not None else None
+
+    def run(self, host: str = '127.0.0.1', port: int = 8080) -> None:
+        # serve until interrupted
+        async def _run():
+            server = await self.serve(host, port)
+            async with server:
+                await server.serve_forever()
+        try:
+            asyncio.run(_run())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        """
+        Serve from a background thread (e.g. in a notebook), port 0 picks a free port.
+
+        Returns: the port, call stop() to stop serving
+        """
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self.serve(host, port))
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            async def _stop():
+                self._server.close()
+                await self._server.wait_closed()
+            asyncio.run_coroutine_threadsafe(_stop(), self._loop).result(timeout=10)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = self._thread = None
+        self.close()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._server = None
+
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            500: 'Internal Server Error'}
+
+
+def _coarsen(data_set: 'xr.Dataset', factor: int) -> 'xr.Dataset':
+    # level of a pyramid: the mean of the blocks of factor x factor pixels for the float layers, their top left
+    # pixel for the integer (flag) layers; partial blocks at the edges are dropped
+    import xarray as xr
+    import rioxarray  # registers the .rio accessor
+    x = data_set['x'].coarsen(x=factor, boundary='trim').mean().values
+    y = data_set['y'].coarsen(y=factor, boundary='trim').mean().values
+    layers = {}
+    for name, data_array in data_set.data_vars.items():
+        if not {'y', 'x'} <= set(data_array.dims):
+            continue
+        if data_array.dtype.kind == 'f':
+            coarse = data_array.coarsen(x=factor, y=factor, boundary='trim').mean(keep_attrs=True)
+        else:
+            coarse = data_array.isel(x=slice(0, len(x) * factor, factor), y=slice(0, len(y) * factor, factor))
+        coarse = coarse.drop_vars(['x', 'y']).assign_coords(x=x, y=y)
+        coarse.encoding = {}
+        layers[name] = coarse
+    level = xr.Dataset(layers, attrs=data_set.attrs)
+    return level.rio.write_crs(data_set.rio.crs)
+
+
+def build_overviews(path: Union[str, Path], min_size: int = _tile_size, chunk_size: int = _tile_size) -> List[int]:
+    """
+    Write the overviews (decimated copies) of a zarr store in its overviews/<factor> groups, factors 2, 4, 8 ...
+    until the level fits in a tile, each from the previous one. The tile server reads them at low zooms, so a
+    zoomed out tile reads a few chunks instead of the whole extent of the store. Rebuild after appending.
+
+    Returns: the factors
+    """
+    from . import encoding
+    from . import export
+    path = Path(path)
+    zarr_format = 2 if (path / '.zgroup').exists() else None
+    previous = export.open_cube(path)
+    factors = []
+    factor = 1
+    while max(previous.rio.width, previous.rio.height) > min_size:
+        factor *= 2
+        level = _coarsen(previous, 2)
+        chunks = {'y': chunk_size, 'x': chunk_size}
+        if 'time' in level.dims:
+            chunks['time'] = 1
+        with metrics.timer('tileserver.overviews'):
+            encoding.to_zarr(level.chunk(chunks), path, group=f'overviews/{factor}', mode='w',
+                             zarr_format=zarr_format)
+        previous = export.open_cube(path, group=f'overviews/{factor}')
+        factors.append(factor)
+        logger.debug('Overview %d of %s: %dx%d', factor, path, previous.rio.width, previous.rio.height)
+    return factors
@@ -68,4 +68,972 @@ def test_extract_metadata():
 
 def test_apply_algorithm(): 
     #Tests the apply_algorithm() function to ensure that it correctly applies the specified image processing algorithm to an image.
-    pass
\ No newline at end of file
+    pass
+
+def test_local_cache(tmp_path):
+    # Tests that the local cache resolves cached files first and evicts least recently used, unpinned files.
+    import pyesat.cache
+    local_cache = pyesat.cache.LocalCache(tmp_path / 'cache', max_bytes=250)
+    urls = [f's3://bucket/ECOv002_L2T_LSTE_24420_013_{t}_20221026T142447_0710_01_LST.tif'
+            for t in ['18TWL', '18TXL', '18TWK']]
+    for i, url in enumerate(urls):
+        file_path = local_cache.path_for(url)
+        file_path.write_bytes(b'0' * 100)
+        os.utime(file_path, (i, i))
+    assert local_cache.resolve(urls[0]) == local_cache.path_for(urls[0]).as_posix()
+    assert local_cache.resolve(urls[0].replace('LST.tif', 'QC.tif')).startswith('s3://')
+    local_cache.pin('18TWL')
+    local_cache.evict(required_bytes=100)
+    assert [f.name for f in local_cache.files()] == [local_cache.path_for(urls[0]).name]
+
+
+def test_get_cache(tmp_path, monkeypatch):
+    # Tests that the cache settings are read once per process, until the cache is reset.
+    import configparser
+    import pyesat.cache
+    import pyesat.credentials
+    reads = []
+    def _get_credentials():
+        reads.append(1)
+        config_parser = configparser.ConfigParser()
+        config_parser.read_dict({'cache': {'path': (tmp_path / f'cache{len(reads)}').as_posix(), 'max_bytes': '100'}})
+        return config_parser
+    monkeypatch.setattr(pyesat.credentials, 'get_credentials', _get_credentials)
+    pyesat.cache.reset_cache()
+    try:
+        assert pyesat.cache.get_cache() is pyesat.cache.get_cache() and len(reads) == 1
+        assert pyesat.cache.get_cache().path == tmp_path / 'cache1' and pyesat.cache.get_cache().max_bytes == 100
+        pyesat.cache.reset_cache()
+        assert pyesat.cache.get_cache().path == tmp_path / 'cache2' and len(reads) == 2
+    finally:
+        pyesat.cache.reset_cache()
+
+
+def test_block_cache(tmp_path):
+    # Tests that repeated reads of the same byte ranges are served from the block cache.
+    import pyesat.blockcache
+    data = os.urandom(300 * 1024)
+    fetched = []
+    def fetch(start, end):
+        fetched.append((start, end))
+        return data[start:end + 1]
+    block_cache = pyesat.blockcache.BlockCache(tmp_path / 'blocks', block_size=64 * 1024)
+    assert block_cache.read('s3://bucket/LST.tif', 1000, 100000, len(data), fetch) == data[1000:101000]
+    assert block_cache.read('s3://bucket/LST.tif', 70000, 10, len(data), fetch) == data[70000:70010]
+    assert len(fetched) == 2
+    stats = block_cache.stats()
+    assert stats['hits'] == 1 and stats['bytes_saved'] == 64 * 1024
+    # the directory is swept once, then only when the blocks written go over max_bytes
+    block_cache.max_bytes = 3 * 64 * 1024
+    sweeps = []
+    files = block_cache.files
+    block_cache.files = lambda: sweeps.append(1) or files()
+    assert block_cache.evict() == 0 and block_cache.evict() == 0 and len(sweeps) == 1
+    block_cache.read('s3://bucket/LST.tif', 128 * 1024, 200000, len(data), fetch)
+    assert block_cache.evict() > 0 and len(sweeps) == 2
+    assert sum(f.stat().st_size for f in files()) <= block_cache.max_bytes
+
+
+def test_block_cache_write_failure(tmp_path, monkeypatch):
+    # Tests that a block that can't be written (e.g. on a full disk) leaves no temporary file behind.
+    import pytest
+    import pyesat.blockcache
+    block_cache = pyesat.blockcache.BlockCache(tmp_path / 'blocks', block_size=1024)
+
+    def _full_disk(src, dst):
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(pyesat.blockcache.os, 'replace', _full_disk)
+    with pytest.raises(OSError):
+        block_cache.read('s3://bucket/LST.tif', 0, 100, 4096, lambda start, end: bytes(end - start + 1))
+    assert not [f for f in (tmp_path / 'blocks').rglob('*') if f.is_file()]
+
+
+def test_block_cache_pickle(tmp_path):
+    # Tests that a block cache opener can be shipped to worker processes.
+    import pickle
+    import requests
+    import pyesat.blockcache
+    opener = pyesat.blockcache.BlockCacheOpener(pyesat.blockcache.BlockCache(tmp_path / 'blocks', block_size=1024))
+    opener.fetcher._http = requests.Session()
+    shipped = pickle.loads(pickle.dumps(opener))
+    assert shipped.fetcher._http is None and shipped.block_cache.path == opener.block_cache.path
+    data = os.urandom(4096)
+    assert shipped.block_cache.read('s3://bucket/LST.tif', 10, 2000, len(data),
+                                    lambda start, end: data[start:end + 1]) == data[10:2010]
+    assert shipped.block_cache._lock is not opener.block_cache._lock and shipped.stats()['misses'] == 2
+
+
+class _TestGranule:
+    def __init__(self, id):
+        self.id = id
+
+
+def _flaky_task(granule, attempts):
+    # fails on the first attempt of every granule, and always for 'G3'
+    attempts[granule.id] = attempts.get(granule.id, 0) + 1
+    if attempts[granule.id] == 1 or granule.id == 'G3':
+        raise RuntimeError(granule.id)
+    return granule.id
+
+
+def test_pipeline_runner():
+    # Tests that the pipeline runner retries failed tasks and accounts for the ones that keep failing.
+    import pyesat.pipeline
+    runner = pyesat.pipeline.PipelineRunner('threads', max_workers=2, retries=1, retry_delay=0., verbose=False)
+    result = runner.run([_TestGranule(f'G{i}') for i in range(6)], task=_flaky_task, attempts={})
+    assert sorted(result.succeeded) == ['G0', 'G1', 'G2', 'G4', 'G5']
+    assert list(result.failed) == ['G3']
+    assert all(n == 2 for n in result.attempts.values())
+
+
+def _credentials_task(granule, shipped_credentials=None):
+    return shipped_credentials
+
+
+def test_pipeline_ships_credentials(monkeypatch):
+    # Tests that credentials are collected once and shipped to any task that accepts them.
+    import pyesat.credentials
+    import pyesat.pipeline
+    calls = []
+    monkeypatch.setattr(pyesat.credentials, 'get_worker_credentials', lambda daacs: calls.append(daacs) or {'t': 1})
+    runner = pyesat.pipeline.PipelineRunner('threads', max_workers=2, retries=0, verbose=False)
+    result = runner.run([_TestGranule(f'G{i}') for i in range(3)], task=_credentials_task)
+    assert list(result.succeeded.values()) == [{'t': 1}] * 3 and len(calls) == 1
+
+
+def test_stream_backpressure():
+    # Tests that a slow sink limits how far the stages upstream of it read ahead.
+    import time
+    import pyesat.stream
+    produced = []
+    def source():
+        for i in range(50):
+            produced.append(i)
+            yield i
+    max_ahead = []
+    def slow_sink(item):
+        time.sleep(0.002)
+        max_ahead.append(len(produced) - item)
+    stream = pyesat.stream.Stream(source()).prefetch(4).map(lambda i: i * 2, workers=2).map(lambda i: i // 2)
+    assert stream.sink(slow_sink) == 50
+    # 4 buffered + 4 in flight in the mapping stage + the items being handed over
+    assert max(max_ahead) <= 12
+
+
+def test_job_state(tmp_path):
+    # Tests that failed work is retried up to max_attempts and completed work is skipped on restart.
+    import pyesat.jobs
+    import pyesat.pipeline
+    job_state = pyesat.jobs.JobState('test', db_path=tmp_path / 'pyesat.db', max_attempts=2)
+    # the attempts of the job are the limit, the retries of the runner don't add to them
+    runner = pyesat.pipeline.PipelineRunner('threads', max_workers=2, retries=2, retry_delay=0., verbose=False)
+    granules = [_TestGranule(f'G{i}') for i in range(6)]
+    result = runner.run(granules, task=_flaky_task, job_state=job_state, attempts={})
+    assert sorted(result.succeeded) == ['G0', 'G1', 'G2', 'G4', 'G5'] and result.attempts['G3'] == 2
+    assert job_state.summary()['process'] == {'pending': 0, 'running': 0, 'done': 5, 'failed': 1}
+    assert job_state.status('G3', 'process') == 'failed'
+    result = runner.run(granules, task=_flaky_task, job_state=job_state, attempts={})
+    assert not result.succeeded and not result.attempts
+
+
+def _sleepy_task(granule, delay=0.):
+    import time
+    time.sleep(delay)
+    return granule.id
+
+
+def _run_job(db_path, granule_ids, register_only=False):
+    # run the granules of one process of a shared job
+    import pyesat.jobs
+    import pyesat.pipeline
+    job_state = pyesat.jobs.JobState('shared', db_path=db_path)
+    if register_only:
+        job_state.add(granule_ids, ['process'])
+        return
+    runner = pyesat.pipeline.PipelineRunner('threads', max_workers=2, retries=0, verbose=False)
+    result = runner.run([_TestGranule(g) for g in granule_ids], task=_sleepy_task, job_state=job_state, delay=0.02)
+    assert sorted(result.succeeded) == sorted(granule_ids)
+
+
+def test_job_state_processes(tmp_path):
+    # Tests that processes sharing a job with different granules only claim and run their own granules.
+    import multiprocessing
+    import pyesat.jobs
+    import pyesat.pipeline
+    context = multiprocessing.get_context('fork')
+    others = [f'H{i}' for i in range(10)]
+    # registered by another process that hasn't run them yet
+    process = context.Process(target=_run_job, args=(tmp_path / 'pyesat.db', others, True))
+    process.start()
+    process.join()
+    job_state = pyesat.jobs.JobState('shared', db_path=tmp_path / 'pyesat.db')
+    runner = pyesat.pipeline.PipelineRunner('threads', max_workers=2, retries=0, verbose=False)
+    granules = [_TestGranule(f'G{i}') for i in range(3)]
+    result = runner.run(granules, task=_sleepy_task, job_state=job_state)
+    assert sorted(result.succeeded) == ['G0', 'G1', 'G2']
+    assert job_state.summary()['process'] == {'pending': 10, 'running': 0, 'done': 3, 'failed': 0}
+    # both processes running at the same time
+    process = context.Process(target=_run_job, args=(tmp_path / 'pyesat.db', others))
+    process.start()
+    granules = [_TestGranule(f'G{i}') for i in range(3, 8)]
+    result = runner.run(granules, task=_sleepy_task, job_state=job_state, delay=0.02)
+    process.join()
+    assert sorted(result.succeeded) == [f'G{i}' for i in range(3, 8)] and process.exitcode == 0
+    assert job_state.summary()['process'] == {'pending': 0, 'running': 0, 'done': 18, 'failed': 0}
+
+
+def _interrupted_task(granule):
+    if granule.id == 'G2':
+        raise KeyboardInterrupt()
+    return granule.id
+
+
+def test_job_state_resume(tmp_path):
+    # Tests that the work of an interrupted run and of a worker that died is processed when the job is restarted.
+    import multiprocessing
+    import socket
+    import pytest
+    import sqlalchemy
+    import pyesat.jobs
+    import pyesat.pipeline
+    job_state = pyesat.jobs.JobState('resume', db_path=tmp_path / 'pyesat.db')
+    runner = pyesat.pipeline.PipelineRunner('threads', max_workers=1, max_in_flight=2, retries=0, verbose=False)
+    granules = [_TestGranule(f'G{i}') for i in range(8)]
+    with pytest.raises(KeyboardInterrupt):
+        runner.run(granules, task=_interrupted_task, job_state=job_state)
+    summary = job_state.summary()['process']
+    assert summary['running'] == 0 and summary['done'] >= 2 and summary['pending'] >= 1
+    # a worker that died with claimed work
+    process = multiprocessing.get_context('fork').Process(target=int)
+    process.start()
+    process.join()
+    claimed = job_state.claim('process', n=2)
+    with job_state.engine.begin() as connection:
+        connection.execute(sqlalchemy.update(pyesat.jobs.JobTask)
+                           .where(pyesat.jobs.JobTask.granule_id.in_(claimed))
+                           .values(worker=f'{socket.gethostname()}:{process.pid}'))
+    result = runner.run(granules, task=_sleepy_task, job_state=job_state)
+    assert set(claimed) <= set(result.succeeded) and 'G2' in result.succeeded
+    assert job_state.summary()['process'] == {'pending': 0, 'running': 0, 'done': 8, 'failed': 0}
+
+
+def test_metrics():
+    # Tests that timings, bytes and cache hit ratios are recorded and exported.
+    import pyesat.metrics
+    registry = pyesat.metrics.Metrics()
+    events = []
+    registry.add_sink(lambda kind, name, value: events.append((kind, name)))
+    with registry.timer('cmr.page'):
+        registry.add_bytes('cmr', 1000)
+    try:
+        with registry.timer('cmr.page'):
+            raise RuntimeError('timeout')
+    except RuntimeError:
+        pass
+    for event in ['blockcache.hit', 'blockcache.hit', 'blockcache.hit', 'blockcache.miss']:
+        registry.count(event)
+    summary = registry.summary()
+    assert summary['durations']['cmr.page']['count'] == 2
+    assert summary['counts']['cmr.page.error'] == 1
+    assert summary['hit_ratios'] == {'blockcache': 0.75}
+    assert 'pyesat_bytes_total{op="cmr"} 1000' in registry.to_prometheus()
+    assert ('duration', 'cmr.page') in events
+
+
+def test_progress_logging(caplog):
+    # Tests that progress is logged as rate-limited summaries rather than one record per item.
+    import logging
+    import pyesat.logs
+    with caplog.at_level(logging.INFO, logger='pyesat'):
+        with pyesat.logs.Progress('granules', total=1000, interval=60.) as progress:
+            for _ in range(1000):
+                progress.update(nbytes=1024 ** 2)
+    assert len(caplog.records) == 1
+    assert 'finished: 1000/1000 granules' in caplog.records[0].getMessage()
+
+
+class _TestTileClient:
+    # CMR stand-in returning the granules (tile, bounds) intersecting the bbox of a query
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.queries = []
+
+    def iter_granules(self, bbox, date_range, collection_id, page_size=500, granule_name=None):
+        import pyesat.tiles
+        self.queries.append(bbox)
+        min_lon, min_lat, max_lon, max_lat = [float(b) for b in bbox.split(',')]
+        for tile, bounds in self.tiles.items():
+            if pyesat.tiles.Site(tile, bbox=bounds).intersects([min_lon, min_lat, max_lon, max_lat]):
+                granule = _TestGranule(f'G_{tile}')
+                granule.title = f'ECOv002_L2T_LSTE_24420_013_{tile}_20221026T142447_0710_01'
+                granule.bounds = bounds
+                yield granule
+
+
+# footprints of ECOSTRESS tiles, which extend about 10 km south and east of their MGRS square
+_test_tile_bounds = {'18SUJ': [-77.334, 38.738, -76.038, 39.745], '18TWK': [-75.0, 39.655, -73.702, 40.651],
+                     '18TWL': [-75.0, 40.555, -73.684, 41.552]}
+
+
+def test_search_planner():
+    # Tests that sites in the same MGRS tile share one query and one granule.
+    import pyesat.tiles
+    assert pyesat.tiles.mgrs_tiles([(-73.9857, 40.7484), (-77.0353, 38.8895), (151.2153, -33.8568)]) == \
+        ['18TWL', '18SUJ', '56HLH']
+    sites = [pyesat.tiles.Site('esb', -73.9857, 40.7484), pyesat.tiles.Site('park', -73.9654, 40.7829),
+             pyesat.tiles.Site('dc', -77.0353, 38.8895)]
+    client = _TestTileClient(_test_tile_bounds)
+    planner = pyesat.tiles.SearchPlanner(sites, client=client)
+    results = planner.search('2022-10-01T00:00:00Z,2022-10-31T23:59:59Z')
+    assert len(client.queries) == 2
+    assert results['esb'][0] is results['park'][0] and [g.id for g in results['esb']] == ['G_18TWL']
+    assert [g.id for g in results['dc']] == ['G_18SUJ']
+
+
+def test_search_planner_overlap():
+    # Tests that a site in the strip where two tiles overlap gets the granules of both tiles, once.
+    import pyesat.tiles
+    sites = [pyesat.tiles.Site('strip', -74.409, 40.6043), pyesat.tiles.Site('south', -74.409, 40.2)]
+    assert pyesat.tiles.mgrs_tiles([(site.lon, site.lat) for site in sites]) == ['18TWK', '18TWK']
+    client = _TestTileClient(_test_tile_bounds)
+    results = pyesat.tiles.SearchPlanner(sites, client=client).search('2022-10-01T00:00:00Z,2022-10-31T23:59:59Z')
+    assert len(client.queries) == 1
+    assert sorted(g.id for g in results['strip']) == ['G_18TWK', 'G_18TWL']
+    assert [g.id for g in results['south']] == ['G_18TWK']
+
+
+def _test_cube(path, size=600, times=3):
+    # small georeferenced LST time series in a zarr store
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    import rioxarray
+    data = np.random.default_rng(0).uniform(250, 320, (times, size, size)).astype('float32')
+    data[:, :10, :10] = np.nan
+    data_set = xr.Dataset({'LST': (('time', 'y', 'x'), data)},
+                          coords={'time': pd.date_range('2022-10-01', periods=times, freq='D'),
+                                  'y': 4600020 - 35 - 70 * np.arange(size), 'x': 499980 + 35 + 70 * np.arange(size)})
+    data_set = data_set.rio.write_crs('EPSG:32618').chunk({'time': 1, 'y': 256, 'x': 256})
+    data_set.to_zarr(path.as_posix(), mode='w')
+    return data_set
+
+
+def test_export_cogs(tmp_path):
+    # Tests that per time and composite COGs are written with tiles, overviews and the values of the cube.
+    import numpy as np
+    import rasterio
+    import pyesat.export
+    cube = _test_cube(tmp_path / 'stack.zarr')
+    paths = pyesat.export.export_zarr(tmp_path / 'stack.zarr', tmp_path / 'cogs', composites=['mean'], blocksize=256)
+    assert len(paths) == 4
+    with rasterio.open(paths[-1]) as src:
+        assert src.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+        assert src.block_shapes[0] == (256, 256) and src.overviews(1) == [2, 4]
+        assert src.crs.to_epsg() == 32618 and src.transform.c == 499980
+        np.testing.assert_allclose(src.read(1), cube['LST'].mean('time').values, rtol=1e-6)
+
+
+def test_rechunk(tmp_path):
+    # Tests that per-granule stores are rewritten pixel-major within the memory budget.
+    import pytest
+    import xarray as xr
+    import pyesat.chunking
+    policy = pyesat.chunking.ChunkPolicy(target_bytes=4 * 1024 ** 2)
+    assert policy.spatial_chunks((256, 256), (1568, 1568)) == (1024, 1024)
+    assert policy.read_chunks((512, 512), (300, 300)) == {'band': 1, 'y': 300, 'x': 300}
+    cube = _test_cube(tmp_path / 'stack.zarr', size=300, times=4)
+    for i in range(4):
+        cube.isel(time=[i]).to_zarr((tmp_path / 'granules' / f'G{i}.zarr').as_posix(), mode='w')
+    target = pyesat.chunking.rechunk(tmp_path / 'granules', tmp_path / 'pixels.zarr', spatial_chunks=(50, 50),
+                                     max_mem=4 * 4 * 50 * 300 * 2)
+    pixels = xr.open_zarr(target, decode_coords='all')
+    assert pixels['LST'].encoding['chunks'] == (4, 50, 50) and pixels.rio.crs.to_epsg() == 32618
+    xr.testing.assert_equal(pixels['LST'].load(), cube['LST'].load())
+    # a chunk that doesn't fit the budget is refused
+    with pytest.raises(ValueError):
+        pyesat.chunking.rechunk(tmp_path / 'granules', tmp_path / 'other.zarr', spatial_chunks=(50, 50),
+                                max_mem=4 * 4 * 50 * 50)
+    assert not (tmp_path / 'other.zarr').exists()
+
+
+def test_rechunk_reads(tmp_path, monkeypatch):
+    # Tests that each source chunk is read once, with slabs aligned to the source chunks or through a staging store.
+    import collections
+    from pathlib import Path
+    import zarr
+    import xarray as xr
+    import pyesat.chunking
+    cube = _test_cube(tmp_path / 'stack.zarr', size=300, times=4)
+    for i in range(4):
+        cube.isel(time=[i]).to_zarr((tmp_path / 'granules' / f'G{i}.zarr').as_posix(), mode='w')
+    reads = collections.Counter()
+    get = zarr.storage.LocalStore.get
+
+    async def counting_get(self, key, *args, **kwargs):
+        if Path(self.root).parent.name == 'granules' and key.startswith('LST/c/'):
+            reads[(Path(self.root).name, key)] += 1
+        return await get(self, key, *args, **kwargs)
+
+    monkeypatch.setattr(zarr.storage.LocalStore, 'get', counting_get)
+    # the full time series of the grid fits the budget, then only two time steps of a 256 x 256 source chunk do
+    for max_mem, target in [(2 * 4 * 4 * 300 * 300, 'direct.zarr'), (2 * 2 * 4 * 256 * 256, 'staged.zarr')]:
+        reads.clear()
+        pyesat.chunking.rechunk(tmp_path / 'granules', tmp_path / target, spatial_chunks=(50, 50), max_mem=max_mem)
+        assert len(reads) == 4 * 4 and set(reads.values()) == {1}
+        xr.testing.assert_equal(xr.open_zarr(tmp_path / target, decode_coords='all')['LST'].load(),
+                                cube['LST'].load())
+    assert not (tmp_path / 'staged.staging.zarr').exists()
+
+
+def test_open_layer(tmp_path, monkeypatch):
+    # Tests that a layer is opened once, with chunks aligned to its blocks.
+    import rasterio
+    import pyesat.chunking
+    granule_id = 'ECOv002_L2T_LSTE_24420_013_18TWL_20221026T142447_0710_01'
+    _write_layers(tmp_path, granule_id, layers=('LST',))
+    open_ = rasterio.open
+    opened = []
+    monkeypatch.setattr(rasterio, 'open', lambda *args, **kwargs: opened.append(args[0]) or open_(*args, **kwargs))
+    data_array = pyesat.chunking.open_layer((tmp_path / f'{granule_id}_LST.tif').as_posix(),
+                                            pyesat.chunking.ChunkPolicy(target_bytes=128 * 128 * 4))
+    assert len(opened) == 1 and data_array.chunks == ((1,), (128, 128), (128, 128))
+    assert float(data_array.mean()) == 300.
+
+
+def test_encoding_profiles(tmp_path):
+    # Tests that layers are stored as compressed scaled integers and decode within the documented precision.
+    import numpy as np
+    import xarray as xr
+    import pyesat.encoding
+    cube = _test_cube(tmp_path / 'raw.zarr', size=300, times=2)
+    cube['QC'] = cube['LST'].fillna(0).astype('uint16') * 64
+    # a layer without a profile keeps its nodata value
+    cube['view_zenith'] = cube['LST'].fillna(-9999).astype('int16')
+    cube['view_zenith'].attrs['_FillValue'] = -9999
+    pyesat.encoding.to_zarr(cube, tmp_path / 'v3.zarr')
+    pyesat.encoding.to_zarr(cube, tmp_path / 'v2.zarr', zarr_format=2)
+    pyesat.encoding.to_netcdf(cube, tmp_path / 'cube.nc')
+    precision = pyesat.encoding.profiles['LST'].precision
+    for path in ['v3.zarr', 'v2.zarr', 'cube.nc']:
+        stored = xr.open_dataset(tmp_path / path, mask_and_scale=False)
+        assert stored['LST'].dtype == 'int16' and stored['QC'].dtype == 'uint16'
+        decoded = xr.open_dataset(tmp_path / path, decode_coords='all')
+        assert decoded.rio.crs.to_epsg() == 32618
+        np.testing.assert_allclose(decoded['LST'], cube['LST'], atol=precision + 1e-4)
+        assert decoded['LST'].isnull().equals(cube['LST'].isnull())
+        np.testing.assert_array_equal(decoded['QC'], cube['QC'])
+        assert stored['view_zenith'].attrs['_FillValue'] == -9999
+        assert decoded['view_zenith'].isnull().equals(cube['LST'].isnull())
+    size = lambda path: sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+    assert size(tmp_path / 'v3.zarr' / 'LST') < size(tmp_path / 'raw.zarr' / 'LST') / 1.5
+
+
+def test_probe_header(tmp_path):
+    # Tests that the grid and layout of COGs are read from their header and served from the catalog.
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+    import pyesat.probe
+    paths = []
+    for name, dtype, bigtiff in [('G1_LST.tif', 'float32', 'NO'), ('G1_QC.tif', 'uint16', 'YES')]:
+        path = tmp_path / name
+        with rasterio.open(path.as_posix(), 'w', driver='COG', width=1000, height=700, count=1, dtype=dtype,
+                           crs='EPSG:32618', transform=from_origin(499980., 4600020., 70., 70.), nodata=0,
+                           blocksize=256, compress='DEFLATE', bigtiff=bigtiff) as dst:
+            dst.write(np.ones((700, 1000), dtype=dtype), 1)
+        paths.append(path.as_posix())
+    # a small first read is completed with a second one
+    headers = [pyesat.probe.LayerHeader(granule_id='G1', **pyesat.probe.read_header(path, header_bytes=64))
+               for path in paths]
+    for path, header in zip(paths, headers):
+        with rasterio.open(path) as src:
+            assert header.grid == (src.crs.to_string(), tuple(src.transform)[:6], src.width, src.height)
+            assert header.dtype == src.dtypes[0] and header.block_shape == src.block_shapes[0]
+            assert header.overviews == len(src.overviews(1)) and header.nodata_value == src.nodata
+            assert header.compression == 'DEFLATE' and header.bounds == tuple(src.bounds)
+    catalog = pyesat.probe.HeaderCatalog(tmp_path / 'catalog.db')
+    catalog.put(headers)
+    assert catalog.granule_headers('G1')['QC'].grid == headers[1].grid
+    assert len(pyesat.probe.group_by_grid({'G1': catalog.granule_headers('G1')})) == 1
+
+
+def test_probe_errors(tmp_path, monkeypatch):
+    # Tests that a layer that can't be probed is counted and doesn't discard the headers of the others.
+    import pyesat.cache
+    import pyesat.metrics
+    import pyesat.probe
+    granule_id = 'ECOv002_L2T_LSTE_24420_013_18TWL_20221026T142447_0710_01'
+    _write_layers(tmp_path / 'granules', granule_id)
+    (tmp_path / 'granules' / f'{granule_id}_QC.tif').write_bytes(b'<Error>AccessDenied</Error>')
+    granule = pyesat.earthdata.Granule(_cmr_granule(
+        granule_id, [f's3://bucket/{granule_id}_{layer}.tif' for layer in ['LST', 'LST_err', 'QC']]))
+    granule._local_path = (tmp_path / 'granules').as_posix()
+    monkeypatch.setattr(pyesat.cache, 'get_cache', lambda: pyesat.cache.LocalCache(tmp_path / 'cache'))
+    errors = pyesat.metrics.summary()['counts'].get('probe.error', 0)
+    catalog = pyesat.probe.HeaderCatalog(tmp_path / 'catalog.db')
+    headers = pyesat.probe.probe_granules([granule], catalog=catalog)
+    assert sorted(headers[granule.id]) == ['LST', 'err']
+    assert sorted(catalog.granule_headers(granule.id)) == ['LST', 'err']
+    assert pyesat.metrics.summary()['counts']['probe.error'] == errors + 1
+
+
+def _refresh_credentials(_):
+    import pyesat.credentials
+    return pyesat.credentials.read_earthdata_token(), pyesat.credentials.get_daac_credentials('lpdaac')['access_key']
+
+
+def test_shared_token_store(tmp_path, monkeypatch):
+    # Tests that concurrent workers refresh the credentials once and reuse them from the configuration file.
+    import datetime
+    import json
+    import threading
+    import multiprocessing
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import pyesat.credentials
+    calls = multiprocessing.get_context('fork').Value('i', 0)
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, content):
+            with calls.get_lock():
+                calls.value += 1
+            body = json.dumps(content).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+            self._send([] if 'tokens' in self.path else
+                       {'accessKeyId': 'key', 'secretAccessKey': 'secret', 'sessionToken': 'session',
+                        'expiration': expiration.strftime('%Y-%m-%d %H:%M:%S+00:00')})
+
+        def do_POST(self):
+            expiration = datetime.datetime.now() + datetime.timedelta(days=60)
+            self._send({'access_token': 'token', 'expiration_date': expiration.strftime('%m/%d/%Y')})
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    (tmp_path / '.netrc').write_text('machine urs.earthdata.nasa.gov login user password pass\n')
+    (tmp_path / '.netrc').chmod(0o600)
+    monkeypatch.setenv('HOME', tmp_path.as_posix())
+    monkeypatch.setattr(pyesat.credentials, 'config_file', tmp_path / 'config.ini')
+    monkeypatch.setitem(pyesat.credentials._edl_token_urls, 'list_token', f'{url}/tokens')
+    monkeypatch.setitem(pyesat.credentials._edl_token_urls, 'generate_token', f'{url}/token')
+    monkeypatch.setitem(pyesat.credentials._s3_cred_endpoint, 'lpdaac', f'{url}/s3credentials')
+    try:
+        with multiprocessing.get_context('fork').Pool(8) as pool:
+            assert set(pool.map(_refresh_credentials, range(16))) == {('token', 'key')}
+    finally:
+        server.shutdown()
+    # one token list and generation, one s3credentials request
+    assert calls.value == 3
+    config = pyesat.credentials.get_credentials()
+    assert config.has_section('lpdaac') and config.has_section('urs.earthdata.nasa.gov')
+
+
+def _test_granule(crs, x0, y0, size, lst, qc, time, granule_id):
+    # lazy single granule data set as from Granule.get_xarray
+    import zlib
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    import rioxarray
+    data_set = xr.Dataset({'LST': (('time', 'y', 'x'), np.full((1, size, size), lst, dtype='float32')),
+                           'QC': (('time', 'y', 'x'), np.full((1, size, size), qc, dtype='uint16'))},
+                          coords={'time': [pd.Timestamp(time)], 'y': y0 - 35 - 70 * np.arange(size),
+                                  'x': x0 + 35 + 70 * np.arange(size)},
+                          attrs={'id': f'G{zlib.crc32(granule_id.encode())}-LPCLOUD', 'title': granule_id})
+    data_set['LST'][0, :5, :5] = np.nan
+    return data_set.rio.write_crs(crs).chunk({'y': 128, 'x': 128})
+
+
+def test_value_layers(tmp_path, monkeypatch):
+    # Tests that the value layers read by get_xarray, including the LST error, are masked and scored by value.
+    import pyesat.algorithms
+    import pyesat.cache
+    import pyesat.mosaic
+    granule_id = 'ECOv002_L2T_LSTE_24420_013_18TWL_20221026T142447_0710_01'
+    _write_layers(tmp_path / 'granules', granule_id, layers=('LST', 'LST_err', 'cloud'))
+    granule = pyesat.earthdata.Granule(_cmr_granule(
+        granule_id, [f's3://bucket/{granule_id}_{layer}.tif' for layer in ['LST', 'LST_err', 'cloud']]))
+    granule._local_path = (tmp_path / 'granules').as_posix()
+    monkeypatch.setattr(pyesat.cache, 'get_cache', lambda: pyesat.cache.LocalCache(tmp_path / 'cache'))
+    data_set = granule.get_xarray().load()
+    data_set['cloud'][:] = 0
+    data_set['cloud'][0, :10] = 1
+    masked = pyesat.algorithms.mask_clouds(data_set)
+    assert masked['err'][0, :10].isnull().all() and masked['err'][0, 10:].notnull().all()
+    assert data_set['err'].notnull().all()
+    values = {'err': masked['err'][0].values}
+    assert (pyesat.mosaic.qc_score(values)[:10] == 255).all() and (pyesat.mosaic.qc_score(values)[10:] == 0).all()
+
+
+def test_mosaic(tmp_path):
+    # Tests that granules from two UTM zones are mosaicked lazily with the best QC winning overlaps.
+    import numpy as np
+    import pyesat.mosaic
+    nominal = _test_granule('EPSG:32618', 499980, 4600020, 300, 300., 0b01, '2022-10-01T10:00', 'A')
+    best = _test_granule('EPSG:32618', 499980 + 70 * 100, 4600020, 300, 310., 0b00, '2022-10-01T10:01', 'B')
+    zone_17 = _test_granule('EPSG:32617', 750000, 4600020, 300, 290., 0b00, '2022-10-01T10:02', 'C')
+    grid = pyesat.mosaic.Grid.from_bounds([-78.0, 41.3, -74.7, 41.55], crs='EPSG:32618', origin=(499980, 4600020))
+    cache = pyesat.mosaic.GeometryCache()
+    mosaic = pyesat.mosaic.mosaic([best, zone_17, nominal], grid, chunk_size=256, cache=cache)
+    assert mosaic['LST'].chunks is not None and mosaic.rio.crs.to_epsg() == 32618
+    assert mosaic.attrs['sources'] == [data_set.attrs['id'] for data_set in [nominal, best, zone_17]]
+    result = mosaic.compute()
+    col, row = ~grid.transform * (499980 + 70 * 150, 4600020 - 70 * 150)
+    assert result['LST'][int(row), int(col)] == 310. and result['source'][int(row), int(col)] == 1
+    col, row = ~grid.transform * (499980 + 70 * 50, 4600020 - 70 * 150)
+    assert result['LST'][int(row), int(col)] == 300. and result['QC'][int(row), int(col)] == 1
+    expected = zone_17['LST'].isel(time=0).rio.reproject('EPSG:32618', transform=grid.transform,
+                                                        shape=(grid.height, grid.width), resampling=0)
+    from_zone_17 = result['source'].values == 2
+    # the same pixels as GDAL's nearest neighbour, but for rounding at the edge of the footprint
+    assert (from_zone_17 != np.isfinite(expected.values)).sum() < 10
+    both = from_zone_17 & np.isfinite(expected.values)
+    np.testing.assert_array_equal(result['LST'].values[both], expected.values[both])
+    # the warp geometry is reused
+    mosaic['LST'].compute()
+    assert len(cache._maps) == len(grid.windows(256)) * 3
+
+
+class _ReadLog:
+    # order of the reads of _SlowGranule and of the consumption of their data sets, with the concurrent reads
+    def __init__(self):
+        import threading
+        self.events = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def add(self, event, granule_id, change=0):
+        with self._lock:
+            self.events.append((event, granule_id))
+            self.active += change
+            self.max_active = max(self.max_active, self.active)
+
+
+class _SlowGranule:
+    # granule whose layers take `delay` seconds to read, optionally logging its reads
+    def __init__(self, i, delay, size=100, read_log=None):
+        self.id = f'G{i}'
+        self.delay = delay
+        self.size = size
+        self.read_log = read_log
+
+    def _read(self):
+        import time
+        import numpy as np
+        if self.read_log is not None:
+            self.read_log.add('start', self.id, 1)
+        time.sleep(self.delay)
+        if self.read_log is not None:
+            self.read_log.add('end', self.id, -1)
+        return np.ones((self.size, self.size), dtype='float32')
+
+    def get_xarray(self, data_sets=None, aws=True, verbose=False):
+        import dask
+        import dask.array as da
+        import xarray as xr
+        read = dask.delayed(self._read)()
+        return xr.Dataset({'LST': (('y', 'x'), da.from_delayed(read, (self.size, self.size), dtype='float32'))},
+                          attrs={'id': self.id})
+
+
+def test_read_ahead():
+    # Tests that reads of the next granules overlap with each other and with processing, within the byte budget.
+    import time
+    import pyesat.prefetch
+    read_log = _ReadLog()
+    granules = [_SlowGranule(i, 0.1, read_log=read_log) for i in range(8)]
+    read_ahead = pyesat.prefetch.ReadAhead(granules, lookahead=3, max_bytes=2.5 * 100 * 100 * 4, workers=2)
+    ids = []
+    for data_set in read_ahead:
+        time.sleep(0.1)  # processing
+        ids.append(data_set.attrs['id'])
+        read_log.add('consumed', data_set.attrs['id'])
+    assert ids == [g.id for g in granules]
+    assert read_ahead.budget.peak <= 2.5 * 100 * 100 * 4 and read_ahead.budget.used == 0
+    # reads run at the same time, and the next granules are read while the current one is processed
+    assert read_log.max_active > 1
+    events = read_log.events
+    assert any(events.index(('start', f'G{i}')) < events.index(('consumed', f'G{i - 1}')) for i in range(1, 8))
+
+
+def test_shared_memory_handoff(tmp_path):
+    # Tests that data sets read in worker processes reach the parent through shared memory and are freed.
+    import pickle
+    import functools
+    import multiprocessing
+    import concurrent.futures
+    import numpy as np
+    import pyesat.shm
+    granules = [_SlowGranule(i, 0., size=1568) for i in range(3)]
+    with pyesat.shm.SharedArena(tmp_path) as arena:
+        with concurrent.futures.ProcessPoolExecutor(2, mp_context=multiprocessing.get_context('fork')) as pool:
+            handles = list(pool.map(functools.partial(pyesat.shm.read_shared, arena=arena), granules))
+        assert len(arena.files()) == 3 and len(pickle.dumps(handles[0])) < 4096
+        data_set = handles[0].open()
+        assert isinstance(data_set['LST'].data, np.memmap) and float(data_set['LST'].sum()) == 1568 ** 2
+        assert data_set.attrs['id'] == 'G0'
+        handles[0].release()
+        # views stay valid after the buffer is released
+        assert len(arena.files()) == 2 and float(data_set['LST'][0, 0]) == 1.
+        with handles[1]:
+            handles[1].open()
+        assert len(arena.files()) == 1
+    assert not arena.path.exists()
+
+
+def _png_pixels(png):
+    # RGBA pixels of a PNG written by pyesat.tileserver.encode_png
+    import zlib
+    import struct
+    import numpy as np
+    width, height = struct.unpack('>II', png[16:24])
+    data = zlib.decompress(png[41:41 + struct.unpack('>I', png[33:37])[0]])
+    return np.frombuffer(data, dtype='uint8').reshape(height, width * 4 + 1)[:, 1:].reshape(height, width, 4)
+
+
+def test_tile_server(tmp_path):
+    # Tests that tiles of a cube are rendered per time step from the overviews, cached and served concurrently.
+    import math
+    import urllib.error
+    import urllib.request
+    import concurrent.futures
+    import numpy as np
+    import pytest
+    import xarray as xr
+    import pyesat.encoding
+    import pyesat.tileserver
+    cube = xr.concat([_test_granule('EPSG:32618', 499980, 4600020, 600, lst, 0, time, 'A')
+                      for lst, time in [(290., '2021-07-01'), (310., '2022-07-01')]], dim='time')
+    pyesat.encoding.to_zarr(cube.chunk({'time': 1}), tmp_path / 'cube.zarr')
+    assert pyesat.tileserver.build_overviews(tmp_path / 'cube.zarr') == [2, 4]
+    server = pyesat.tileserver.TileServer([tmp_path / 'cube.zarr'], workers=4)
+    source = server.sources['cube']
+    assert [level.factor for level in source.levels] == [1, 2, 4] and source.level_for(8, 95).factor == 4
+    port = server.start()
+    try:
+        lon, lat = (source.bounds[0] + source.bounds[2]) / 2, (source.bounds[1] + source.bounds[3]) / 2
+        x = int((lon + 180) / 360 * 2 ** 12)
+        y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * 2 ** 12)
+        url = f'http://127.0.0.1:{port}/tiles/cube/12/{x}/{y}.png'
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            tiles = list(executor.map(lambda u: urllib.request.urlopen(u).read(), [url] * 8))
+        assert len(set(tiles)) == 1 and len(server.cache) == 1 and tiles[0][:8] == b'\x89PNG\r\n\x1a\n'
+        style = pyesat.tileserver.Style.for_layer('LST')
+        for time, lst in [(None, 310.), ('2021-06-20', 290.)]:
+            png = urllib.request.urlopen(url + (f'?time={time}' if time else '')).read()
+            assert (_png_pixels(png)[128, 128] == style.apply(np.array([lst]))[0]).all()
+        wmts = urllib.request.urlopen(f'http://127.0.0.1:{port}/wmts/cube/12/{y}/{x}.png').read()
+        assert wmts == tiles[0] and len(server.cache) == 2
+        empty = urllib.request.urlopen(f'http://127.0.0.1:{port}/tiles/cube/12/0/0.png').read()
+        assert (_png_pixels(empty)[..., 3] == 0).all()
+        for path, status in [('tiles/other/1/0/0.png', 404), ('tiles/cube/1/2/0.png', 400),
+                             ('tiles/cube/1/0/0.png?variable=EmisWB', 400)]:
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/{path}')
+            assert error.value.code == status
+    finally:
+        server.stop()
+
+
+def test_climatology_store(tmp_path):
+    # Tests that granules are folded into running per-bin statistics once, with anomalies against the history.
+    import numpy as np
+    import pyesat.algorithms
+    rng = np.random.default_rng(0)
+    store = pyesat.algorithms.ClimatologyStore(tmp_path, chunk_size=128)
+    history = []
+    for year in range(2018, 2024):
+        granule = _test_granule('EPSG:32618', 499980, 4600020, 300, 300., 0, f'{year}-07-01T15:00',
+                                f'ECOv002_L2T_LSTE_{year}_013_18TWL_{year}0701T150000_0710_01').load()
+        granule['LST'][0] = rng.normal(300., 2., (300, 300))
+        if year % 2:
+            granule['LST'][0, :, :150] = np.nan
+        history.append(granule['LST'].values[0].copy())
+        anomaly = store.update(granule)
+    assert anomaly.attrs['bin_label'] == 'doy 177-192, 09-12h'
+    expected = granule['LST'].values[0] - np.nanmean(history[:-1], axis=0)
+    assert np.allclose(anomaly['LST_anomaly'].values[0, 10:, 200:], expected[10:, 200:], atol=1e-3)
+    assert np.isnan(anomaly['LST_anomaly'].values[0, :, :150]).all()
+    store_path, = store.stores()
+    assert store_path.name.startswith('18TWL-')
+    assert store.update(granule) is not None and len(store.granules(store_path)) == 6
+    climatology = store.climatology(store_path).isel(bin=anomaly.attrs['bin']).compute()
+    assert int(climatology['LST_count'][0, 200]) == 6 and int(climatology['LST_count'][10, 10]) == 3
+    assert np.allclose(climatology['LST_mean'].values[10:], np.nanmean(history, axis=0)[10:], atol=1e-3)
+    assert np.allclose(climatology['LST_std'].values[10:], np.nanstd(history, axis=0, ddof=1)[10:], atol=1e-3)
+    assert np.isnan(store.anomaly(granule.assign_coords(time=[np.datetime64('2024-01-01')]))['LST_zscore']).all()
+
+
+def test_climatology_interrupted_update(tmp_path, monkeypatch):
+    # Tests that an update interrupted after some chunks were written is rolled back and can be re-run.
+    import numpy as np
+    import pytest
+    import pyesat.algorithms
+    store = pyesat.algorithms.ClimatologyStore(tmp_path, chunk_size=128)
+    granules = [_test_granule('EPSG:32618', 499980, 4600020, 300, lst, 0, f'{year}-07-01T15:00',
+                              f'ECOv002_L2T_LSTE_{year}_013_18TWL_{year}0701T150000_0710_01').load()
+                for year, lst in [(2020, 300.), (2021, 310.)]]
+    store.update(granules[0].copy())
+    welford_update = pyesat.algorithms.welford_update
+    calls = []
+
+    def _failing_update(*args):
+        calls.append(1)
+        if len(calls) == 4:
+            raise KeyboardInterrupt()
+        return welford_update(*args)
+    monkeypatch.setattr(pyesat.algorithms, 'welford_update', _failing_update)
+    with pytest.raises(KeyboardInterrupt):
+        store.update(granules[1].copy())
+    # a process killed at the same point leaves its journal, the next update rolls it back
+    store_path, = store.stores()
+    assert store.journal_path(store_path).exists()
+    # and the line of a granule it was appending to the record
+    with open(store.granules_path(store_path), 'ab') as f:
+        f.write(b'ECOv002_L2T_LSTE_2022')
+    monkeypatch.setattr(pyesat.algorithms, 'welford_update', welford_update)
+    index = store.update(granules[1].copy()).attrs['bin']
+    assert not store.journal_path(store_path).exists()
+    assert store.granules(store_path) == [granule.attrs['id'] for granule in granules]
+    climatology = store.climatology(store_path, min_count=1).isel(bin=index).compute()
+    assert (climatology['LST_count'].values[5:, 5:] == 2).all()
+    assert np.allclose(climatology['LST_mean'].values[5:, 5:], 305.)
+
+
+def _cmr_granule(granule_id, urls):
+    # granule json entry as returned by the CMR, the id is a concept id and the title the granule name
+    import zlib
+    return {'id': f'G{zlib.crc32(granule_id.encode())}-LPCLOUD', 'dataset_id': 'ECOSTRESS Tiled Land Surface Temperature', 'data_center': 'LPCLOUD',
+            'time_start': '2022-10-26T14:24:47.000Z', 'time_end': '2022-10-26T14:25:39.000Z',
+            'collection_concept_id': 'C2076090826-LPCLOUD', 'producer_granule_id': granule_id,
+            'browse_flag': True, 'online_access_flag': True, 'original_format': 'ECHO10',
+            'coordinate_system': 'CARTESIAN', 'day_night_flag': 'DAY', 'title': granule_id,
+            'updated': '2022-10-27T00:00:00.000Z', 'granule_size': '1.0',
+            'orbit_calculated_spatial_domains': [{'start_orbit_number': '24420', 'stop_orbit_number': '24420'}],
+            'boxes': ['41.4 -75.0 42.3 -73.8'], 'links': [{'href': url} for url in urls]}
+
+
+def _write_layers(path, granule_id, layers=('LST', 'LST_err', 'QC')):
+    # small COG layers of a granule
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+    path.mkdir(parents=True, exist_ok=True)
+    for layer in layers:
+        dtype = 'uint16' if layer == 'QC' else 'float32'
+        with rasterio.open((path / f'{granule_id}_{layer}.tif').as_posix(), 'w', driver='COG', width=256,
+                           height=256, count=1, dtype=dtype, crs='EPSG:32618', nodata=None if layer == 'QC' else np.nan,
+                           transform=from_origin(499980., 4600020., 70., 70.), blocksize=128) as dst:
+            dst.write(np.full((256, 256), 300, dtype=dtype), 1)
+
+
+def test_time_to_first_byte(tmp_path, monkeypatch):
+    # Tests that the time to open the first remote layer is measured and committed to the catalog.
+    import contextlib
+    import pyesat.cache
+    import pyesat.chunking
+    granule_id = 'ECOv002_L2T_LSTE_24420_013_18TWL_20221026T142447_0710_01'
+    _write_layers(tmp_path / 'bucket', granule_id)
+    granule = pyesat.earthdata.Granule(_cmr_granule(
+        granule_id, [f's3://bucket/{granule_id}_{layer}.tif' for layer in ['LST', 'LST_err', 'QC']]))
+    # the S3 bucket is served from disk
+    open_layer = pyesat.chunking.open_layer
+    opened = []
+    def _open_layer(url, policy=None, **open_kwargs):
+        opened.append(url)
+        return open_layer(url.replace('s3://', f'{tmp_path.as_posix()}/'), policy, **open_kwargs)
+    monkeypatch.setattr(pyesat.chunking, 'open_layer', _open_layer)
+    monkeypatch.setattr(pyesat.earthdata, 'DaacReadSession', contextlib.nullcontext)
+    monkeypatch.setattr(pyesat.cache, 'get_cache', lambda: pyesat.cache.LocalCache(tmp_path / 'cache'))
+    monkeypatch.setattr(pyesat.earthdata, 'db_path', tmp_path / 'pyesat.db')
+    pyesat.earthdata.create_orm_classes(db_path=tmp_path / 'pyesat.db')
+    data_set = granule.get_xarray(data_sets=['QC', 'LST'], block_cache=False)
+    assert list(data_set.data_vars) == ['QC', 'LST'] and len(opened) == 2
+    assert 0 < granule._time_to_first_byte
+    with pyesat.earthdata.SessionContextManager(db_path=tmp_path / 'pyesat.db') as session:
+        stored = session.get(pyesat.earthdata.Granule, granule.id)
+        assert stored._time_to_first_byte == granule._time_to_first_byte
+
+
+def test_encoding_layer_names(tmp_path, monkeypatch):
+    # Tests that the layers read by get_xarray are stored with their encoding profiles.
+    import pyesat.cache
+    import pyesat.encoding
+    granule_id = 'ECOv002_L2T_LSTE_24420_013_18TWL_20221026T142447_0710_01'
+    _write_layers(tmp_path / 'granules', granule_id)
+    granule = pyesat.earthdata.Granule(_cmr_granule(
+        granule_id, [f's3://bucket/{granule_id}_{layer}.tif' for layer in ['LST', 'LST_err', 'QC']]))
+    granule._local_path = (tmp_path / 'granules').as_posix()
+    monkeypatch.setattr(pyesat.cache, 'get_cache', lambda: pyesat.cache.LocalCache(tmp_path / 'cache'))
+    data_set = granule.get_xarray()
+    encoding = pyesat.encoding.zarr_encoding(data_set)
+    for name in data_set.data_vars:
+        assert encoding[name]['dtype'] == pyesat.encoding.profiles[name].dtype
+    assert encoding['err']['scale_factor'] == 0.001
+
+
+def test_download_interrupted(tmp_path, monkeypatch):
+    # Tests that an interrupted download leaves no partial file in the cache, and a download is recorded.
+    import urllib.request
+    import pytest
+    import pyesat.cache
+    local_cache = pyesat.cache.LocalCache(tmp_path / 'cache')
+    monkeypatch.setattr(pyesat.cache, 'get_cache', lambda: local_cache)
+    granule_id = 'ECOv002_L2T_LSTE_24420_013_18TWL_20221026T142447_0710_01'
+    granule = pyesat.earthdata.Granule(_cmr_granule(granule_id, [f's3://bucket/{granule_id}_LST.tif']))
+
+    def _interrupted(url, file_name):
+        with open(file_name, 'wb') as f:
+            f.write(b'0' * 100)
+        raise ConnectionResetError(url)
+    monkeypatch.setattr(urllib.request, 'urlretrieve', _interrupted)
+    with pytest.raises(ConnectionResetError):
+        granule.download()
+    assert not list((tmp_path / 'cache').iterdir())
+    assert granule.resolve_links()[0].startswith('s3://')
+    monkeypatch.setattr(urllib.request, 'urlretrieve', lambda url, file_name: open(file_name, 'wb').close())
+    monkeypatch.setattr(pyesat.earthdata, 'db_path', tmp_path / 'pyesat.db')
+    pyesat.earthdata.create_orm_classes(db_path=tmp_path / 'pyesat.db')
+    granule.download()
+    assert granule.resolve_links() == [local_cache.path_for(granule.s3[0]).as_posix()]
+    # the download is recorded in the catalog
+    with pyesat.earthdata.SessionContextManager(db_path=tmp_path / 'pyesat.db') as session:
+        stored = session.get(pyesat.earthdata.Granule, granule.id)
+        assert stored._is_downloaded and stored._local_path == local_cache.path.as_posix()
+
+
+def test_download_resolved_by_new_session(tmp_path, monkeypatch):
+    # Tests that a granule downloaded to a directory is read from it when found again by a search.
+    import urllib.request
+    import sqlalchemy
+    import pyesat.cache
+    monkeypatch.setattr(pyesat.cache, 'get_cache', lambda: pyesat.cache.LocalCache(tmp_path / 'cache'))
+    monkeypatch.setattr(urllib.request, 'urlretrieve', lambda url, file_name: open(file_name, 'wb').close())
+    monkeypatch.setattr(pyesat.earthdata, 'db_path', tmp_path / 'pyesat.db')
+    pyesat.earthdata.create_orm_classes(db_path=tmp_path / 'pyesat.db')
+    granule_id = 'ECOv002_L2T_LSTE_24420_013_18TWL_20221026T142447_0710_01'
+    entry = _cmr_granule(granule_id, [f's3://bucket/{granule_id}_LST.tif'])
+    (tmp_path / 'granules').mkdir()
+    pyesat.earthdata.Granule(entry).download(out_dir=tmp_path / 'granules')
+    granule = pyesat.earthdata.Granule(entry)
+    assert granule.resolve_links() == [(tmp_path / 'granules' / f'{granule_id}_LST.tif').as_posix()]
+    assert granule._is_downloaded
+    # many granules are looked up in one query, once
+    queries = []
+    engine = pyesat.earthdata.get_engine(tmp_path / 'pyesat.db')
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', lambda *args: queries.append(args[2]))
+    others = [pyesat.earthdata.Granule(_cmr_granule(name, [f's3://bucket/{name}_LST.tif']))
+              for name in [granule_id, granule_id.replace('18TWL', '18TWK')]]
+    links = pyesat.earthdata.resolve_links(others)
+    assert links[others[0].id] == granule.resolve_links() and links[others[1].id][0].startswith('s3://')
+    others[1].resolve_links()
+    assert len(queries) == 1